@@ -1,19 +1,39 @@
+import datetime
 import json
-from typing import Optional, List, Set
+from typing import Dict, Optional, List, Set, Tuple
 
 import asyncpg
 
+from pool_manager import PoolConfig, PoolManager
+from queries import QUERIES, SCHEMA, StatementRegistry
+from storage import Event, Storage
 
-class SQLManager:
-    def __init__(self, database_url: str, bot_loop):
+
+class SQLManager(Storage):
+    """PostgreSQLに保存"""
+
+    def __init__(self, database_url: str, bot_loop, pool_config: PoolConfig = PoolConfig()):
+        super().__init__()
         self.loop = bot_loop
         self.con = None
         self.database_url = database_url
+        self.statements = StatementRegistry(QUERIES)  # SQLの実行と再利用率の記録
+        self.pool = PoolManager(database_url, pool_config, init=self.statements.init_connection)  # 接続プール
+        self.event_partitions: Set[datetime.datetime] = set()  # 作成済みのイベントのパーティション (月初の日時)
+        self.legacy_guilds: Set[int] = set()  # 旧形式のデータを移行していないサーバー (読み込み時に移行する)
 
     # Connection
     async def connect(self) -> asyncpg.connection:
         """データベースに接続"""
-        self.con = await asyncpg.create_pool(self.database_url, loop=self.loop)
+        # テーブルが存在しない場合は作成 (プールの接続でSQLを準備する前に行う)
+        con = await asyncpg.connect(self.database_url)
+        try:
+            await con.execute(SCHEMA)
+        finally:
+            await con.close()
+        self.con = await self.pool.open(self.loop)
+        await self.load_guild_settings()  # サーバー設定をキャッシュに読み込み
+        self.legacy_guilds = set(await self._fetchval("get_legacy_guild_ids") or [])
 
     def is_connected(self) -> bool:
         """データベースに接続しているか確認"""
@@ -22,249 +42,260 @@ class SQLManager:
         else:
             return True
 
+    def get_backend_stats(self) -> Dict[str, str]:
+        """接続プールと準備済みステートメントの統計を取得"""
+        pool = self.pool.get_stats()
+        statements = self.statements.get_stats()
+        return {
+            "Pool": f"Connections: {pool['in_use']} in use / {pool['size']} open / {pool['max_size']} max\n"
+                    f"Waiting: {pool['waiting']} (avg {pool['wait_avg'] * 1000:.1f}[ms] / max {pool['wait_max'] * 1000:.1f}[ms] / timeout {pool['timeouts']}times)\n"
+                    f"Recycled: {pool['recycled']}connections",
+            "Database": f"Statements: {statements['statements']} x {statements['connections']}connections (hit {statements['hit_rate']:.1%} / prepare {statements['misses']}times {statements['prepare_time'] * 1000:.1f}[ms])",
+        }
+
+    async def _fetch(self, name: str, *args) -> List[asyncpg.Record]:
+        """準備済みのSQLを実行して全ての行を取得"""
+        async with self.pool.acquire() as con:
+            return await self.statements.fetch(con, name, *args)
+
+    async def _fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        """準備済みのSQLを実行して最初の行を取得"""
+        async with self.pool.acquire() as con:
+            return await self.statements.fetchrow(con, name, *args)
+
+    async def _fetchval(self, name: str, *args):
+        """準備済みのSQLを実行して最初の値を取得"""
+        async with self.pool.acquire() as con:
+            return await self.statements.fetchval(con, name, *args)
+
+    async def _execute(self, name: str, *args) -> None:
+        """準備済みのSQLを実行"""
+        async with self.pool.acquire() as con:
+            await self.statements.fetch(con, name, *args)
+
     # Guild
     async def get_guild_ids(self) -> list:
         """登録されているサーバーIDのリストを取得"""
         # SELECT array_agg(id) FROM server // id列の値をすべて配列にして表示
-        res = await self.con.fetchrow("SELECT array_agg(id) FROM server;")
-        return dict(res)["array_agg"]
+        return await self._fetchval("get_guild_ids") or []
 
-    async def is_enabled_guild(self, guild_id: int) -> bool:
-        """特定のサーバーでモニターが有効になっているかどうかを確認"""
-        res = await self.con.fetchrow("SELECT channel FROM server WHERE id = $1;", guild_id)
-        if res is None or res["channel"] is None:
-            return False
-        else:
-            return True
+    async def _fetch_guild_settings(self) -> Dict[int, Optional[int]]:
+        """全サーバーのログチャンネルIDを取得"""
+        return {record["id"]: record["channel"] for record in await self._fetch("get_guild_settings")}
 
-    async def enable_guild(self, guild_id: int, channel_id: int) -> None:
-        """有効にする"""
-        if not await self.is_registered_guild(guild_id):
-            await self.register_new_guild(guild_id)
-        await self.con.execute("UPDATE server SET channel = $1 WHERE id = $2;", channel_id, guild_id)
-
-    async def disable_guild(self, guild_id: int) -> None:
-        """無効にする"""
-        await self.con.execute("UPDATE server SET channel = null WHERE id = $1;", guild_id)
+    async def _set_log_channel_id(self, guild_id: int, channel_id: Optional[int]) -> None:
+        """ログチャンネルIDを保存 (Noneの場合は無効)"""
+        if channel_id is None:
+            await self._execute("disable_guild", guild_id)
+        else:
+            await self._execute("enable_guild", guild_id, channel_id)
 
     async def is_registered_guild(self, guild_id: int) -> bool:
         """サーバーが登録されているか確認"""
-        res = await self.con.fetchrow("select count(*) from server where id = $1", guild_id)
-        if res is None or res["count"] is None or res["count"] == 0:
-            return False
-        else:
-            return True
+        return await self._fetchval("is_registered_guild", guild_id)
 
-    async def register_new_guild(self, guild_id: int) -> None:
-        """新規サーバーのデータを追加"""
-        try:
-            await self.con.execute("INSERT INTO server values($1)", guild_id)
-        except asyncpg.exceptions.UniqueViolationError:
-            pass  # サーバーに再参加した場合
+    async def _insert_guilds(self, guild_ids: List[int]) -> List[int]:
+        """登録されていないサーバーを追加して、追加したサーバーIDのリストを取得"""
+        return [record["id"] for record in await self._fetch("register_new_guilds", guild_ids)]
+
+    async def set_guilds_left(self, guild_ids: List[int], left: bool) -> None:
+        """サーバーの退出日時を記録 (leftがFalseの場合は退出日時を消去)"""
+        await self._execute("set_guilds_left" if left else "set_guilds_returned", guild_ids)
 
     async def get_guild_users_count(self, guild_id: int) -> int:
         """サーバーが認識しているユーザー数を取得"""
-        res = await self.con.fetchrow("SELECT count(keys) FROM (SELECT jsonb_object_keys(users) AS keys FROM server WHERE id = $1)r ;", guild_id)
-        if res is None or res["count"] is None:
-            return 0
-        else:
-            return res["count"]
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("get_guild_users_count", guild_id) or 0
 
     async def get_guild_users(self, guild_id: int) -> list:
         """保存されているユーザーのリストを取得"""
-        res = await self.con.fetchrow("SELECT array_agg(keys) FROM (SELECT jsonb_object_keys(users) AS keys FROM server WHERE id = $1)r ;", guild_id)
-        if res is None or res["array_agg"] is None:
-            return []
-        else:
-            return res["array_agg"]
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("get_guild_users", guild_id) or []
 
     async def get_enabled_guild_ids(self) -> list:
         """登録されているサーバーIDのリストを取得"""
         # SELECT array_agg(id) FROM server WHERE channel is not null // channelがnullでない(=有効化されている)サーバーのidを配列で取得
-        res = await self.con.fetchrow("SELECT array_agg(id) FROM server WHERE channel is not null;")
-        if guild_ids := dict(res)["array_agg"]:  # データが存在する場合
-            return guild_ids
-        else:  # データが空の場合
-            return []
+        return await self._fetchval("get_enabled_guild_ids") or []
 
-    async def get_log_channel_id(self, guild_id: int) -> Optional[int]:
-        """ログ送信用チャンネルを取得"""
-        res = await self.con.fetchrow("SELECT channel FROM server WHERE id = $1", guild_id)
-        if res is None or res["channel"] is None:
-            return None
-        else:
-            return res["channel"]
+    async def _fetch_log_channel_id(self, guild_id: int) -> Optional[int]:
+        """ログ送信用チャンネルをデータベースから取得"""
+        return await self._fetchval("get_log_channel_id", guild_id)
 
     # Trigger
     async def get_code_trigger_list(self, guild_id: int) -> list:
         """招待コードトリガーに設定されているコードのリストを取得"""
-        # SELECT array_agg(keys) FROM () r // keysを配列に整形して表示 (名前をつけないといけないため任意の名前r(AS r)を追加)
-        # SELECT jsonb_object_keys(code_trigger) AS keys FROM server WHERE id = $1 // code_triggerのキー一覧を取得してkeysという名前で保存
-        res = await self.con.fetchrow("""
-            SELECT array_agg(keys) FROM (
-                SELECT jsonb_object_keys(code_trigger) AS keys FROM server WHERE id = $1
-            ) r
-        """, guild_id)
-        if res is None or res["array_agg"] is None:
-            return []
-        else:
-            return res["array_agg"]
+        return await self._fetchval("get_code_trigger_list", guild_id) or []
 
     async def get_code_trigger_count(self, guild_id: int) -> int:
         """招待コードトリガーの数を取得"""
-        res = await self.con.fetchrow("select count(keys) from (select jsonb_object_keys(code_trigger) as keys from server where id = $1)r ;", guild_id)
-        if res is None or res["count"] is None:
-            return 0
-        else:
-            return res["count"]
+        return await self._fetchval("get_code_trigger_count", guild_id) or 0
 
     async def get_code_trigger_roles(self, guild_id: int, code: str) -> list:
         """招待コードトリガーに設定されている役職のリストを取得"""
-        res = await self.con.fetchrow("SELECT code_trigger->>$1 AS f FROM server WHERE id = $2;", code, guild_id)
+        res = await self._fetchrow("get_code_trigger_roles", guild_id, code)
         if res is None or res["f"] is None or res["f"] == "null":
             return []
         else:
             return json.loads(res["f"])  # 文字列で返って来るので手動で変換
 
     async def add_code_trigger(self, guild_id: int, code: str, roles: list) -> None:
-        # UPDATE SERVER SET code_trigger = jsonb_set(code_trigger, '{%s}', $1::jsonb) where id = $2 # [code_trigger][code] = roles
-        await self.con.execute("UPDATE SERVER SET code_trigger = jsonb_set(code_trigger, '{%s}', $1::jsonb) where id = $2" % code, json.dumps(roles), guild_id)
+        """招待コードトリガーを追加"""
+        await self._execute("add_code_trigger", guild_id, code, json.dumps(roles))
 
     async def remove_code_trigger(self, guild_id: int, code: str) -> None:
         """招待コードトリガーから設定されているコードを削除"""
-        # UPDATE server set code_trigger = // code_triggerの値を更新
-        # code_trigger - code // code_triggerの中のキーがcodeである要素を削除
-        # WHERE id = guild_id // idがサーバーであるものに適用
-        await self.con.execute("UPDATE server set code_trigger = code_trigger - $1 WHERE id = $2;", code, guild_id)
+        await self._execute("remove_code_trigger", guild_id, code)
 
     async def get_user_trigger_list(self, guild_id: int) -> list:
         """ユーザートリガーに設定されているコードのリストを取得"""
-        # SELECT array_agg(keys) FROM () r // keysを配列に整形して表示 (名前をつけないといけないため任意の名前r(AS r)を追加)
-        # SELECT jsonb_object_keys(user_trigger) AS keys FROM server WHERE id = $1 // user_triggerのキー一覧を取得してkeysという名前で保存
-        res = await self.con.fetchrow("""
-            SELECT array_agg(keys) FROM (
-                SELECT jsonb_object_keys(user_trigger) AS keys FROM server WHERE id = $1
-            ) r
-        """, guild_id)
-        if res is None or res["array_agg"] is None:
-            return []
-        else:
-            return res["array_agg"]
+        return await self._fetchval("get_user_trigger_list", guild_id) or []
 
     async def get_user_trigger_count(self, guild_id: int) -> int:
         """ユーザートリガーの数を取得"""
-        res = await self.con.fetchrow("select count(keys) from (select jsonb_object_keys(user_trigger) as keys from server where id = $1)r ;", guild_id)
-        if res is None or res["count"] is None:
-            return 0
-        else:
-            return res["count"]
+        return await self._fetchval("get_user_trigger_count", guild_id) or 0
 
     async def get_user_trigger_roles(self, guild_id: int, user_id: int) -> list:
         """ユーザートリガーに設定されている役職のリストを取得"""
-        res = await self.con.fetchrow("SELECT user_trigger->>$1 AS f FROM server WHERE id = $2;", str(user_id), guild_id)
+        res = await self._fetchrow("get_user_trigger_roles", guild_id, str(user_id))
         if res is None or res["f"] is None or res["f"] == "null":
             return []
         else:
             return json.loads(res["f"])  # 文字列で返って来るので手動で変換
 
     async def add_user_trigger(self, guild_id: int, user_id: int, roles: list) -> None:
-        # UPDATE SERVER SET code_trigger = jsonb_set(code_trigger, '{%s}', $1::jsonb) where id = $2 # [user_trigger][user_id] = roles
-        await self.con.execute("UPDATE SERVER SET user_trigger = jsonb_set(user_trigger, '{%d}', $1::jsonb) where id = $2" % user_id, json.dumps(roles), guild_id)
+        """ユーザートリガーを追加"""
+        await self._execute("add_user_trigger", guild_id, str(user_id), json.dumps(roles))
 
     async def remove_user_trigger(self, guild_id: int, user: int) -> None:
         """ユーザートリガーから設定されているコードを削除"""
-        # UPDATE server set user_trigger = // user_triggerの値を更新
-        # user_trigger - code // user_triggerの中のキーがcodeである要素を削除
-        # WHERE id = guild_id // idがサーバーであるものに適用
-        await self.con.execute("UPDATE server set user_trigger = user_trigger - $1 WHERE id = $2;", str(user), guild_id)
+        await self._execute("remove_user_trigger", guild_id, str(user))
 
     # Invites
-    async def add_invited_to_inviter(self, guild_id: int, inviter: int, invited: int) -> None:
-        """招待履歴を招待者のデータに追加"""
-        if not await self.is_registered_user(guild_id, inviter):
-            await self.register_new_user(guild_id, inviter)
-        res = await self.con.fetchrow("select users->$1->'to' as f from server where id = $2;", str(inviter), guild_id)
-        if res is not None and dict(res)["f"] is not None and invited in json.loads(dict(res)["f"]):
-            return  # 既にユーザーが追加されている場合は終了
-        # UPDATE server SET users = jsonb_insert(users, '{%d, to, 0}', $1) // users[inviter][to]にある配列にinvitedを追加
-        await self.con.execute("UPDATE server SET users = jsonb_insert(users, '{%d, to, 0}', $1)" % inviter, str(invited))
-
-    async def add_inviter_to_invited(self, guild_id: int, inviter: int, invited: int) -> None:
-        """招待元ユーザーデータを招待された人のデータに追加"""
-        if not await self.is_registered_user(guild_id, invited):
-            await self.register_new_user(guild_id, invited)
-        # UPDATE server SET users = jsonb_set(users, '{%d, from}, $1)) // users[invited][from]にinvitedを代入
-        await self.con.execute("UPDATE server SET users = jsonb_set(users, '{%d, from}', $1)" % invited, str(inviter))
-
-    async def add_code_to_invited(self, guild_id: int, code: str, invited: int) -> None:
-        """使用した招待コードを招待された人のデータに追加"""
-        if not await self.is_registered_user(guild_id, invited):
-            await self.register_new_user(guild_id, invited)
-        # UPDATE server SET users = jsonb_set(users, '{%d, from}, $1)) // users[invited][code]にinvitedを代入
-        # 文字列を代入したい場合,'"string"'の形式にする必要があるため%で代入
-        await self.con.execute("UPDATE server SET users = jsonb_set(users, '{%d, code}', '\"%s\"')" % (invited, code))
+    async def record_join(self, guild_id: int, inviter: int, invited: int, code: str) -> None:
+        """参加履歴を1回の問い合わせで記録 (招待者の登録, 招待履歴の追加, 招待元と招待コードの保存)"""
+        # 全て重複時の処理をON CONFLICTで行うため、同時に参加があっても競合しない
+        await self._execute("record_join", guild_id, inviter, invited, code)
+
+    async def record_joins(self, records: List[Tuple[int, int, int, str]]) -> None:
+        """複数の参加履歴をまとめて記録 [(サーバーID, 招待者ID, 参加者ID, 招待コード), ...]"""
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await self.statements.executemany(con, "record_join", records)
 
     # User
     async def register_new_user(self, guild_id: int, user_id: int) -> None:
         """新規ユーザーデータを追加"""
-        init_data = {user_id: {"to": [], "from": None, "code": None, "uid": user_id}}
-        await self.con.execute("UPDATE server SET users = users||$1::jsonb WHERE id = $2", json.dumps(init_data), guild_id)
+        await self._execute("register_new_user", guild_id, user_id)
 
-    async def reset_user_data(self, guild_id: int, user_id: int):
-        """既存ユーザーデータをクリア"""
-        await self.con.execute("UPDATE SERVER SET users = jsonb_set(users, '{%d, to}', '[]'::jsonb) where id = $1" % user_id, guild_id)
+    async def mark_member_left(self, guild_id: int, user_id: int) -> None:
+        """メンバーの退出日時を記録 (再参加時に消去)"""
+        await self._execute("mark_member_left", guild_id, user_id)
+
+    async def reset_users_data(self, guild_id: int, user_ids: Optional[List[int]] = None):
+        """複数ユーザーのデータを1回でクリア (user_idsを指定しない場合はサーバー全体)"""
+        await self._migrate_if_legacy(guild_id)  # クリア後に旧形式のデータが移行されて戻らないように先に移行
+        if user_ids is None:
+            await self._execute("reset_guild_users_data", guild_id)
+        else:
+            await self._execute("reset_users_data", guild_id, user_ids)
 
     async def get_user_invite_count(self, guild_id: int, user_id: int) -> int:
         """特定ユーザーの招待数を取得"""
-        res = await self.con.fetchrow("SELECT jsonb_array_length(users#>'{%d, to}') FROM server WHERE id = $1;" % user_id, guild_id)
-        if res is None or res["jsonb_array_length"] is None:
-            return 0
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("get_user_invite_count", guild_id, user_id) or 0
+
+    async def get_leaderboard(self, guild_id: int, limit: int, after: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int]]:
+        """招待数の多いユーザーのリストを取得 [(ユーザーID, 招待数), ...] afterを指定した場合はその次から (前のページの最後の行)"""
+        await self._migrate_if_legacy(guild_id)
+        if after is None:
+            records = await self._fetch("get_leaderboard", guild_id, limit)
         else:
-            return res["jsonb_array_length"]
+            records = await self._fetch("get_leaderboard_after", guild_id, limit, after[1], after[0])
+        return [(record["user_id"], record["count"]) for record in records]
 
     async def get_user_invite_from(self, guild_id: int, user_id: int) -> Optional[int]:
         """特定ユーザーの招待元ユーザーIDを取得"""
-        # SELECT users#>'{%d, from}' AS f FROM server WHERE id = $1 // [users][user_id][from]にある値を取得
-        res = await self.con.fetchrow("SELECT users#>'{%d, from}' AS f FROM server WHERE id = $1;" % user_id, guild_id)
-        if res is None or res["f"] is None or res["f"] == "null":
-            return None
-        else:
-            return int(res["f"])
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("get_user_invite_from", guild_id, user_id)
 
     async def get_user_invite_code(self, guild_id: int, user_id: int) -> Optional[str]:
         """特定ユーザーの参加時の招待コードを取得"""
-        # SELECT users#>'{%d, code}' AS f FROM server WHERE id = $1 // [users][user_id][code]にある値を取得
-        res = await self.con.fetchrow("SELECT users#>'{%d, code}' AS f FROM server WHERE id = $1;" % user_id, guild_id)
-        if res is None or res["f"] is None or res["f"] == "null":
-            return None
-        else:  # "CodeTEsT" -> CodeTEsT
-            return res["f"].strip('"')  # 普通のテキストとして取得するので,でコードされないので,手動でデコードする
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("get_user_invite_code", guild_id, user_id)
 
     async def is_registered_user(self, guild_id: int, user_id: int) -> bool:
         """ユーザーがサーバーのユーザーリストに登録されているか確認"""
-        # SELECT users ? $1 AS f FROM server WHERE id = $2 // idがguild_idであるもので、usersの中にinvitedというキーがあるかどうか
-        res = await self.con.fetchrow("SELECT users ? $1 AS f FROM server WHERE id = $2;", str(user_id), guild_id)
-        if res is None or not res["f"]:
-            return False
-        else:
-            return True
+        await self._migrate_if_legacy(guild_id)
+        return await self._fetchval("is_registered_user", guild_id, user_id)
 
     async def filter_with_code_and_from(self, code_list: List[str], from_list: List[str], guild_id: int) -> Set[int]:
         """指定した招待コードまたは招待者によって参加した人のIDリストを取得"""
-        sql = ""
-        # @.code like_regex "code1|code2" ... 招待コードがcode1またはcode2であるならば
-        if code_list:
-            sql += "@.code like_regex \"" + "|".join([f"{i}" for i in code_list]) + "\""
-        if from_list:
-            # @from == 128319 || @from == 198733 ... 招待者が128319か198733ならば
-            from_sql = "@.from == " + f" || @.from == ".join(from_list)
-            if sql:  # 招待コードの条件があった場合は OR の記号を追加
-                sql += "||" + from_sql
-            else:
-                sql += from_sql
-        id_list = set()
-        # SELECT jsonb_path_query(users, '$.* ? (%s)') FROM server; ... 任意のキー内の条件に合う値を取得
-        res = await self.con.fetch("SELECT jsonb_path_query(users, '$.* ? (%s)') FROM server where id = $1;" % sql, guild_id)
-        for record in res:
-            id_list.add(json.loads(record['jsonb_path_query'])["uid"])
-        return id_list
+        await self._migrate_if_legacy(guild_id)
+        res = await self._fetch("filter_with_code_and_from", guild_id, code_list, [int(user_id) for user_id in from_list])
+        return {record["user_id"] for record in res}
+
+    # Event
+    async def record_events(self, events: List[Event]) -> None:
+        """複数のイベントをまとめて追記 (必要な月のパーティションを先に作成)"""
+        months = {event[0].astimezone(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0) for event in events}
+        async with self.pool.acquire() as con:
+            if new_months := months - self.event_partitions:
+                await self.statements.fetch(con, "create_event_partitions", list(new_months))
+                self.event_partitions |= new_months
+            await self.statements.fetch(con, "record_events", *[list(column) for column in zip(*events)])
+
+    async def get_events(self, guild_id: int, since: datetime.datetime, until: datetime.datetime) -> List[Event]:
+        """期間内(since以上until未満)のサーバーのイベントを発生順に取得"""
+        return [tuple(record) for record in await self._fetch("get_events", guild_id, since, until)]
+
+    # Retention
+    async def get_departed_guild_ids(self, before: datetime.datetime) -> list:
+        """beforeより前にBOTが退出したサーバーIDのリストを取得"""
+        return await self._fetchval("get_departed_guild_ids", before) or []
+
+    async def purge_guild(self, guild_id: int, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """退出したサーバーのデータを削除 (メンバー, 招待履歴, 招待数, イベント, サーバーの順)"""
+        for name in ("purge_guild_members", "purge_guild_invited", "purge_guild_invite_count", "purge_guild_events"):
+            res = await self._fetchrow(name, guild_id, limit, before)
+            if res["deleted_rows"]:
+                return res["deleted_rows"], res["deleted_bytes"]
+        res = await self._fetchrow("purge_guild", guild_id, before)
+        return res["deleted_rows"], res["deleted_bytes"]
+
+    async def purge_departed_members(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前に退出したメンバーのデータを削除"""
+        res = await self._fetchrow("purge_departed_members", before, limit)
+        return res["deleted_rows"], res["deleted_bytes"]
+
+    async def purge_events(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前のイベントを削除 (行ごとではなく、期間が全て過ぎたパーティションを1回に1つずつ削除するため、limitは使用しない)"""
+        res = await self._fetchrow("purge_events", before)
+        if res["deleted_rows"] or res["deleted_bytes"]:
+            self.event_partitions.clear()  # 削除した月のイベントが届いた場合に作り直すため
+        return res["deleted_rows"], res["deleted_bytes"]
+
+    # Migration
+    async def migrate_legacy_users(self) -> int:
+        """server.usersのJSONBデータをmember/invitedテーブルへ移行 (BOT稼働中に実行可能)"""
+        migrated = 0
+        for guild_id in await self._fetchval("get_legacy_guild_ids") or []:
+            await self.migrate_legacy_guild(guild_id)
+            migrated += 1
+        return migrated
+
+    async def migrate_legacy_guild(self, guild_id: int) -> None:
+        """1サーバー分のJSONBデータを移行"""
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                res = await self.statements.fetchrow(con, "lock_legacy_guild", guild_id)
+                if res is not None and not res["users_migrated"]:
+                    await self.statements.fetch(con, "migrate_legacy_members", guild_id)
+                    await self.statements.fetch(con, "migrate_legacy_invited", guild_id)
+                    await self.statements.fetch(con, "migrate_legacy_invite_count", guild_id)
+                    await self.statements.fetch(con, "finish_legacy_guild", guild_id)
+        self.legacy_guilds.discard(guild_id)
+
+    async def _migrate_if_legacy(self, guild_id: int) -> None:
+        """旧形式のデータを移行していないサーバーの場合は、読み込む前に移行 (バックグラウンドの移行が終わっていない・失敗した場合)"""
+        if guild_id in self.legacy_guilds:
+            await self.migrate_legacy_guild(guild_id)
@@ -0,0 +1,77 @@
+import dataclasses
+from typing import Dict, List, Optional, Tuple
+
+from invite_cache import InviteSnapshot
+
+# 判定結果の種類
+EXACT = "exact"  # 1つの招待の増加数と参加者数が一致
+ATTRIBUTED = "attributed"  # 1つの招待だけが増加 (増加数の方が多い場合や、使用上限回数に達した場合) か、増加した招待が全て同じ招待者のもの
+AMBIGUOUS = "ambiguous"  # 複数の招待が増加したか、増加数が参加者数より少ない
+UNKNOWN = "unknown"  # 増加した招待がない (バニティURLなど)
+
+
+@dataclasses.dataclass
+class Attribution:
+    status: str  # 判定結果の種類
+    inviter: Optional[int] = None  # 招待者ID (EXACT, ATTRIBUTEDの場合のみ)
+    code: Optional[str] = None  # 招待コード (EXACT, ATTRIBUTEDの場合のみ, 同じ招待者の複数の招待が増加した場合はNone)
+    candidates: List[Tuple[Optional[int], str]] = dataclasses.field(default_factory=list)  # 候補 [(招待者ID, 招待コード), ...]
+
+    @property
+    def resolved(self) -> bool:
+        return self.status in (EXACT, ATTRIBUTED)
+
+
+@dataclasses.dataclass
+class JoinBatch:
+    """同じ取得結果を共有する参加のまとまり"""
+    old: Optional[InviteSnapshot]  # 前の招待キャッシュ
+    new: Optional[InviteSnapshot]  # 後の招待キャッシュ
+    size: int  # 参加者数
+    attribution: Optional[Attribution] = None  # 判定結果 (最初の参加の処理で計算して共有)
+
+
+class AttributionEngine:
+    """招待ごとの使用回数の増加から、まとめて参加したメンバーの招待者を判定する (確定できない場合は推測しない)"""
+
+    def __init__(self):
+        # 参加者ごとの判定結果の数 {判定結果の種類: 数}
+        self.counts: Dict[str, int] = {EXACT: 0, ATTRIBUTED: 0, AMBIGUOUS: 0, UNKNOWN: 0}
+
+    def attribute(self, batch: JoinBatch) -> Attribution:
+        """参加者の招待者を判定 (同じまとまりの参加者は同じ結果になる)"""
+        if batch.attribution is None:
+            batch.attribution = self._attribute(batch)
+        self.counts[batch.attribution.status] += 1
+        return batch.attribution
+
+    def _attribute(self, batch: JoinBatch) -> Attribution:
+        if batch.old is None or batch.new is None:
+            return Attribution(UNKNOWN)
+        # 使用回数が増えた招待 (減った場合は作り直されたとみなして除外)
+        deltas = {code: delta for code, delta in batch.old.deltas(batch.new).items() if delta is None or delta > 0}
+        candidates = [(batch.old.get_author(code) or batch.new.get_author(code), code) for code in deltas]
+        if not deltas:
+            return Attribution(UNKNOWN)
+        if len(deltas) > 1:
+            inviters = {inviter for inviter, _ in candidates}
+            # 全て同じ招待者の招待で、参加者数以上に増加した場合は招待者のみ確定 (招待コードは不明)
+            if len(inviters) == 1 and None not in inviters and (None in deltas.values() or sum(deltas.values()) >= batch.size):
+                return Attribution(ATTRIBUTED, inviters.pop(), None, candidates)
+            return Attribution(AMBIGUOUS, candidates=candidates)
+        inviter, code = candidates[0]
+        delta = deltas[code]
+        if inviter is None:  # 作成者が不明な招待
+            return Attribution(UNKNOWN, candidates=candidates)
+        if delta is None or delta > batch.size:
+            # 使用上限回数に達した場合は増加数が不明, 増加数の方が多い場合はまとめられなかった参加が他にある
+            return Attribution(ATTRIBUTED, inviter, code, candidates)
+        if delta == batch.size:
+            return Attribution(EXACT, inviter, code, candidates)
+        # 一部の参加者は他の方法で参加したが、どの参加者かは分からない
+        return Attribution(AMBIGUOUS, candidates=candidates)
+
+    def get_stats(self) -> dict:
+        """判定結果の数と、招待者を特定できた割合を取得"""
+        total = sum(self.counts.values())
+        return dict(self.counts, total=total, accuracy=(self.counts[EXACT] + self.counts[ATTRIBUTED]) / total if total else 0.0)
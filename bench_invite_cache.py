@@ -0,0 +1,66 @@
+"""招待キャッシュ(辞書形式とInviteSnapshot)の使用メモリと、招待ごとの使用回数の増加の計算時間を比較 (python bench_invite_cache.py [招待数])"""
+import random
+import string
+import sys
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+
+from invite_cache import InviteSnapshot
+
+
+def make_invites(count: int) -> list:
+    """guild.invites()の結果の代わりになるダミーの招待を作成"""
+    random.seed(0)
+    return [SimpleNamespace(code="".join(random.choices(string.ascii_letters + string.digits, k=8)), uses=random.randrange(1000),
+                            inviter=SimpleNamespace(id=random.randrange(10 ** 17, 10 ** 18))) for _ in range(count)]
+
+
+def dict_cache(invites) -> dict:
+    """変更前の形式 {招待コード: {"uses": 使用回数, "author": 作成者ID}}"""
+    return {invite.code: {"uses": invite.uses, "author": invite.inviter.id} for invite in invites}
+
+
+def dict_deltas(old_invites: dict, new_invites: dict) -> dict:
+    """辞書形式での招待ごとの使用回数の増加の計算 (InviteSnapshot.deltasと同じ結果)"""
+    changed = {}
+    for code, invite in old_invites.items():
+        if (new_invite := new_invites.get(code)) is None:
+            changed[code] = None
+        elif new_invite["uses"] != invite["uses"]:
+            changed[code] = new_invite["uses"] - invite["uses"]
+    for code in new_invites.keys() - old_invites.keys():
+        if new_invites[code]["uses"] > 0:
+            changed[code] = new_invites[code]["uses"]
+    return changed
+
+
+def measure(build, invites) -> int:
+    """キャッシュの作成で確保されたメモリ[byte] (招待コードの文字列は共有されるため除く)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = build(invites)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del cache
+    return size
+
+
+def main(count: int) -> None:
+    invites = make_invites(count)
+    used = [SimpleNamespace(code=invite.code, uses=invite.uses, inviter=invite.inviter) for invite in invites]
+    used[-1].uses += 1  # 最後の招待が使われた場合 (全体を比較する最悪のケース)
+    removed = used[:count // 2] + used[count // 2 + 1:]  # 招待が使用上限回数に達して削除された場合
+    print(f"invites: {count}")
+    for name, build, deltas in (("dict", dict_cache, dict_deltas), ("snapshot", InviteSnapshot.from_invites, lambda old, new: old.deltas(new))):
+        old, new, new_removed = build(invites), build(used), build(removed)
+        assert len(deltas(old, new)) == 1 and len(deltas(old, new_removed)) == 2
+        size = measure(build, invites)
+        number = 200
+        deltas_time = timeit.timeit(lambda: deltas(old, new), number=number) / number
+        removed_time = timeit.timeit(lambda: deltas(old, new_removed), number=number) / number
+        print(f"{name:>8}: {size / count:6.1f} bytes/invite  deltas {deltas_time * 1000:7.3f}[ms]  deltas(removed) {removed_time * 1000:7.3f}[ms]")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
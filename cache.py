@@ -30,14 +30,11 @@ class Cache(commands.Cog):
             if not await self.bot.confirm(ctx):
                 return
             await normal_ember_builder(ctx, "It may takes several time if the server is large..")
-            for invite in await ctx.guild.invites():
-                await invite.delete()
+            await self.bot.delete_invites(ctx.guild, await self.bot.fetch_scheduler.fetch(ctx.guild))
             await success_embed_builder(ctx, "All server invites has deleted successfully!")
         else:  # 特定ユーザー分
             target_users = {user.id for user in ctx.message.mentions}
-            for invite in await ctx.guild.invites():
-                if invite.inviter.id in target_users:
-                    await invite.delete()
+            await self.bot.delete_invites(ctx.guild, [invite for invite in await self.bot.fetch_scheduler.fetch(ctx.guild) if invite.inviter.id in target_users])
             mentions_text = "<@" + "> <@".join(target_users) + ">"
             await success_embed_builder(ctx, f"All server invites created by {mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has deleted successfully!")
 
@@ -52,15 +49,13 @@ class Cache(commands.Cog):
             if not await self.bot.confirm(ctx):
                 return
             await normal_ember_builder(ctx, "It may takes several time if the server is large..")
-            for user in await self.bot.db.get_guild_users(ctx.guild.id):
-                await self.bot.db.reset_user_data(ctx.guild.id, int(user))
+            await self.bot.join_buffer.flush()  # 書き込み待ちの履歴がクリア後に残らないように先に書き込み
+            await self.bot.db.reset_users_data(ctx.guild.id)
             await success_embed_builder(ctx, "All cached data has deleted successfully!")
         else:  # 特定ユーザー分
-            target_users = []
-            for target_user in ctx.message.mentions:
-                target_users.append(str(target_user.id))
-                if str(target_user.id) in await self.bot.db.get_guild_users(ctx.guild.id):
-                    await self.bot.db.reset_user_data(ctx.guild.id, target_user.id)
+            target_users = [str(target_user.id) for target_user in ctx.message.mentions]
+            await self.bot.join_buffer.flush()
+            await self.bot.db.reset_users_data(ctx.guild.id, [target_user.id for target_user in ctx.message.mentions])
             mentions_text = "<@" + "> <@".join(target_users) + ">"
             await success_embed_builder(ctx, f"All cached data of {mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has deleted successfully!")
 
@@ -0,0 +1,61 @@
+import random
+from typing import Dict, Optional, Tuple
+
+import discord
+
+
+def can_send_log(channel: discord.TextChannel, me: discord.Member) -> bool:
+    """チャンネルにログ(埋め込み)を送信できるか確認"""
+    perms = channel.permissions_for(me)
+    return perms.send_messages and perms.embed_links and perms.read_messages
+
+
+class ChannelCache:
+    """
+    サーバーごとのログの送信先と権限の確認結果
+    チャンネル・役職・BOT自身の更新のイベントで、そのサーバーの確認結果を破棄する
+    """
+
+    def __init__(self):
+        # ログチャンネル {サーバーID: (チャンネルID, チャンネル(見つからない場合はNone), 送信できるか)}
+        self.log_channels: Dict[int, Tuple[int, Optional[discord.TextChannel], bool]] = {}
+        # ログチャンネルが使えない場合の送信先 {サーバーID: チャンネル(送信できるチャンネルがない場合はNone)}
+        self.fallback_channels: Dict[int, Optional[discord.TextChannel]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_log_channel(self, guild: discord.Guild, channel_id: int) -> Tuple[Optional[discord.TextChannel], bool]:
+        """ログチャンネルと、送信できるかを取得"""
+        if (entry := self.log_channels.get(guild.id)) is not None and entry[0] == channel_id:  # ログチャンネルが変更された場合は確認し直す
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        channel = guild.get_channel(channel_id)
+        sendable = channel is not None and can_send_log(channel, guild.me)
+        self.log_channels[guild.id] = (channel_id, channel, sendable)
+        return channel, sendable
+
+    def get_fallback_channel(self, guild: discord.Guild) -> Optional[discord.TextChannel]:
+        """ログチャンネル以外の送信先を取得 (システムチャンネルを優先し、それ以外はランダムに選ぶ)"""
+        if guild.id in self.fallback_channels:
+            self.hits += 1
+            return self.fallback_channels[guild.id]
+        self.misses += 1
+        channels = guild.text_channels
+        random.shuffle(channels)
+        if (sys_ch := guild.system_channel) is not None:
+            channels.insert(0, sys_ch)
+        channel = self.fallback_channels[guild.id] = next((channel for channel in channels if can_send_log(channel, guild.me)), None)
+        return channel
+
+    def invalidate(self, guild_id: int) -> None:
+        """サーバーの確認結果を破棄"""
+        if guild_id in self.log_channels or guild_id in self.fallback_channels:
+            self.invalidations += 1
+            self.log_channels.pop(guild_id, None)
+            self.fallback_channels.pop(guild_id, None)
+
+    def get_stats(self) -> dict:
+        """確認結果を使った回数と、破棄した回数を取得"""
+        return {"guilds": len(self.log_channels), "fallbacks": len(self.fallback_channels), "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
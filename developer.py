@@ -14,6 +14,7 @@ import traceback2
 from discord.ext import commands
 import time
 import psutil
+from SQLManager import SQLManager
 from main import InviteMonitor
 
 
@@ -74,12 +75,22 @@ class Developer(commands.Cog, command_attrs=dict(hidden=True)):
     @commands.command()
     async def restart(self, ctx):
         await ctx.send(":closed_lock_with_key:BOTを再起動します.")
+        await self.bot.join_buffer.close()  # 書き込み待ちの参加履歴を保存
+        await self.bot.event_writer.close()  # 書き込み待ちのイベント履歴を保存
+        await self.bot.save_invite_cache()  # 再起動後すぐに参加を判定できるように招待キャッシュを保存
+        await self.bot.digest.close()  # まとめたログを送信
+        await self.bot.log_batcher.close()  # 送信待ちのログを送信
         python = sys.executable
         os.execl(python, python, *sys.argv)
 
     @commands.command()
     async def quit(self, ctx):
         await ctx.send(":closed_lock_with_key:BOTを停止します.")
+        await self.bot.join_buffer.close()  # 書き込み待ちの参加履歴を保存
+        await self.bot.event_writer.close()  # 書き込み待ちのイベント履歴を保存
+        await self.bot.save_invite_cache()  # 招待キャッシュを保存
+        await self.bot.digest.close()  # まとめたログを送信
+        await self.bot.log_batcher.close()  # 送信待ちのログを送信
         sys.exit()
 
     @commands.command()
@@ -160,6 +171,40 @@ class Developer(commands.Cog, command_attrs=dict(hidden=True)):
         embed.add_field(name="Server", value=f"```yaml\nCPU: [{cpu_per}%]\nMemory: [{mem_per}%] {mem_used:.2f}GiB / {mem_total:.2f}GiB\nSwap: [{swap_per}%] {swap_used:.2f}GiB / {swap_total:.2f}GiB\nTemperature: {','.join(temp)}```", inline=False)
         embed.add_field(name="Discord", value=f"```yaml\nServers: {guilds}\nTextChannels: {text_channels}\nVoiceChannels: {voice_channels}\nUsers: {users}\nConnectedVC: {vcs}```", inline=False)
         embed.add_field(name="Run", value=f"```yaml\nUptime: {uptime}\nLatency: {latency:.2f}[s]\n```")
+        settings = self.bot.db.get_settings_stats()
+        invite_cache = self.bot.cache.get_stats()
+        coalesce = self.bot.join_coalescer.get_stats()
+        channels = self.bot.channel_cache.get_stats()
+        embed.add_field(name="Cache", value=f"```yaml\nSettings: {settings['guilds']}guilds (hit {settings['hits']} / miss {settings['misses']})\n"
+                                            f"Channels: {channels['guilds']}guilds (hit {channels['hits']} / miss {channels['misses']} / invalidate {channels['invalidations']})\n"
+                                            f"Invites: {invite_cache['invites']}invites in {invite_cache['hot']}guilds ({invite_cache['hot_memory'] / 1024:.1f}KiB)\n"
+                                            f"ColdInvites: {invite_cache['cold']}guilds ({invite_cache['cold_memory'] / 1024:.1f}KiB) / evict {invite_cache['evictions']}times / reload {invite_cache['reloads']}times\n"
+                                            f"InviteUpdates: fetch {self.bot.invite_fetches}times / patch {self.bot.invite_patches}times\n"
+                                            f"JoinCoalesce: {coalesce['joins']}joins / {coalesce['fetches']}fetches (max batch {coalesce['max_batch']})\n```", inline=False)
+        fetch = self.bot.fetch_scheduler.get_stats()
+        waits = "\n".join(f"Wait({name}): {wait['count']}times avg {wait['avg']:.2f}[s] / max {wait['max']:.2f}[s]" for name, wait in fetch["waits"].items())
+        embed.add_field(name="InviteFetch", value=f"```yaml\nQueue: {fetch['queued']}queued / {fetch['in_flight']}in flight (tokens {fetch['tokens']:.1f})\n"
+                                                  f"Fetched: {fetch['fetched']}times (merged {fetch['merged']} / errors {fetch['errors']})\n{waits}\n```", inline=False)
+        logs = self.bot.log_batcher.get_stats()
+        digest = self.bot.digest.get_stats()
+        embed.add_field(name="LogBatch", value=f"```yaml\nLogs: {logs['logs']} in {logs['messages']}messages (max batch {logs['max_batch']} / pending {logs['pending']} / shed {logs['shed']} / failed {logs['failed']})\n"
+                                               f"Digest: {digest['guilds']}guilds now / {digest['enabled']}times enabled ({digest['digested']}events in {digest['sent']}digests)\n```", inline=False)
+        outbound = self.bot.outbound.get_stats()
+        outbound_waits = "\n".join(f"Wait({name}): {wait['count']}times avg {wait['avg']:.2f}[s] / max {wait['max']:.2f}[s]" for name, wait in outbound["waits"].items())
+        busy_guilds = ", ".join(f"{guild_id}({depth})" for guild_id, depth in outbound["guilds"]) or "None"
+        embed.add_field(name="Outbound", value=f"```yaml\nQueue: {outbound['queued']}queued in {outbound['routes']}routes\nBusyGuilds: {busy_guilds}\n"
+                                               f"Executed: {outbound['executed']} (merged {outbound['merged']} / shed {outbound['shed']} / errors {outbound['errors']})\n{outbound_waits}\n```", inline=False)
+        reconcile = self.bot.reconciler.get_stats()
+        embed.add_field(name="Reconcile", value=f"```yaml\nChecks: {reconcile['checks']}times in {reconcile['guilds']}guilds (skipped {reconcile['skipped']})\n"
+                                                f"Drift: {reconcile['drifts']}times ({reconcile['drift_rate']:.1%})\n"
+                                                f"Interval: {reconcile['min_interval']:.0f}[s] - {reconcile['max_interval']:.0f}[s]\n```", inline=False)
+        attribution = self.bot.attribution.get_stats()
+        embed.add_field(name="Attribution", value=f"```yaml\nJoins: {attribution['total']} (accuracy {attribution['accuracy']:.1%})\n"
+                                                  f"Exact: {attribution['exact']} / Attributed: {attribution['attributed']} / Ambiguous: {attribution['ambiguous']} / Unknown: {attribution['unknown']}\n```", inline=False)
+        for name, value in self.bot.db.get_backend_stats().items():
+            embed.add_field(name=name, value=f"```yaml\n{value}\n```", inline=False)
+        if (report := self.bot.retention.last_report) is not None:
+            embed.add_field(name="Retention", value=f"```yaml\nLastRun: {self.bot.retention.last_run:%Y/%m/%d %H:%M:%S}\nDeleted: {self.bot.retention.total_rows}rows {self.bot.retention.total_bytes / 1024 / 1024:.2f}MiB\n```", inline=False)
         await ctx.send(embed=embed)
 
     @commands.command(aliases=["pg"])
@@ -183,10 +228,20 @@ class Developer(commands.Cog, command_attrs=dict(hidden=True)):
 
     @commands.command()
     async def db(self, ctx, *, text):
+        if not isinstance(self.bot.db, SQLManager):
+            return await ctx.send("PostgreSQL以外では使用できません.")
         res = await self.bot.db.con.fetch(text)
         res = [dict(i) for i in res]
         await ctx.send("```json\n"+pprint.pformat(res)[:1980]+"```")
 
+    @commands.command()
+    async def retention(self, ctx):
+        await ctx.send("保持期間を過ぎたデータを削除します.")
+        report = await self.bot.retention.run()
+        rows = sum(report[key][0] for key in ("guild_data", "members", "events"))
+        size = sum(report[key][1] for key in ("guild_data", "members", "events"))
+        await ctx.send(f"削除しました: サーバー`{report['guilds']}`件 メンバー`{report['members'][0]}`件 イベント`{report['events'][0]}`件 (合計`{rows}`行 削除した行のサイズ`{size / 1024:.1f}`KiB, `{report['time']:.2f}`[s])")
+
     async def run_subprocess(self, cmd, loop=None):
         loop = loop or asyncio.get_event_loop()
         try:
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import datetime
+import time
+import traceback
+from typing import Awaitable, Callable, Counter, Deque, Dict, List, Optional, Tuple
+
+import discord
+
+from attribution import AMBIGUOUS, UNKNOWN
+
+
+class GuildDigest:
+    """まとめて送信するまでのサーバーのイベントの集計"""
+
+    def __init__(self):
+        self.started = datetime.datetime.utcnow()  # 集計を開始した日時
+        self.joins = 0
+        self.leaves = 0
+        self.statuses: Counter[str] = collections.Counter()  # 参加者の招待者の判定結果 {判定結果の種類: 数}
+        self.codes: Counter[str] = collections.Counter()  # 招待コードごとの参加者数
+        self.inviters: Counter[int] = collections.Counter()  # 招待者ごとの参加者数
+        self.invites_created = 0
+        self.invites_deleted = 0
+        self.young: List[Tuple[int, str, int]] = []  # 作成されて間もないアカウント [(ユーザーID, ユーザー名, 作成後の日数), ...]
+        self.young_count = 0
+
+    @property
+    def events(self) -> int:
+        return self.joins + self.leaves + self.invites_created + self.invites_deleted
+
+
+class DigestManager:
+    """
+    参加・退出・招待のイベントが多いサーバーのログを、一定間隔で1つの集計にまとめて送信する
+    イベントの頻度が閾値を超えたサーバーは自動でまとめる状態になり、頻度が下がったら個別のログに戻る
+    """
+
+    def __init__(self, get_guild: Callable[[int], Optional[discord.Guild]], send: Callable[..., Awaitable[None]],
+                 threshold: int = 30, window: float = 60.0, interval: float = 60.0, young_days: int = 7, max_young: int = 20):
+        self.get_guild = get_guild
+        self.send = send  # ログの送信処理 (サーバー, embed=埋め込み)
+        self.threshold = threshold  # window秒間のイベント数がこれ以上のサーバーをまとめる (0の場合はまとめない)
+        self.window = window  # イベントの頻度を測る時間[秒]
+        self.interval = interval  # まとめたログを送信する間隔[秒]
+        self.young_days = young_days  # 作成後この日数以内のアカウントを一覧にする
+        self.max_young = max_young  # 一覧にする作成されて間もないアカウントの最大数
+        self.recent: Dict[int, Deque[float]] = {}  # 直近threshold件のイベントの時刻 {サーバーID: [time.monotonic(), ...]}
+        self.digests: Dict[int, GuildDigest] = {}  # まとめる状態のサーバーの集計 {サーバーID: 集計}
+        self._task: Optional[asyncio.Task] = None
+        self.enabled_count = 0  # まとめる状態になった回数
+        self.digested = 0  # まとめたイベントの数
+        self.sent = 0  # まとめたログを送信した数
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """定期送信を開始"""
+        if self.threshold > 0 and self._task is None:
+            self._task = loop.create_task(self._flush_loop())
+
+    def observe(self, guild_id: int) -> bool:
+        """イベントを記録し、まとめる状態かを確認 (まとめる場合はTrue)"""
+        if self.threshold <= 0:
+            return False
+        now = time.monotonic()
+        if (recent := self.recent.get(guild_id)) is None:
+            recent = self.recent[guild_id] = collections.deque(maxlen=self.threshold)
+        recent.append(now)
+        if guild_id not in self.digests and len(recent) == self.threshold and now - recent[0] <= self.window:
+            self.digests[guild_id] = GuildDigest()
+            self.enabled_count += 1
+            print(f"Digest mode enabled for {guild_id} ({self.threshold} events in {now - recent[0]:.1f}s)")
+        if guild_id in self.digests:
+            self.digested += 1
+            return True
+        return False
+
+    def add_join(self, member: discord.Member, status: str, res: Optional[Tuple[int, str]]) -> None:
+        """参加をまとめる"""
+        digest = self.digests[member.guild.id]
+        digest.joins += 1
+        digest.statuses[status] += 1
+        if res is not None:
+            digest.inviters[res[0]] += 1
+            if res[1] is not None:  # 招待者の複数の招待が同時に使われた場合は招待コードが不明
+                digest.codes[res[1]] += 1
+        if (age := (datetime.datetime.utcnow() - member.created_at).days) <= self.young_days:
+            digest.young_count += 1
+            if len(digest.young) < self.max_young:
+                digest.young.append((member.id, str(member), age))
+
+    def add_leave(self, member: discord.Member) -> None:
+        """退出をまとめる"""
+        self.digests[member.guild.id].leaves += 1
+
+    def add_invite(self, guild_id: int, created: bool) -> None:
+        """招待の作成・削除をまとめる"""
+        digest = self.digests[guild_id]
+        if created:
+            digest.invites_created += 1
+        else:
+            digest.invites_deleted += 1
+
+    def build_embed(self, digest: GuildDigest) -> discord.Embed:
+        """集計から送信する埋め込みを作成"""
+        embed = discord.Embed(title="Activity Digest", color=0xffd8a8, timestamp=datetime.datetime.utcnow())
+        embed.description = f"High traffic detected, so logs are summarized every {self.interval:.0f} seconds.\n\n"
+        embed.description += f"`Joined  :`  {digest.joins} (unknown {digest.statuses[UNKNOWN]} / ambiguous {digest.statuses[AMBIGUOUS]})\n"
+        embed.description += f"`Left    :`  {digest.leaves}\n"
+        embed.description += f"`Invites :`  {digest.invites_created} created / {digest.invites_deleted} deleted\n"
+        if digest.codes:
+            embed.add_field(name="Codes", value="\n".join(f"`{code}` : {count}" for code, count in digest.codes.most_common(10)))
+        if digest.inviters:
+            embed.add_field(name="Inviters", value="\n".join(f"<@{inviter}> : {count}" for inviter, count in digest.inviters.most_common(10)))
+        if digest.young_count:
+            young = "\n".join(f"<@{user_id}> {name} ({age}days)" for user_id, name, age in digest.young)
+            if digest.young_count > len(digest.young):
+                young += f"\n...and {digest.young_count - len(digest.young)} more"
+            embed.add_field(name=f"New accounts (within {self.young_days} days)", value=young[:1024], inline=False)
+        embed.set_footer(text=f"Since {digest.started:%Y/%m/%d %H:%M:%S} UTC")
+        return embed
+
+    async def flush(self) -> None:
+        """まとめたログを送信し、頻度が下がったサーバーは個別のログに戻す"""
+        now = time.monotonic()
+        for guild_id, digest in list(self.digests.items()):
+            # 直近window秒間のイベント数が閾値の半分を下回ったら戻す (送信中のイベントは次の集計に含める)
+            if sum(1 for at in self.recent.get(guild_id, ()) if now - at <= self.window) < self.threshold / 2:
+                del self.digests[guild_id]
+                self.recent.pop(guild_id, None)
+                print(f"Digest mode disabled for {guild_id}")
+            else:
+                self.digests[guild_id] = GuildDigest()
+            if digest.events and (guild := self.get_guild(guild_id)) is not None:
+                try:
+                    await self.send(guild, embed=self.build_embed(digest))
+                    self.sent += 1
+                except Exception:
+                    traceback.print_exc()
+        # イベントがなくなったサーバーの記録を削除
+        for guild_id in [guild_id for guild_id, recent in self.recent.items() if now - recent[-1] > self.window]:
+            del self.recent[guild_id]
+
+    async def close(self) -> None:
+        """まとめたログを全て送信"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def get_stats(self) -> dict:
+        """まとめる状態のサーバー数と、まとめたイベントの数を取得"""
+        return {"guilds": len(self.digests), "enabled": self.enabled_count, "digested": self.digested, "sent": self.sent}
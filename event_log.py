@@ -0,0 +1,47 @@
+import datetime
+from typing import List, Optional
+
+from join_buffer import WriteBehindBuffer
+from storage import Event, Storage
+
+# イベントの種類
+EVENT_JOIN = "join"  # メンバーの参加
+EVENT_JOIN_AMBIGUOUS = "join_ambiguous"  # 招待者を確定できなかった参加 (候補の招待ごとに1行)
+EVENT_LEAVE = "leave"  # メンバーの退出
+EVENT_INVITE_CREATE = "invite_create"  # 招待の作成
+EVENT_INVITE_DELETE = "invite_delete"  # 招待の削除・期限切れ
+EVENT_INVITE_DRIFT = "invite_drift"  # 取得し直した招待と招待キャッシュの差異 (差異があった招待ごとに1行)
+
+
+class EventWriter(WriteBehindBuffer):
+    """参加・退出・招待の作成/削除のイベントを溜めて、まとめて追記するバッファ"""
+
+    def __init__(self, db: Storage, max_size: int = 500, interval: float = 10.0, max_pending: int = 50000):
+        super().__init__(db, max_size, interval, max_pending)
+        self.pending: List[Event] = []  # 書き込み待ちのイベント (発生順)
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def record(self, guild_id: int, kind: str, user_id: Optional[int] = None, inviter: Optional[int] = None, code: Optional[str] = None) -> None:
+        """イベントを記録 (発生日時は記録した時刻)"""
+        event = (datetime.datetime.now(datetime.timezone.utc), guild_id, kind, user_id, inviter, code)
+        if not self.enabled:
+            return await self.db.record_events([event])
+        self.pending.append(event)
+        self._added()
+
+    def _take(self) -> List[Event]:
+        events, self.pending = self.pending, []
+        return events
+
+    async def _write(self, batch: List[Event]) -> None:
+        await self.db.record_events(batch)
+
+    def _restore(self, batch: List[Event]) -> None:
+        # 書き込みに失敗した場合は、発生順を保ったまま戻す (上限を超えた分は古いものから破棄)
+        room = max(self.max_pending - len(self.pending), 0)
+        if room < len(batch):
+            self.dropped += len(batch) - room
+            batch = batch[len(batch) - room:]
+        self.pending[:0] = batch
@@ -6,6 +6,8 @@ import pytz
 from discord.ext import commands
 
 import identifier
+from attribution import AMBIGUOUS
+from event_log import EVENT_INVITE_CREATE, EVENT_INVITE_DELETE, EVENT_JOIN, EVENT_JOIN_AMBIGUOUS, EVENT_LEAVE
 from identifier import error_embed_builder, warning_embed_builder, success_embed_builder
 from main import InviteMonitor
 
@@ -40,8 +42,11 @@ class Invite(commands.Cog):
         """招待が作成された際のイベント"""
         if await self.bot.db.get_log_channel_id(invite.guild.id):  # サーバーで有効化されている場合
             if invite.guild.me.guild_permissions.manage_guild and invite.guild.me.guild_permissions.manage_channels:  # 権限を確認
-                # 招待キャッシュを更新
-                await self.bot.update_server_cache(invite.guild)
+                # 招待キャッシュに追加 (全ての招待を取得し直さない)
+                await self.bot.add_invite_cache(invite)
+                await self.bot.event_writer.record(invite.guild.id, EVENT_INVITE_CREATE, inviter=invite.inviter.id, code=invite.code)
+                if self.bot.digest.observe(invite.guild.id):  # 招待のイベントが多いサーバーはまとめて送信
+                    return self.bot.digest.add_invite(invite.guild.id, True)
                 # ログを送信
                 embed = discord.Embed(color=0xa8ffa8)
                 embed.set_author(name="Invite Created", icon_url="https://cdn.discordapp.com/emojis/762303590365921280.png?v=1")
@@ -60,19 +65,21 @@ class Invite(commands.Cog):
         """招待が削除された際のイベント"""
         if await self.bot.db.get_log_channel_id(invite.guild.id):  # サーバーで有効化されている場合
             if invite.guild.me.guild_permissions.manage_guild and invite.guild.me.guild_permissions.manage_channels:  # 権限を確認
-                inviter = None
-                if invite.code in self.bot.cache[invite.guild.id]:  # 招待キャッシュから、招待作成者を取得
-                    inviter = self.bot.cache[invite.guild.id][invite.code]['author']
-                # 招待キャッシュを更新
-                await self.bot.update_server_cache(invite.guild)
-                # ログを送信
-                embed = discord.Embed(color=0xffbf7f)
-                embed.set_author(name="Invite Deleted", icon_url="https://cdn.discordapp.com/emojis/762303590529892432.png?v=1")
-                embed.description = f"Invite [{invite.code}]({invite.url}) by {'<@' + str(inviter) + '>' if inviter else 'Unknown'} has deleted or expired.\n\n"
-                embed.description += f"`Channel  :`  <#{invite.channel.id}>\n"
-                user = await self.catch_user(inviter)  # 招待者を取得
-                embed.description += f"`Inviter  :`  {user}\n"
-                await self.bot.log_send(invite.guild, embed=embed)
+                inviter = self.bot.cache[invite.guild.id].get_author(invite.code) if invite.guild.id in self.bot.cache else None  # 招待キャッシュから、招待作成者を取得
+                # 招待キャッシュから削除 (全ての招待を取得し直さない)
+                await self.bot.remove_invite_cache(invite)
+                await self.bot.event_writer.record(invite.guild.id, EVENT_INVITE_DELETE, inviter=inviter, code=invite.code)
+                if self.bot.digest.observe(invite.guild.id):  # 招待のイベントが多いサーバーはまとめて送信
+                    self.bot.digest.add_invite(invite.guild.id, False)
+                else:
+                    # ログを送信
+                    embed = discord.Embed(color=0xffbf7f)
+                    embed.set_author(name="Invite Deleted", icon_url="https://cdn.discordapp.com/emojis/762303590529892432.png?v=1")
+                    embed.description = f"Invite [{invite.code}]({invite.url}) by {'<@' + str(inviter) + '>' if inviter else 'Unknown'} has deleted or expired.\n\n"
+                    embed.description += f"`Channel  :`  <#{invite.channel.id}>\n"
+                    user = await self.catch_user(inviter)  # 招待者を取得
+                    embed.description += f"`Inviter  :`  {user}\n"
+                    await self.bot.log_send(invite.guild, embed=embed)
                 # Triggerに登録されたコードが削除されていないかどうか確認する
                 if invite.code in await self.bot.db.get_code_trigger_list(invite.guild.id):
                     # 通知文を送信
@@ -86,35 +93,52 @@ class Invite(commands.Cog):
         """メンバーが参加した際のイベント"""
         if await self.bot.db.get_log_channel_id(member.guild.id):  # サーバーで有効化されている場合
             if member.guild.me.guild_permissions.manage_guild and member.guild.me.guild_permissions.manage_channels:  # 権限を確認
-                old_invite_cache = self.bot.cache[member.guild.id]  # 前の招待キャッシュを取得
-                new_invite_cache = await self.bot.update_server_cache(member.guild)  # 後の招待キャッシュを取得
-                res = await self.check_invite_diff(old_invite_cache, new_invite_cache)  # 差異から招待者を特定
-                # ログを送信
-                embed = discord.Embed(color=0xa8d3ff)
-                embed.set_author(name="Member Joined", icon_url="https://cdn.discordapp.com/emojis/762305608271265852.png")
-                embed.set_thumbnail(url=member.avatar_url)
-                if res is not None:  # ユーザーが判別できた場合
-                    # 招待作成者の招待履歴に記録
-                    await self.bot.db.add_invited_to_inviter(member.guild.id, res[0], member.id)
-                    # 招待された人の招待作成者を記録
-                    await self.bot.db.add_inviter_to_invited(member.guild.id, res[0], member.id)
-                    await self.bot.db.add_code_to_invited(member.guild.id, res[1], member.id)
-                    inviter = await self.catch_user(res[0])  # 招待者を取得
-                    # ログを送信
-                    embed.description = f"<@{member.id}> has joined through [{res[1]}](https://discord.gg/{res[1]}) made by <@{inviter.id}>\n\n"
-                    embed.description += f"`User    :`  {member}\n"
-                    embed.description += f"`Code    :`  {res[1]}\n"
-                    embed.description += f"`Inviter :`  {inviter}\n"
+                # 前後の招待キャッシュを取得 (同時に参加したメンバーとは取得結果を共有)
+                batch = await self.bot.join_coalescer.refresh(member.guild)
+                attribution = self.bot.attribution.attribute(batch)  # 招待ごとの使用回数の増加から招待者を特定
+                res = (attribution.inviter, attribution.code) if attribution.resolved else None
+                if attribution.status == AMBIGUOUS:  # 確定できない場合は推測せずに候補を1つずつ記録
+                    for candidate_inviter, candidate_code in attribution.candidates:
+                        await self.bot.event_writer.record(member.guild.id, EVENT_JOIN_AMBIGUOUS, member.id, candidate_inviter, candidate_code)
                 else:
-                    embed.description = f"<@{member.id}> has joined\n\n"
-                    embed.description += f"`User    :`  {member}\n"
-                    embed.description += f"`Inviter :`  Unknown\n"
-                # 参加者のアカウント作成日時を経過した時間で表示
-                embed.timestamp, delta = self.get_delta_time(member.created_at, with_warn=True)
-                # ログを送信
-                embed.description += f"`Created :` {delta} ago"
-                embed.set_footer(text=f"{member.guild.name} | {len(member.guild.members)}members", icon_url=member.guild.icon_url)
-                await self.bot.log_send(member.guild, embed=embed)
+                    await self.bot.event_writer.record(member.guild.id, EVENT_JOIN, member.id, *(res or ()))
+                if res is not None:  # 招待作成者の招待履歴と、招待された人の招待作成者・招待コードを記録
+                    await self.bot.join_buffer.record_join(member.guild.id, res[0], member.id, res[1])
+                if self.bot.digest.observe(member.guild.id):  # 参加が多いサーバーはまとめて送信
+                    self.bot.digest.add_join(member, attribution.status, res)
+                else:
+                    # ログを送信
+                    embed = discord.Embed(color=0xa8d3ff)
+                    embed.set_author(name="Member Joined", icon_url="https://cdn.discordapp.com/emojis/762305608271265852.png")
+                    embed.set_thumbnail(url=member.avatar_url)
+                    if res is not None and res[1] is None:  # 招待者の複数の招待が同時に使われた場合
+                        inviter = await self.catch_user(res[0])  # 招待者を取得
+                        embed.description = f"<@{member.id}> has joined through an invite made by <@{inviter.id}>\n\n"
+                        embed.description += f"`User    :`  {member}\n"
+                        embed.description += f"`Codes   :`  {', '.join(code for _, code in attribution.candidates)[:500]}\n"
+                        embed.description += f"`Inviter :`  {inviter}\n"
+                    elif res is not None:  # ユーザーが判別できた場合
+                        inviter = await self.catch_user(res[0])  # 招待者を取得
+                        # ログを送信
+                        embed.description = f"<@{member.id}> has joined through [{res[1]}](https://discord.gg/{res[1]}) made by <@{inviter.id}>\n\n"
+                        embed.description += f"`User    :`  {member}\n"
+                        embed.description += f"`Code    :`  {res[1]}\n"
+                        embed.description += f"`Inviter :`  {inviter}\n"
+                    elif attribution.status == AMBIGUOUS:  # 複数の招待が同時に使われた場合
+                        embed.description = f"<@{member.id}> has joined\n\n"
+                        embed.description += f"`User    :`  {member}\n"
+                        embed.description += f"`Inviter :`  Ambiguous ({batch.size} members joined at once)\n"
+                        embed.description += f"`Codes   :`  {', '.join(code for _, code in attribution.candidates)[:500]}\n"
+                    else:
+                        embed.description = f"<@{member.id}> has joined\n\n"
+                        embed.description += f"`User    :`  {member}\n"
+                        embed.description += f"`Inviter :`  Unknown\n"
+                    # 参加者のアカウント作成日時を経過した時間で表示
+                    embed.timestamp, delta = self.get_delta_time(member.created_at, with_warn=True)
+                    # ログを送信
+                    embed.description += f"`Created :` {delta} ago"
+                    embed.set_footer(text=f"{member.guild.name} | {len(member.guild.members)}members", icon_url=member.guild.icon_url)
+                    await self.bot.log_send(member.guild, embed=embed)
                 # UserTriggerを確認
                 if res is None:  # 招待を認識できなかった場合
                     return
@@ -131,7 +155,7 @@ class Invite(commands.Cog):
                             await self.bot.db.remove_user_trigger(member.guild.id, res[0])
                         else:
                             try:
-                                await member.add_roles(*target_role)  # リスト内のロールオブジェクトをそれぞれ指定
+                                await self.bot.add_roles(member, target_role)  # リスト内のロールオブジェクトをそれぞれ指定
                             except:  # 役職の付与に失敗した場合
                                 error_msg += f":x: Failed to add role `{','.join([role.name for role in target_role])}` of user trigger **{res[0]}**\nPlease check position of role! These may be higher role than I have.\n"
                         if error_msg != "":  # エラーが発生した場合
@@ -148,7 +172,7 @@ class Invite(commands.Cog):
                             await self.bot.db.remove_code_trigger(member.guild.id, res[1])
                         else:
                             try:
-                                await member.add_roles(*target_role)  # リストのロールオブジェクトをそれぞれ指定
+                                await self.bot.add_roles(member, target_role)  # リストのロールオブジェクトをそれぞれ指定
                             except:  # 役職の付与に失敗した場合
                                 error_msg += f":x: Failed to add role `{','.join([role.name for role in target_role])}` of code trigger **{res[1]}**\nPlease check position of role! These may be higher role than I have.\n"
                         if error_msg != "":  # エラーが発生した場合
@@ -163,20 +187,29 @@ class Invite(commands.Cog):
             return  # 自分自身がサーバーを退出した時
         if await self.bot.db.get_log_channel_id(member.guild.id):  # サーバーで有効化されている場合
             if member.guild.me.guild_permissions.manage_guild and member.guild.me.guild_permissions.manage_channels:  # 権限を確認
+                # 書き込み待ちの参加履歴は、退出日時より先に書き込んでから使用
+                if (pending := await self.bot.join_buffer.take(member.guild.id, member.id)) is not None:
+                    invite_from, invite_code = pending
+                else:
+                    invite_from = await self.bot.db.get_user_invite_from(member.guild.id, member.id)
+                    invite_code = None
+                if invite_from and invite_code is None:
+                    invite_code = await self.bot.db.get_user_invite_code(member.guild.id, member.id)
+                await self.bot.event_writer.record(member.guild.id, EVENT_LEAVE, member.id, invite_from, invite_code)
+                await self.bot.db.mark_member_left(member.guild.id, member.id)
+                if self.bot.digest.observe(member.guild.id):  # 退出が多いサーバーはまとめて送信
+                    return self.bot.digest.add_leave(member)
                 # ログを送信
                 embed = discord.Embed(color=0xffa8a8)
                 embed.set_author(name="Member Left", icon_url="https://cdn.discordapp.com/emojis/762305607625605140.png")
                 embed.set_thumbnail(url=member.avatar_url)
                 # メンバーがデータベース上に存在しないか、招待元がNoneの場合
-                invite_from = await self.bot.db.get_user_invite_from(member.guild.id, member.id)
-                if not await self.bot.db.is_registered_user(member.guild.id, member.id) or not invite_from:
+                if not invite_from:
                     embed.description = f"<@{member.id}> has left\n\n"
                     embed.description += f"`User    :`  {member}\n"
                     embed.description += f"`Inviter :`  Unknown\n"
                 else:  # 招待者データがある場合
-                    inviter_id = invite_from
-                    invite_code = await self.bot.db.get_user_invite_code(member.guild.id, member.id)
-                    inviter = await self.catch_user(inviter_id)
+                    inviter = await self.catch_user(invite_from)
                     embed.description = f"<@{member.id}> invited by {'<@' + str(inviter.id) + '>' if inviter != 'Unknown' else 'Unknown'} has left\n\n"
                     embed.description += f"`User    :`  {member}\n"
                     embed.description += f"`Code    :`  {invite_code}\n"
@@ -189,23 +222,6 @@ class Invite(commands.Cog):
             else:  # 権限不足エラー
                 await self.bot.perm_lack_reporter(member.guild, ["manage_guild", "manage_channels"])
 
-    @commands.Cog.listener()
-    async def check_invite_diff(self, old_invites, new_invites):
-        """
-        招待キャッシュの差異から、招待者を取得
-        :param old_invites: 前の招待キャッシュ
-        :param new_invites: 後の招待キャッシュ
-        :return: [招待者ID:int, 招待コード: str]
-        """
-        for invite in old_invites:
-            if invite in new_invites:
-                if old_invites[invite]["uses"] != new_invites[invite]["uses"]:  # 使用回数が変わっている場合
-                    return [old_invites[invite]["author"], invite]
-            else:
-                return [old_invites[invite]["author"], invite]  # 招待コードがなくなっている場合→使用上限回数に達した場合
-        else:
-            return None  # 何らかの問題で,変更点が見つからなかった場合
-
     @commands.command(aliases=["inv"], usage="invite (@bot)", brief="Get bot's invite link", description="Show invite link of the bot. If some bot mentioned, send invite link of those.")
     @commands.cooldown(1, 3, commands.BucketType.guild)
     async def invite(self, ctx):
@@ -246,7 +262,7 @@ class Invite(commands.Cog):
             if count == 1:
                 ex_invite: str
                 if ctx.guild.id in self.bot.cache and self.bot.cache[ctx.guild.id]:
-                    ex_invite = list(self.bot.cache[ctx.guild.id].keys())[0]
+                    ex_invite = self.bot.cache[ctx.guild.id].codes[0]
                 else:
                     ex_invite = "RbzSSrw"
                 embed.description += f"\n\n**No triggers here! To get started:**\n{self.bot.PREFIX}code_trigger add [code] [roles]\n**For example:**\n{self.bot.PREFIX}code_trigger add {ex_invite} {ctx.guild.roles[-1].mention if ctx.guild.roles else '@new_role'}\n\n{self.bot.PREFIX}help code_trigger to learn more."
@@ -0,0 +1,339 @@
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# 招待キャッシュの保存形式 (数値はリトルエンディアン)
+# ヘッダー: 識別子, バージョン, 保存日時(UNIX時間), サーバー数
+# サーバーごと: サーバーID, 招待数, 招待コードのバイト数 + 招待コード(改行区切り) + 使用回数(int32) + 作成者ID(int64)
+SNAPSHOT_MAGIC = b"IMIC"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHdI")
+SNAPSHOT_GUILD = struct.Struct("<qII")
+
+
+def first_mismatch(a: array, b: array) -> int:
+    """同じ長さで内容が異なる配列の、最初に値が異なる位置を取得 (スライス同士の比較で二分探索)"""
+    lo, hi = 0, len(a)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def common_prefix(a: list, b: list) -> int:
+    """2つのリストの先頭から一致している要素数を取得 (スライス同士の比較で二分探索)"""
+    lo, hi = 0, min(len(a), len(b))
+    if a[:hi] == b[:hi]:
+        return hi
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class InviteSnapshot:
+    """サーバーの招待キャッシュ (招待コード・使用回数・作成者を並列の配列で保持)"""
+
+    __slots__ = ("codes", "uses", "authors", "index")
+
+    def __init__(self, codes: List[str], uses: array, authors: array):
+        self.codes = codes  # 招待コード (同じ文字列を共有するためintern済み)
+        self.uses = uses  # 使用回数 array('i')
+        self.authors = authors  # 作成者ID (不明な場合は0) array('q')
+        self.index: Dict[str, int] = {code: i for i, code in enumerate(codes)}  # {招待コード: 位置}
+
+    @classmethod
+    def from_invites(cls, invites: Iterable) -> "InviteSnapshot":
+        """guild.invites()の結果(discord.Inviteのリスト)から作成"""
+        codes, uses, authors = [], array("i"), array("q")
+        for invite in invites:
+            codes.append(sys.intern(invite.code))
+            uses.append(invite.uses)
+            authors.append(invite.inviter.id if invite.inviter is not None else 0)  # バニティURLなどは作成者なし
+        return cls(codes, uses, authors)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.codes)
+
+    def get_uses(self, code: str) -> Optional[int]:
+        """招待コードの使用回数を取得"""
+        if (i := self.index.get(code)) is None:
+            return None
+        return self.uses[i]
+
+    def get_author(self, code: str) -> Optional[int]:
+        """招待コードの作成者IDを取得"""
+        if (i := self.index.get(code)) is None:
+            return None
+        return self.authors[i] or None
+
+    def add(self, code: str, uses: int, author: Optional[int]) -> None:
+        """招待を追加 (既にある場合は更新)"""
+        if (i := self.index.get(code)) is not None:
+            self.uses[i] = uses
+            self.authors[i] = author or 0
+            return
+        self.index[code] = len(self.codes)
+        self.codes.append(sys.intern(code))
+        self.uses.append(uses)
+        self.authors.append(author or 0)
+
+    def remove(self, code: str) -> bool:
+        """招待を削除 (末尾の招待を空いた位置に移動する) 削除した場合はTrue"""
+        if (i := self.index.pop(code, None)) is None:
+            return False
+        last = len(self.codes) - 1
+        if i != last:
+            self.codes[i], self.uses[i], self.authors[i] = self.codes[last], self.uses[last], self.authors[last]
+            self.index[self.codes[i]] = i
+        self.codes.pop()
+        self.uses.pop()
+        self.authors.pop()
+        return True
+
+    def deltas(self, new: "InviteSnapshot") -> Dict[str, Optional[int]]:
+        """
+        招待キャッシュの差異から、招待ごとの使用回数の増加を取得
+        :param new: 後の招待キャッシュ
+        :return: {招待コード: 増加した回数} なくなった招待(使用上限回数に達した場合)はNone
+        """
+        changed: Dict[str, Optional[int]] = {}
+        if self.codes == new.codes:  # 招待の並びが同じ場合は配列同士を比較 (ほとんどの場合はこちら)
+            self._compare_uses(new, changed, 0, 0, len(self.codes))
+            return changed
+        # 招待が追加・削除された場合も、並びが同じ先頭と末尾は配列同士で比較し、異なる中間だけを招待コードで照合する
+        head = common_prefix(self.codes, new.codes)
+        tail = common_prefix(self.codes[head:][::-1], new.codes[head:][::-1])
+        old_end, new_end = len(self.codes) - tail, len(new.codes) - tail
+        self._compare_uses(new, changed, 0, 0, head)
+        new_uses = dict(zip(new.codes[head:new_end], new.uses[head:new_end]))
+        for code, uses in zip(self.codes[head:old_end], self.uses[head:old_end]):
+            if (new_count := new_uses.pop(code, None)) is None:
+                changed[code] = None
+            elif new_count != uses:
+                changed[code] = new_count - uses
+        self._compare_uses(new, changed, old_end, new_end, len(self.codes))
+        for code, uses in new_uses.items():  # 前の取得以降に作成されて使われた招待
+            if uses > 0:
+                changed[code] = uses
+        return changed
+
+    def _compare_uses(self, new: "InviteSnapshot", changed: Dict[str, Optional[int]], start: int, new_start: int, end: int) -> None:
+        """並びが同じ範囲(前のstart〜end, 後のnew_start〜)の使用回数を比較して、異なる招待をchangedに追加"""
+        old_uses, new_uses = self.uses[start:end], new.uses[new_start:new_start + end - start]
+        i = 0
+        # 異なる部分がなくなるまで、最初に値が異なる位置を探す
+        while old_uses[i:] != new_uses[i:]:
+            i += first_mismatch(old_uses[i:], new_uses[i:])
+            changed[self.codes[start + i]] = new_uses[i] - old_uses[i]
+            i += 1
+
+    def memory_usage(self) -> int:
+        """キャッシュの使用メモリ[byte] (共有している招待コードの文字列は除く)"""
+        return sys.getsizeof(self.codes) + sys.getsizeof(self.uses) + sys.getsizeof(self.authors) + sys.getsizeof(self.index)
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def pack_snapshot(guild_id: int, snapshot: InviteSnapshot) -> bytes:
+    """サーバーの招待キャッシュを保存形式に変換"""
+    codes = "\n".join(snapshot.codes).encode()
+    return b"".join([SNAPSHOT_GUILD.pack(guild_id, len(snapshot), len(codes)), codes, _little_endian(snapshot.uses), _little_endian(snapshot.authors)])
+
+
+def unpack_snapshot(data: bytes, offset: int = 0) -> Tuple[int, InviteSnapshot, int]:
+    """保存形式からサーバーの招待キャッシュを復元 (サーバーID, 招待キャッシュ, 次の位置)"""
+    guild_id, count, codes_size = SNAPSHOT_GUILD.unpack_from(data, offset)
+    offset += SNAPSHOT_GUILD.size
+    codes = [sys.intern(code) for code in data[offset:offset + codes_size].decode().split("\n")] if count else []
+    offset += codes_size
+    uses = _from_little_endian("i", data[offset:offset + count * 4])
+    offset += count * 4
+    authors = _from_little_endian("q", data[offset:offset + count * 8])
+    offset += count * 8
+    if not (len(codes) == len(uses) == len(authors) == count):
+        raise struct.error("invite snapshot is truncated")
+    return guild_id, InviteSnapshot(codes, uses, authors), offset
+
+
+class InviteCache:
+    """
+    全サーバーの招待キャッシュ (最近使われた順に保持)
+    しばらく使われていないサーバーや、使用メモリが上限を超えた場合は古い順に圧縮した状態(cold)に移し、次に使われた際に復元する
+    """
+
+    def __init__(self, budget: int = 0, idle: float = 0.0):
+        # 展開済みの招待キャッシュの使用メモリの上限[byte] (0の場合は上限なし)
+        # 圧縮済みの分は含めない (含めると圧縮済みだけで上限を超えた場合に、使われているサーバーまで毎回圧縮してしまう)
+        self.budget = budget
+        self.idle = idle  # これより長く使われていないサーバーは圧縮する[秒] (0の場合は圧縮しない)
+        self.hot: "OrderedDict[int, InviteSnapshot]" = OrderedDict()  # 展開済みの招待キャッシュ (最近使われた順)
+        self.cold: Dict[int, bytes] = {}  # 圧縮した招待キャッシュ {サーバーID: zlibで圧縮した保存形式}
+        self.accessed: Dict[int, float] = {}  # 最後に使われた時刻 {サーバーID: time.monotonic()}
+        self.hot_memory = 0  # 前回の確認時の展開済みの招待キャッシュの使用メモリ[byte]
+        self.evictions = 0  # 圧縮した回数
+        self.reloads = 0  # 復元した回数
+
+    def __len__(self) -> int:
+        return len(self.hot) + len(self.cold)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self.hot or guild_id in self.cold
+
+    def __getitem__(self, guild_id: int) -> InviteSnapshot:
+        if (snapshot := self.get(guild_id)) is None:
+            raise KeyError(guild_id)
+        return snapshot
+
+    def __setitem__(self, guild_id: int, snapshot: InviteSnapshot) -> None:
+        self.cold.pop(guild_id, None)
+        self.hot[guild_id] = snapshot
+        self.hot.move_to_end(guild_id)
+        self.accessed[guild_id] = time.monotonic()
+
+    def __delitem__(self, guild_id: int) -> None:
+        if self.pop(guild_id) is None:
+            raise KeyError(guild_id)
+
+    def get(self, guild_id: int) -> Optional[InviteSnapshot]:
+        """招待キャッシュを取得 (圧縮されている場合は復元する)"""
+        if (snapshot := self.hot.get(guild_id)) is not None:
+            self.hot.move_to_end(guild_id)
+            self.accessed[guild_id] = time.monotonic()
+            return snapshot
+        if (data := self.cold.get(guild_id)) is None:
+            return None
+        snapshot = unpack_snapshot(zlib.decompress(data))[1]
+        self.reloads += 1
+        self[guild_id] = snapshot
+        return snapshot
+
+    def peek(self, guild_id: int) -> Optional[InviteSnapshot]:
+        """招待キャッシュを取得 (使われた扱いにせず、圧縮されている場合も展開した状態で保持しない)"""
+        if (snapshot := self.hot.get(guild_id)) is not None:
+            return snapshot
+        if (data := self.cold.get(guild_id)) is None:
+            return None
+        return unpack_snapshot(zlib.decompress(data))[1]
+
+    def replace(self, guild_id: int, snapshot: InviteSnapshot) -> None:
+        """招待キャッシュを置き換え (使われた扱いにせず、圧縮されている場合は圧縮したまま)"""
+        if guild_id in self.cold:
+            self.cold[guild_id] = zlib.compress(pack_snapshot(guild_id, snapshot), 1)
+        elif guild_id in self.hot:
+            self.hot[guild_id] = snapshot
+        else:
+            self[guild_id] = snapshot
+
+    def pop(self, guild_id: int) -> Optional[InviteSnapshot]:
+        """招待キャッシュを削除"""
+        self.accessed.pop(guild_id, None)
+        if (data := self.cold.pop(guild_id, None)) is not None:
+            return unpack_snapshot(zlib.decompress(data))[1]
+        return self.hot.pop(guild_id, None)
+
+    def update(self, snapshots: Dict[int, InviteSnapshot]) -> None:
+        for guild_id, snapshot in snapshots.items():
+            self[guild_id] = snapshot
+
+    def keys(self) -> Set[int]:
+        return self.hot.keys() | self.cold.keys()
+
+    def packed(self) -> Iterator[bytes]:
+        """全サーバーの招待キャッシュを保存形式で取得 (圧縮されているサーバーは展開しない)"""
+        for guild_id, snapshot in self.hot.items():
+            yield pack_snapshot(guild_id, snapshot)
+        for data in self.cold.values():
+            yield zlib.decompress(data)
+
+    def evict(self) -> int:
+        """使われていない順に、しばらく使われていないサーバーと展開済みの使用メモリの上限を超えた分を圧縮 圧縮したサーバー数を返す"""
+        now = time.monotonic()
+        self.hot_memory = sum(snapshot.memory_usage() for snapshot in self.hot.values())
+        evicted = 0
+        while self.hot:
+            guild_id = next(iter(self.hot))
+            idle = self.idle > 0 and now - self.accessed.get(guild_id, 0.0) >= self.idle
+            over = self.budget > 0 and self.hot_memory > self.budget
+            if not (idle or over):
+                break
+            snapshot = self.hot.pop(guild_id)
+            self.cold[guild_id] = zlib.compress(pack_snapshot(guild_id, snapshot), 1)
+            self.hot_memory -= snapshot.memory_usage()
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def get_stats(self) -> dict:
+        """展開済み・圧縮済みのサーバー数と使用メモリ、圧縮・復元の回数を取得"""
+        return {
+            "hot": len(self.hot),
+            "cold": len(self.cold),
+            "invites": sum(len(snapshot) for snapshot in self.hot.values()),
+            "hot_memory": sum(snapshot.memory_usage() for snapshot in self.hot.values()),
+            "cold_memory": sum(len(data) for data in self.cold.values()),
+            "budget": self.budget,
+            "evictions": self.evictions,
+            "reloads": self.reloads,
+        }
+
+
+def dump_snapshots(cache: InviteCache) -> bytes:
+    """全サーバーの招待キャッシュを保存形式に変換"""
+    return b"".join([SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time(), len(cache)), *cache.packed()])
+
+
+def write_snapshots(path: str, data: bytes) -> None:
+    """保存形式のデータをファイルに書き込み (書き込み途中のファイルを読み込まないように置き換える)"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def load_snapshots(path: str, max_age: float) -> Dict[int, InviteSnapshot]:
+    """ファイルから全サーバーの招待キャッシュを読み込み (ファイルがない・古い・壊れている場合は空)"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, saved_at, guilds = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or time.time() - saved_at > max_age:
+            return {}
+        cache = {}
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(guilds):
+            guild_id, snapshot, offset = unpack_snapshot(data, offset)
+            cache[guild_id] = snapshot
+        return cache
+    except (OSError, struct.error, UnicodeDecodeError):
+        return {}
@@ -0,0 +1,168 @@
+import abc
+import asyncio
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+from storage import Storage
+
+# 参加履歴 (サーバーID, 招待者ID, 参加者ID, 招待コード)
+JoinRecord = Tuple[int, int, int, str]
+
+
+class WriteBehindBuffer(abc.ABC):
+    """
+    書き込みを溜めて、件数が上限に達した時と一定間隔ごとにまとめてデータベースに反映するバッファの共通処理
+    継承先で__len__, _take, _write, _restoreを実装する
+    """
+
+    def __init__(self, db: Storage, max_size: int, interval: float, max_pending: int):
+        self.db = db
+        self.max_size = max_size  # この件数に達したら書き込み (0の場合はバッファを使わない)
+        self.interval = interval  # 書き込み間隔[秒]
+        self.max_pending = max_pending  # 書き込みに失敗した際に戻す上限 (データベースの停止中に増え続けないように、超えた分は破棄)
+        self.written = 0  # 書き込んだ件数
+        self.write_count = 0  # 書き込んだ回数
+        self.dropped = 0  # 書き込みに失敗して破棄した件数
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()  # 件数が上限に達した際に定期書き込みを待たずに書き込む
+        self._stop = asyncio.Event()  # 定期書き込みを終了する (書き込み中の場合は書き終わってから)
+        self._task: Optional[asyncio.Task] = None
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        """書き込み待ちの件数"""
+
+    @abc.abstractmethod
+    def _take(self) -> list:
+        """書き込み待ちを全て取り出す"""
+
+    @abc.abstractmethod
+    async def _write(self, batch: list) -> None:
+        """取り出した分をデータベースに書き込み"""
+
+    @abc.abstractmethod
+    def _restore(self, batch: list) -> None:
+        """書き込みに失敗した分をmax_pendingまで書き込み待ちに戻す (戻せなかった分はdroppedに加算)"""
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """定期書き込みを開始"""
+        if self.enabled and self._task is None:
+            self._task = loop.create_task(self._flush_loop())
+
+    def _added(self) -> None:
+        """書き込み待ちに追加した後に呼び出す"""
+        if len(self) >= self.max_size:
+            self._wake.set()
+
+    async def flush(self) -> None:
+        """書き込み待ちをまとめて書き込み"""
+        async with self._lock:
+            if not len(self):
+                return
+            batch = self._take()
+            try:
+                await self._write(batch)
+            except BaseException:  # キャンセルされた場合も、取り出した分が失われないように戻す
+                self._restore(batch)
+                raise
+            self.written += len(batch)
+            self.write_count += 1
+
+    async def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stop.is_set():  # 残りはclose()で書き込む
+                break
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+                # 失敗した場合は、件数が上限に達していても間隔を空ける
+                try:
+                    await asyncio.wait_for(self._stop.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def close(self) -> None:
+        """定期書き込みを停止して、残りを書き込み"""
+        if self._task is not None:
+            # 書き込みの途中でキャンセルすると取り出した分が失われるため、終了を伝えて書き終わるのを待つ
+            self._stop.set()
+            self._wake.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._stop.clear()
+        await self.flush()
+
+
+class JoinBuffer(WriteBehindBuffer):
+    """参加履歴の書き込みを溜めて、まとめてデータベースに反映するバッファ"""
+
+    def __init__(self, db: Storage, max_size: int = 100, interval: float = 5.0, max_pending: int = 10000):
+        super().__init__(db, max_size, interval, max_pending)
+        # 書き込み待ちの参加履歴 {サーバーID: {参加者ID: (招待者ID, 招待コード)}}
+        self.pending: Dict[int, Dict[int, Tuple[int, str]]] = {}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    async def record_join(self, guild_id: int, inviter: int, invited: int, code: str) -> None:
+        """参加履歴を記録 (バッファが無効の場合は直接書き込み)"""
+        if not self.enabled:
+            return await self.db.record_join(guild_id, inviter, invited, code)
+        guild = self.pending.setdefault(guild_id, {})
+        if invited not in guild:
+            self.size += 1
+        guild[invited] = (inviter, code)  # 同じユーザーの記録は最新のものに統合
+        self._added()
+
+    async def take(self, guild_id: int, user_id: int) -> Optional[Tuple[int, str]]:
+        """
+        書き込み待ちの参加履歴を取り出して、すぐに書き込む (招待者ID, 招待コード)
+        退出の記録より後にまとめて書き込まれると退出日時が消えるため、退出時はこれを先に呼び出す
+        """
+        async with self._lock:  # 書き込み中の参加履歴がある場合は、その書き込みを待つ
+            if (guild := self.pending.get(guild_id)) is None or (record := guild.pop(user_id, None)) is None:
+                return None
+            self.size -= 1
+            if not guild:
+                del self.pending[guild_id]
+            try:
+                await self.db.record_join(guild_id, record[0], user_id, record[1])
+            except Exception:
+                self._restore([(guild_id, record[0], user_id, record[1])])
+                raise
+            self.written += 1
+            self.write_count += 1
+            return record
+
+    def _take(self) -> List[JoinRecord]:
+        pending, self.pending, self.size = self.pending, {}, 0
+        # 同時に書き込む他のトランザクションとデッドロックしないように順番を揃える
+        return sorted((guild_id, inviter, invited, code) for guild_id, users in pending.items() for invited, (inviter, code) in users.items())
+
+    async def _write(self, batch: List[JoinRecord]) -> None:
+        await self.db.record_joins(batch)
+
+    def _restore(self, batch: List[JoinRecord]) -> None:
+        # 書き込みに失敗した場合は、その間に追加された記録を優先して戻す
+        for guild_id, inviter, invited, code in batch:
+            guild = self.pending.setdefault(guild_id, {})
+            if invited in guild:
+                continue
+            if self.size >= self.max_pending:
+                self.dropped += 1
+            else:
+                guild[invited] = (inviter, code)
+                self.size += 1
+            if not guild:
+                del self.pending[guild_id]
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import discord
+
+from attribution import JoinBatch
+from invite_cache import InviteCache, InviteSnapshot
+
+
+class JoinCoalescer:
+    """
+    同じサーバーの招待の取得中に参加したメンバーの招待の取得を1回にまとめる
+    取得中でなければすぐに取得し、取得中の参加はその取得が終わった後にまとめて取得する
+    """
+
+    def __init__(self, cache: InviteCache, fetch: Callable[[discord.Guild], Awaitable[Optional[InviteSnapshot]]]):
+        self.cache = cache  # 招待キャッシュ {サーバーID: 招待キャッシュ}
+        self.fetch = fetch  # 招待を全て取得する処理 (招待キャッシュは更新しない)
+        self.pending: Dict[int, asyncio.Future] = {}  # 次の取得を待つ参加 {サーバーID: 取得結果}
+        self.running: Set[int] = set()  # 招待を取得中のサーバー
+        self.locks: Dict[int, asyncio.Lock] = {}  # 招待キャッシュを変更する際のロック {サーバーID: ロック}
+        self.last_join: Dict[int, float] = {}  # 最後に参加があった時刻 {サーバーID: time.monotonic()}
+        self.joins = 0  # 参加の数
+        self.fetches = 0  # 招待を取得した回数
+        self.max_batch = 0  # 1回の取得でまとめた最大の参加数
+        self._batch_sizes: Dict[int, int] = {}
+
+    def lock(self, guild_id: int) -> asyncio.Lock:
+        """サーバーの招待キャッシュを変更する際のロックを取得 (取得を待つ間は保持しない)"""
+        if (lock := self.locks.get(guild_id)) is None:
+            lock = self.locks[guild_id] = asyncio.Lock()
+        return lock
+
+    async def refresh(self, guild: discord.Guild) -> JoinBatch:
+        """参加時の招待キャッシュの更新 (同じ取得を待つ参加は同じ取得結果を共有する)"""
+        self.joins += 1
+        self.last_join[guild.id] = time.monotonic()
+        if (future := self.pending.get(guild.id)) is None:
+            future = self.pending[guild.id] = asyncio.get_event_loop().create_future()
+            self._batch_sizes[guild.id] = 0
+            if guild.id not in self.running:  # 取得中の場合は、その取得が終わった後に続けて取得する
+                asyncio.ensure_future(self._run(guild))
+        self._batch_sizes[guild.id] += 1
+        return await asyncio.shield(future)  # 1つの参加の処理がキャンセルされても、取得は続ける
+
+    def busy(self, guild_id: int) -> bool:
+        """参加時の招待の取得中か"""
+        return guild_id in self.running
+
+    async def _run(self, guild: discord.Guild) -> None:
+        self.running.add(guild.id)
+        try:
+            while (future := self.pending.pop(guild.id, None)) is not None:
+                # 以降の参加は次の取得にまとめる
+                size = self._batch_sizes.pop(guild.id)
+                self.max_batch = max(self.max_batch, size)
+                try:
+                    new = await self.fetch(guild)
+                except Exception as e:
+                    future.set_exception(e)
+                    future.exception()  # 待っている処理がない場合に警告を出さない
+                    continue
+                self.fetches += 1
+                async with self.lock(guild.id):  # 招待キャッシュの比較と置き換えのみロック
+                    old = self.cache.get(guild.id)  # 取得中に作成・削除された招待を含む (圧縮されている場合は復元)
+                    if new is not None:
+                        self.cache[guild.id] = new
+                future.set_result(JoinBatch(old, new, size))
+        finally:
+            self.running.discard(guild.id)
+
+    def get_stats(self) -> dict:
+        """まとめた参加数と取得回数を取得"""
+        return {"joins": self.joins, "fetches": self.fetches, "saved": self.joins - self.fetches, "max_batch": self.max_batch}
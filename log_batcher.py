@@ -0,0 +1,110 @@
+import asyncio
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+import discord
+from discord.http import HTTPClient, Route
+
+from outbound import OutboundQueue, PRIORITY_LOG
+
+MAX_EMBEDS = 10  # 1つのメッセージに含められる埋め込みの最大数
+MAX_EMBED_CHARS = 6000  # 1つのメッセージの埋め込みの合計文字数の上限
+MAX_CONTENT_CHARS = 2000  # 1つのメッセージの本文の文字数の上限
+
+
+class LogBatcher:
+    """ログチャンネルごとに短時間のログをまとめて、1つのメッセージで最大10個の埋め込みを送信する"""
+
+    def __init__(self, http: HTTPClient, outbound: OutboundQueue, window: float = 1.0):
+        self.http = http
+        self.outbound = outbound  # 送信はキック・BANなどより後に行う
+        self.window = window  # ログをまとめる時間[秒] (しばらく送信していないチャンネルにはすぐ送信) 0の場合はまとめない
+        self.pending: Dict[int, List[Tuple[str, Optional[discord.Embed]]]] = {}  # 送信待ちのログ {チャンネルID: [(本文, 埋め込み), ...]}
+        self.guilds: Dict[int, int] = {}  # チャンネルのサーバー {チャンネルID: サーバーID}
+        self.last_sent: Dict[int, float] = {}  # 最後に送信した時刻 {チャンネルID: time.monotonic()}
+        self._tasks: Dict[int, asyncio.Task] = {}  # 送信待ちのチャンネルの送信処理
+        self.logs = 0  # 送信したログの数
+        self.messages = 0  # 送信したメッセージの数
+        self.shed = 0  # 混雑のため破棄されたログの数
+        self.failed = 0  # 送信に失敗したログの数
+        self.max_batch = 0  # 1つのメッセージにまとめた最大のログの数
+
+    async def send(self, guild_id: int, channel_id: int, content: str = "", embed: Optional[discord.Embed] = None) -> None:
+        """ログを送信待ちに追加 (上限に達した場合と、しばらく送信していないチャンネルはすぐ送信)"""
+        self.guilds[channel_id] = guild_id
+        queue = self.pending.setdefault(channel_id, [])
+        queue.append((content, embed))
+        if channel_id in self._tasks:
+            if len(queue) >= MAX_EMBEDS:
+                self._tasks.pop(channel_id).cancel()
+                await self.flush(channel_id)
+            return
+        wait = self.last_sent.get(channel_id, 0.0) + self.window - time.monotonic()
+        if wait <= 0:  # 静かなチャンネルは待たずに送信
+            await self.flush(channel_id)
+        else:
+            self._tasks[channel_id] = asyncio.ensure_future(self._flush_later(channel_id, wait))
+
+    async def _flush_later(self, channel_id: int, wait: float) -> None:
+        await asyncio.sleep(wait)
+        del self._tasks[channel_id]
+        await self.flush(channel_id)
+
+    async def flush(self, channel_id: int) -> None:
+        """チャンネルの送信待ちのログを全て送信"""
+        queue = self.pending.pop(channel_id, [])
+        self.last_sent[channel_id] = time.monotonic()
+        while queue:
+            batch = self._take_batch(queue)
+            try:
+                if await self._post(channel_id, batch) is None:  # 送信待ちが多いサーバーのため破棄された
+                    self.shed += len(batch)
+                    continue
+            except Exception:
+                traceback.print_exc()
+                self.failed += len(batch)
+                continue
+            self.logs += len(batch)
+            self.messages += 1
+            self.max_batch = max(self.max_batch, len(batch))
+
+    async def close(self) -> None:
+        """全ての送信待ちのログを送信"""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        for channel_id in list(self.pending):
+            await self.flush(channel_id)
+
+    @staticmethod
+    def _take_batch(queue: List[Tuple[str, Optional[discord.Embed]]]) -> List[Tuple[str, Optional[discord.Embed]]]:
+        """1つのメッセージで送信できる分を先頭から取り出す"""
+        embeds = content_chars = embed_chars = 0
+        size = 0
+        for content, embed in queue:
+            if size and (embeds + (embed is not None) > MAX_EMBEDS
+                         or content_chars + len(content) + 1 > MAX_CONTENT_CHARS
+                         or embed_chars + (len(embed) if embed is not None else 0) > MAX_EMBED_CHARS):
+                break
+            embeds += embed is not None
+            content_chars += len(content) + 1
+            embed_chars += len(embed) if embed is not None else 0
+            size += 1
+        batch = queue[:size]
+        del queue[:size]
+        return batch
+
+    async def _post(self, channel_id: int, batch: List[Tuple[str, Optional[discord.Embed]]]) -> Optional[dict]:
+        # discord.py 1.5のsendは埋め込みを1つしか送れないため、APIを直接呼び出す
+        payload = {"embeds": [embed.to_dict() for _, embed in batch if embed is not None]}
+        if content := "\n".join(content for content, _ in batch if content):
+            payload["content"] = content
+        route = Route("POST", "/channels/{channel_id}/messages", channel_id=channel_id)
+        # 送信したメッセージ (混雑のため破棄された場合はNone)
+        return await self.outbound.submit(self.guilds[channel_id], f"messages:{channel_id}", lambda: self.http.request(route, json=payload), PRIORITY_LOG)
+
+    def get_stats(self) -> dict:
+        """送信したログとメッセージの数を取得 (破棄・失敗したログは含めない)"""
+        return {"logs": self.logs, "messages": self.messages, "saved": self.logs - self.messages, "max_batch": self.max_batch, "shed": self.shed, "failed": self.failed,
+                "pending": sum(len(queue) for queue in self.pending.values())}
@@ -1,18 +1,35 @@
 import asyncio
+import functools
 import identifier
 import logging
 import os
 import platform
-import random
 import time
-from typing import Optional
+import traceback
+from typing import Any, List, Optional
 
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 
 from SQLManager import SQLManager
+from attribution import AttributionEngine
+from channel_cache import ChannelCache
+from digest import DigestManager
+from event_log import EVENT_INVITE_DRIFT, EventWriter
 from help import Help
+from invite_cache import InviteCache, InviteSnapshot, dump_snapshots, load_snapshots, write_snapshots
+from join_coalescer import JoinCoalescer
+from join_buffer import JoinBuffer
+from log_batcher import LogBatcher
+from memory_storage import MemoryStorage
+from outbound import OutboundQueue, PRIORITY_MODERATION, PRIORITY_ROLE
+from pool_manager import PoolConfig
+from ratelimit import InviteFetchScheduler, PRIORITY_COMMAND, PRIORITY_JOIN, PRIORITY_RECONCILE, PRIORITY_WARMUP
+from reconcile import InviteReconciler, ReconcilePolicy
+from retention import RetentionJob, RetentionPolicy
+from sqlite_storage import SQLiteStorage
+from storage import Storage
 from identifier import error_embed_builder, success_embed_builder, normal_ember_builder
 from static_data import StaticData
 
@@ -41,33 +58,174 @@ class InviteMonitor(commands.Bot):
         self.static_data = StaticData()
 
         # データベース接続準備
-        self.db = SQLManager(os.getenv("DATABASE_URL"), self.loop)
-        self.cache = {}  # 招待キャッシュ
+        self.db = self.create_storage(os.getenv("STORAGE_BACKEND", "postgres"))
+        # 参加履歴の書き込みバッファ (JOIN_BUFFER_SIZE=0で無効, 書き込みに失敗した場合はJOIN_BUFFER_MAX_PENDING件まで保持)
+        self.join_buffer = JoinBuffer(self.db, int(os.getenv("JOIN_BUFFER_SIZE", 100)), float(os.getenv("JOIN_BUFFER_INTERVAL", 5)),
+                                      int(os.getenv("JOIN_BUFFER_MAX_PENDING", 10000)))
+        # イベント履歴の書き込みバッファ (EVENT_BUFFER_SIZE=0で無効, 書き込みに失敗した場合はEVENT_BUFFER_MAX_PENDING件まで保持)
+        self.event_writer = EventWriter(self.db, int(os.getenv("EVENT_BUFFER_SIZE", 500)), float(os.getenv("EVENT_BUFFER_INTERVAL", 10)),
+                                        int(os.getenv("EVENT_BUFFER_MAX_PENDING", 50000)))
+        self.channel_cache = ChannelCache()  # サーバーごとのログの送信先と権限の確認結果
+        # Discordへの送信の優先度順の実行 (全体で1秒あたりOUTBOUND_RATE回, ルートごとにOUTBOUND_ROUTE_RATE回, サーバーの送信待ちがOUTBOUND_GUILD_LIMIT件を超えたらログを破棄)
+        self.outbound = OutboundQueue(float(os.getenv("OUTBOUND_RATE", 40)), float(os.getenv("OUTBOUND_ROUTE_RATE", 5)), int(os.getenv("OUTBOUND_ROUTE_BURST", 5)),
+                                      int(os.getenv("OUTBOUND_GUILD_LIMIT", 200)))
+        # ログチャンネルへの送信をまとめる (LOG_BATCH_WINDOW秒以内のログを1つのメッセージにまとめる, 0でまとめない)
+        self.log_batcher = LogBatcher(self.http, self.outbound, float(os.getenv("LOG_BATCH_WINDOW", 1)))
+        # イベントが多いサーバーのログをまとめる (DIGEST_WINDOW秒間にDIGEST_THRESHOLD件以上のイベントがあったら、DIGEST_INTERVAL秒ごとに集計を送信)
+        self.digest = DigestManager(self.get_guild, self.log_send, int(os.getenv("DIGEST_THRESHOLD", 30)), float(os.getenv("DIGEST_WINDOW", 60)),
+                                    float(os.getenv("DIGEST_INTERVAL", 60)), int(os.getenv("DIGEST_YOUNG_DAYS", 7)))
+        # 保持期間を過ぎたデータの削除 (既定では削除しない)
+        # RETENTION_GUILD_DAYS: 退出したサーバー, RETENTION_MEMBER_DAYS: 退出したメンバー, RETENTION_EVENT_DAYS: イベント履歴のデータを残す日数 (0で削除しない)
+        self.retention = RetentionJob(self.db, RetentionPolicy.from_env())
+        # 招待キャッシュ (INVITE_CACHE_IDLE秒使われていないサーバーと、展開済みの分がINVITE_CACHE_BUDGET[MiB]を超えた分は古い順に圧縮)
+        self.cache = InviteCache(int(float(os.getenv("INVITE_CACHE_BUDGET", 0)) * 1024 * 1024), float(os.getenv("INVITE_CACHE_IDLE", 86400)))
+        self.cache_sweep_interval = float(os.getenv("INVITE_CACHE_SWEEP_INTERVAL", 60))  # 圧縮するサーバーを確認する間隔[秒]
+        self.invite_fetches = 0  # 招待を全て取得した回数
+        self.invite_patches = 0  # 招待のイベントから招待キャッシュを更新した回数
+        # 招待の取得の頻度制限 (1秒あたりINVITE_FETCH_RATE回, 連続でINVITE_FETCH_BURST回まで)
+        self.fetch_scheduler = InviteFetchScheduler(float(os.getenv("INVITE_FETCH_RATE", 10)), int(os.getenv("INVITE_FETCH_BURST", 20)))
+        self.attribution = AttributionEngine()  # 参加者の招待者の判定
+        # 招待の取得中の参加をまとめて、取得が終わった後に1回で取得する
+        self.join_coalescer = JoinCoalescer(self.cache, functools.partial(self.fetch_invite_snapshot, priority=PRIORITY_JOIN))
+        # 取りこぼしたイベントで古くなった招待キャッシュの定期的な取得し直し (全サーバーで1分あたりRECONCILE_BUDGET回まで)
+        self.reconciler = InviteReconciler(self.cache, self.join_coalescer, self.get_guild, functools.partial(self.fetch_invite_snapshot, priority=PRIORITY_RECONCILE),
+                                           self.on_invite_drift, ReconcilePolicy.from_env())
+        self.warmup_concurrency = int(os.getenv("WARMUP_CONCURRENCY", 10))  # 起動時に同時に招待を取得するサーバー数
+        # 招待キャッシュの保存先 (INVITE_SNAPSHOT_PATHを空にすると保存しない)
+        self.snapshot_path = os.getenv("INVITE_SNAPSHOT_PATH", "invite_cache.bin")
+        self.snapshot_interval = float(os.getenv("INVITE_SNAPSHOT_INTERVAL", 300))  # 保存間隔[秒]
+        self.snapshot_max_age = float(os.getenv("INVITE_SNAPSHOT_MAX_AGE", 3600))  # これより古い保存データは使わない[秒]
 
         for cog in self.bot_cogs:
             self.load_extension(cog)  # Cogの読み込み
 
+    def create_storage(self, backend: str) -> Storage:
+        """保存先を作成 (postgres, sqlite, memory)"""
+        if backend == "postgres":
+            return SQLManager(os.getenv("DATABASE_URL"), self.loop, PoolConfig.from_env())
+        elif backend == "sqlite":
+            return SQLiteStorage(os.getenv("SQLITE_PATH", "invite_monitor.db"))
+        elif backend == "memory":
+            return MemoryStorage()
+        else:
+            raise ValueError(f"Unknown storage backend: {backend}")
+
     async def on_ready(self):
         """キャッシュの準備ができた際のイベント"""
         if not self.db.is_connected():  # データベースに接続しているか確認
             print(f"Logged in to [{self.user}]")
             await self.db.connect()  # データベースに接続
-            # 全てのサーバーの招待情報のキャッシュを更新
-            for guild_id in await self.db.get_enabled_guild_ids():  # 有効化されているサーバーを取得
-                guild = self.get_guild(guild_id)
-                if guild is None:  # BOTのダウンタイム中にサーバーを退出した場合
-                    await self.db.disable_guild(guild_id)
-                else:
-                    await self.update_server_cache(guild)
-            # サーバーを確認
-            registered_guilds = set(await self.db.get_guild_ids())
-            joined_guilds = {guild.id for guild in bot.guilds}
-            new_guilds = joined_guilds - registered_guilds
-            for guild in new_guilds:
-                await self.db.register_new_guild(guild)
+            # 旧形式(JSONB)の招待履歴をバックグラウンドで移行
+            self.loop.create_task(self.migrate_legacy_users())
+            self.join_buffer.start(self.loop)  # 参加履歴の定期書き込みを開始
+            self.event_writer.start(self.loop)  # イベント履歴の定期書き込みを開始
+            if await self.load_invite_cache():
+                # 保存された招待キャッシュですぐに参加を判定できるため、取得し直して確認するのはバックグラウンドで行う
+                self.loop.create_task(self.warm_up())
+            else:
+                await self.warm_up()  # 全てのサーバーの招待情報のキャッシュを更新
+            if self.snapshot_path:
+                self.loop.create_task(self._save_invite_cache_loop())  # 招待キャッシュの定期保存を開始
+            self.loop.create_task(self._evict_invite_cache_loop())  # 使われていない招待キャッシュの定期圧縮を開始
+            self.retention.start(self.loop)  # 保持期間を過ぎたデータの定期削除を開始
+            self.reconciler.start(self.loop)  # 招待キャッシュの定期的な取得し直しを開始
+            self.digest.start(self.loop)  # まとめたログの定期送信を開始
             # 起動後のBOTステータスを設定
             await self.change_presence(status=discord.Status.online, activity=discord.Game(f"{self.PREFIX}help | {len(self.guilds)}servers\n"))
 
+    async def migrate_legacy_users(self) -> None:
+        """旧形式の招待履歴を移行 (失敗した場合も、未移行のサーバーは読み込み時に移行される)"""
+        try:
+            if migrated := await self.db.migrate_legacy_users():
+                print(f"Migrated legacy invite data of {migrated} servers")
+        except Exception:
+            traceback.print_exc()
+
+    async def warm_up(self):
+        """起動時に全サーバーの招待キャッシュを並行して作成"""
+        start = time.perf_counter()
+        # 新しく参加したサーバーをまとめて登録
+        registered_guilds = set(await self.db.get_guild_ids())
+        await self.db.register_new_guilds([guild.id for guild in self.guilds if guild.id not in registered_guilds])
+        # BOTのダウンタイム中に退出・再参加したサーバーの退出日時を更新
+        current_guilds = {guild.id for guild in self.guilds}
+        await self.db.set_guilds_left(list(registered_guilds - current_guilds), True)
+        await self.db.set_guilds_left(list(current_guilds & registered_guilds), False)
+        # 有効化されているサーバーの招待を同時にwarmup_concurrency件まで取得
+        guild_ids = await self.db.get_enabled_guild_ids()
+        semaphore = asyncio.Semaphore(self.warmup_concurrency)
+        done = 0
+        stale = 0  # 保存された招待キャッシュと異なっていたサーバー数
+
+        async def warm(guild_id: int):
+            nonlocal done, stale
+            if (guild := self.get_guild(guild_id)) is None:  # BOTのダウンタイム中にサーバーを退出した場合
+                await self.db.disable_guild(guild_id)
+            else:
+                async with semaphore:
+                    start = time.monotonic()
+                    new = await self.fetch_invite_snapshot(guild, PRIORITY_WARMUP)
+                # 取得中に参加があった場合は、参加時の取得に任せる
+                if new is not None and self.join_coalescer.last_join.get(guild_id, 0.0) < start:
+                    async with self.join_coalescer.lock(guild_id):
+                        old = self.cache.get(guild_id)
+                        self.cache[guild_id] = new
+                    if old is not None and (old.codes != new.codes or old.uses != new.uses):
+                        stale += 1
+            done += 1
+            if done % 100 == 0:
+                print(f"Warming up invite cache... {done}/{len(guild_ids)}")
+
+        results = await asyncio.gather(*[warm(guild_id) for guild_id in guild_ids], return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            traceback.print_exception(type(error), error, error.__traceback__)
+        print(f"Invite cache warmed up for {len(guild_ids) - len(failed)}/{len(guild_ids)} servers in {time.perf_counter() - start:.2f}s ({stale} stale)")
+
+    async def load_invite_cache(self) -> bool:
+        """保存された招待キャッシュを読み込み (有効化されているサーバーのみ) 読み込んだ場合はTrue"""
+        if not self.snapshot_path:
+            return False
+        start = time.perf_counter()
+        snapshots = await self.loop.run_in_executor(None, load_snapshots, self.snapshot_path, self.snapshot_max_age)
+        enabled_guilds = set(await self.db.get_enabled_guild_ids())
+        self.cache.update({guild_id: snapshot for guild_id, snapshot in snapshots.items() if guild_id in enabled_guilds})
+        if snapshots:
+            print(f"Invite cache loaded for {len(self.cache)} servers in {time.perf_counter() - start:.2f}s")
+        return bool(snapshots)
+
+    async def save_invite_cache(self) -> None:
+        """招待キャッシュをファイルに保存 (変換はイベントループ上で行い、書き込みは別スレッドで行う)"""
+        if self.snapshot_path:
+            await self.loop.run_in_executor(None, write_snapshots, self.snapshot_path, dump_snapshots(self.cache))
+
+    async def _save_invite_cache_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save_invite_cache()
+            except Exception:
+                traceback.print_exc()
+
+    async def _evict_invite_cache_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.cache_sweep_interval)
+            try:
+                if evicted := self.cache.evict():
+                    print(f"Invite cache: evicted {evicted} servers ({len(self.cache.hot)} resident / {len(self.cache.cold)} cold)")
+            except Exception:
+                traceback.print_exc()
+
+    async def close(self):
+        """BOTを終了する際に、書き込み待ちのデータを保存"""
+        if self.db.is_connected():
+            await self.join_buffer.close()
+            await self.event_writer.close()
+            await self.save_invite_cache()
+        await self.digest.close()
+        await self.log_batcher.close()
+        await super().close()
+
     async def on_guild_join(self, guild: discord.guild):
         """BOT自身がサーバーに参加した際のイベント"""
         # サーバー情報をデータベースに新規登録
@@ -82,13 +240,47 @@ class InviteMonitor(commands.Bot):
 
     async def on_guild_remove(self, guild):
         """BOT自身がサーバーを退出した際のイベント"""
-        # 招待キャッシュを削除
-        await self.db.disable_guild(guild.id)
+        # 招待キャッシュを削除 (データは保持期間を過ぎたら削除)
+        await self.db.leave_guild(guild.id)
+        self.channel_cache.invalidate(guild.id)
         if guild.id in self.cache:
             del self.cache[guild.id]
         # ステータス変更
         await self.change_presence(status=discord.Status.online, activity=discord.Game(f"{self.PREFIX}help | {len(self.guilds)}servers\n"))
 
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        """サーバーが更新された際のイベント (システムチャンネルの変更)"""
+        self.channel_cache.invalidate(after.id)
+
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        """チャンネルが作成された際のイベント"""
+        self.channel_cache.invalidate(channel.guild.id)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        """チャンネルが削除された際のイベント"""
+        self.channel_cache.invalidate(channel.guild.id)
+
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        """チャンネルが更新された際のイベント (権限の上書きの変更)"""
+        self.channel_cache.invalidate(after.guild.id)
+
+    async def on_guild_role_create(self, role: discord.Role):
+        """役職が作成された際のイベント"""
+        self.channel_cache.invalidate(role.guild.id)
+
+    async def on_guild_role_delete(self, role: discord.Role):
+        """役職が削除された際のイベント"""
+        self.channel_cache.invalidate(role.guild.id)
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        """役職が更新された際のイベント (権限の変更)"""
+        self.channel_cache.invalidate(after.guild.id)
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        """メンバーが更新された際のイベント (BOT自身の役職の変更)"""
+        if after.id == self.user.id:
+            self.channel_cache.invalidate(after.guild.id)
+
     async def on_message(self, message):
         """メッセージを受け取った際のイベント"""
         if message.content == f"<@!{self.user.id}>":  # メンションされた場合、簡単な説明分を送信
@@ -98,14 +290,60 @@ class InviteMonitor(commands.Bot):
         else:  # コマンドを処理
             await self.process_commands(message)
 
-    async def update_server_cache(self, guild: discord.guild):
-        """サーバーの招待キャッシュを更新"""
+    async def fetch_invite_snapshot(self, guild: discord.guild, priority: int = PRIORITY_COMMAND) -> Optional[InviteSnapshot]:
+        """サーバーの招待を全て取得 (取得は頻度制限のキューを通して優先度順に行う) 権限がない場合はNone"""
         if not (guild.me.guild_permissions.manage_guild and guild.me.guild_permissions.manage_channels):
             return await self.perm_lack_reporter(guild, ["manage_guild", "manage_channels"])
-        invites = {invite.code: {"uses": invite.uses, "author": invite.inviter.id} for invite in await guild.invites()}
-        self.cache[guild.id] = invites
+        invites = InviteSnapshot.from_invites(await self.fetch_scheduler.fetch(guild, priority))
+        self.invite_fetches += 1
         return invites
 
+    async def update_server_cache(self, guild: discord.guild, priority: int = PRIORITY_COMMAND):
+        """サーバーの招待キャッシュを更新"""
+        if (invites := await self.fetch_invite_snapshot(guild, priority)) is not None:
+            self.cache[guild.id] = invites
+        return invites
+
+    async def on_invite_drift(self, guild_id: int, codes: List[str]) -> None:
+        """取得し直した招待が招待キャッシュと異なっていた場合に記録"""
+        for code in codes:  # 差異があった招待を1つずつ記録
+            await self.event_writer.record(guild_id, EVENT_INVITE_DRIFT, code=code)
+
+    async def add_invite_cache(self, invite: discord.Invite) -> None:
+        """作成された招待を招待キャッシュに追加 (キャッシュがない場合は全て取得)"""
+        self.reconciler.touch(invite.guild.id)
+        async with self.join_coalescer.lock(invite.guild.id):  # 招待キャッシュの置き換えとは同時に行わない
+            if (snapshot := self.cache.get(invite.guild.id)) is not None:
+                snapshot.add(invite.code, invite.uses or 0, invite.inviter.id if invite.inviter is not None else None)
+                self.invite_patches += 1
+                return
+        await self.update_server_cache(invite.guild)
+
+    async def remove_invite_cache(self, invite: discord.Invite) -> None:
+        """削除された招待を招待キャッシュから削除 (キャッシュがない場合は全て取得)"""
+        self.reconciler.touch(invite.guild.id)
+        async with self.join_coalescer.lock(invite.guild.id):  # 招待キャッシュの置き換えとは同時に行わない
+            if (snapshot := self.cache.get(invite.guild.id)) is not None:
+                snapshot.remove(invite.code)
+                self.invite_patches += 1
+                return
+        await self.update_server_cache(invite.guild)
+
+    async def moderate_members(self, guild: discord.Guild, action: str, members: List[discord.Member]) -> List[Any]:
+        """メンバーをまとめてキック・BAN (ログの送信より優先) メンバーごとの結果か例外を返す"""
+        return await asyncio.gather(*[self.outbound.submit(guild.id, f"{action}:{guild.id}", getattr(member, action), PRIORITY_MODERATION, (action, guild.id, member.id))
+                                      for member in members], return_exceptions=True)
+
+    async def delete_invites(self, guild: discord.Guild, invites: List[discord.Invite]) -> None:
+        """招待をまとめて削除 (ログの送信より優先)"""
+        await asyncio.gather(*[self.outbound.submit(guild.id, f"invite_delete:{guild.id}", invite.delete, PRIORITY_MODERATION, ("invite_delete", invite.code))
+                               for invite in invites])
+
+    async def add_roles(self, member: discord.Member, roles: List[discord.Role]) -> None:
+        """トリガーによる役職の付与 (ログの送信より優先, 同じメンバーへの同じ役職の付与はまとめる)"""
+        merge_key = ("roles", member.guild.id, member.id, tuple(sorted(role.id for role in roles)))
+        await self.outbound.submit(member.guild.id, f"roles:{member.guild.id}", lambda: member.add_roles(*roles), PRIORITY_ROLE, merge_key)
+
     async def confirm(self, ctx):
         """本当に実行するかの確認"""
 
@@ -130,15 +368,8 @@ class InviteMonitor(commands.Bot):
             args["embed"] = embed
         if content != "":
             args["content"] = content
-        channels = guild.text_channels
-        random.shuffle(channels)
-        if (sys_ch := guild.system_channel) is not None:
-            channels.insert(0, sys_ch)
-        for channel in channels:
-            perms = channel.permissions_for(guild.me)
-            if perms.send_messages and perms.embed_links and perms.read_messages:
-                await channel.send(**args)
-                break
+        if (channel := self.channel_cache.get_fallback_channel(guild)) is not None:  # 送信先はキャッシュから取得
+            await channel.send(**args)
         else:  # どのチャンネルにも送信できなかった場合
             if try_owner:
                 try:
@@ -161,27 +392,22 @@ class InviteMonitor(commands.Bot):
     async def log_send(self, guild: discord.Guild, content: str = "", embed: Optional[discord.Embed] = None):
         """ログチャンネルにログめっせーぞを送信"""
         log_channel_id = await self.db.get_log_channel_id(guild.id)
-        log_channel = self.get_channel(log_channel_id)
+        # チャンネルと権限の確認結果はキャッシュから取得 (チャンネル・役職・BOT自身の更新で確認し直す)
+        log_channel, sendable = self.channel_cache.get_log_channel(guild, log_channel_id)
         if log_channel is None:
             embed = discord.Embed(title=f"{self.static_data.emoji_stop}  Important Warning  {self.static_data.emoji_stop}", color=0xff0000)
             embed.description = f"The feature was automatically __disabled__ because log channel (<#{log_channel_id}>) was not found\n" \
                                 f"If you want to continue monitoring, setup different channel by `{self.PREFIX}enable` again."
             await self.db.disable_guild(guild.id)
             return await self.find_send(guild, embed=embed)
-        perms = log_channel.permissions_for(guild.me)
-        if not (perms.send_messages and perms.embed_links and perms.read_messages):
+        if not sendable:
             embed = discord.Embed(title=f"{self.static_data.emoji_stop}  Important Warning  {self.static_data.emoji_stop}", color=0xff0000)
             embed.description = f"The feature was automatically __disabled__ because missing following permissions in log channel (<#{log_channel_id}>)" \
                                 "```diff\n- read_messages\n- send_messages\n- embed_links```" \
                                 f"If you want to continue monitoring, add permissions to the BOT and setup by `{self.PREFIX}enable` again."
             await self.db.disable_guild(guild.id)
             return await self.find_send(guild, embed=embed)
-        args = {}
-        if embed is not None:
-            args["embed"] = embed
-        if content != "":
-            args["content"] = content
-        await log_channel.send(**args)
+        await self.log_batcher.send(guild.id, log_channel.id, content, embed)  # 短時間のログは1つのメッセージにまとめて送信
 
 
 if __name__ == '__main__':
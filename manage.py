@@ -48,23 +48,23 @@ class Manage(commands.Cog):
     async def kick(self, ctx, *, condition):
         error_log = ""
         target_users = set()
+        members = []
         for target in self.extract_user(condition):
             if (member := ctx.guild.get_member(target)) is None:
                 error_log += f"User not in this server: <@{target}>\n"
                 continue
-            try:
-                await member.kick()
-            except:
-                error_log += f"Failed to kick user <@{target}>\n"
+            members.append(member)
+        # ログの送信より優先してまとめて実行
+        for member, result in zip(members, await self.bot.moderate_members(ctx.guild, "kick", members)):
+            if isinstance(result, Exception):
+                error_log += f"Failed to kick user <@{member.id}>\n"
             else:
-                target_users.add(str(target))
+                target_users.add(str(member.id))
         if error_log != "":
             await error_embed_builder(ctx, error_log[:1900].rsplit("\n", 1)[0] + "\n..." if len(error_log) >= 1900 else error_log)
         if not target_users:
             return await error_embed_builder(ctx, "No user found to kick")
-        for invite in await ctx.guild.invites():
-            if str(invite.inviter.id) in target_users:
-                await invite.delete()
+        await self.bot.delete_invites(ctx.guild, [invite for invite in await self.bot.fetch_scheduler.fetch(ctx.guild) if str(invite.inviter.id) in target_users])
         mentions_text = "<@" + "> <@".join(target_users) + ">"
         await success_embed_builder(ctx, f"{mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has kicked successfully!")
 
@@ -74,23 +74,23 @@ class Manage(commands.Cog):
     async def ban(self, ctx, *, condition):
         error_log = ""
         target_users = set()
+        members = []
         for target in self.extract_user(condition):
             if (member := ctx.guild.get_member(target)) is None:
                 error_log += f"User not in this server: <@{target}>\n"
                 continue
-            try:
-                await member.ban()
-            except:
-                error_log += f"Failed to ban user <@{target}>\n"
+            members.append(member)
+        # ログの送信より優先してまとめて実行
+        for member, result in zip(members, await self.bot.moderate_members(ctx.guild, "ban", members)):
+            if isinstance(result, Exception):
+                error_log += f"Failed to ban user <@{member.id}>\n"
             else:
-                target_users.add(str(target))
+                target_users.add(str(member.id))
         if error_log != "":
             await error_embed_builder(ctx, error_log[:1900].rsplit("\n", 1)[0] + "\n..." if len(error_log) >= 1900 else error_log)
         if not target_users:
             return await error_embed_builder(ctx, "No user found to ban")
-        for invite in await ctx.guild.invites():
-            if str(invite.inviter.id) in target_users:
-                await invite.delete()
+        await self.bot.delete_invites(ctx.guild, [invite for invite in await self.bot.fetch_scheduler.fetch(ctx.guild) if str(invite.inviter.id) in target_users])
         mentions_text = "<@" + "> <@".join(target_users) + ">"
         await success_embed_builder(ctx, f"{mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has banned successfully!")
 
@@ -112,23 +112,20 @@ class Manage(commands.Cog):
         error_log = ""
         # Kickに成功した人のみのリストを作成
         target_checked = set()
-        for target in target_users:
-            if (member := ctx.guild.get_member(target)) is None:
-                continue  # サーバーに存在しない場合
-            try:
-                await member.kick()
-            except:
-                error_log += f"Failed to kick user <@{target}>\n"
+        members = [member for target in target_users if (member := ctx.guild.get_member(target)) is not None]  # サーバーに存在するメンバーのみ
+        # ログの送信より優先してまとめて実行
+        for member, result in zip(members, await self.bot.moderate_members(ctx.guild, "kick", members)):
+            if isinstance(result, Exception):
+                error_log += f"Failed to kick user <@{member.id}>\n"
             else:
-                target_checked.add(str(target))
+                target_checked.add(str(member.id))
         if error_log != "":
             error_log += "They has same or higher role than me."
             await error_embed_builder(ctx, error_log[:1900].rsplit("\n", 1)[0] + "\n..." if len(error_log) >= 1900 else error_log)
         if not target_checked:
             return await error_embed_builder(ctx, f"No user found to kick.")
-        for invite in await ctx.guild.invites():
-            if (str(invite.inviter.id) in target_checked) or (invite.code in codes):
-                await invite.delete()
+        invites = await self.bot.fetch_scheduler.fetch(ctx.guild)
+        await self.bot.delete_invites(ctx.guild, [invite for invite in invites if (str(invite.inviter.id) in target_checked) or (invite.code in codes)])
         mentions_text = "<@" + "> <@".join(target_checked) + ">"
         await success_embed_builder(ctx, f"{mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has kicked successfully!")
 
@@ -150,23 +147,20 @@ class Manage(commands.Cog):
         error_log = ""
         # Kickに成功した人のみのリストを作成
         target_checked = set()
-        for target in target_users:
-            if (member := ctx.guild.get_member(target)) is None:
-                continue  # サーバーに存在しない場合
-            try:
-                await member.ban()
-            except:
-                error_log += f"Failed to ban user <@{target}>\n"
+        members = [member for target in target_users if (member := ctx.guild.get_member(target)) is not None]  # サーバーに存在するメンバーのみ
+        # ログの送信より優先してまとめて実行
+        for member, result in zip(members, await self.bot.moderate_members(ctx.guild, "ban", members)):
+            if isinstance(result, Exception):
+                error_log += f"Failed to ban user <@{member.id}>\n"
             else:
-                target_checked.add(str(target))
+                target_checked.add(str(member.id))
         if error_log != "":
             error_log += "They has same or higher role than me."
             await error_embed_builder(ctx, error_log[:1900].rsplit("\n", 1)[0] + "\n..." if len(error_log) >= 1900 else error_log)
         if not target_checked:
             return await error_embed_builder(ctx, f"No user found to kick.")
-        for invite in await ctx.guild.invites():
-            if (str(invite.inviter.id) in target_checked) or (invite.code in codes):
-                await invite.delete()
+        invites = await self.bot.fetch_scheduler.fetch(ctx.guild)
+        await self.bot.delete_invites(ctx.guild, [invite for invite in invites if (str(invite.inviter.id) in target_checked) or (invite.code in codes)])
         mentions_text = "<@" + "> <@".join(target_checked) + ">"
         await success_embed_builder(ctx, f"{mentions_text[:1900].rsplit('<', 1)[0] + '...' if len(mentions_text) >= 1900 else mentions_text} has banned successfully!")
 
@@ -198,7 +192,7 @@ class Manage(commands.Cog):
             if code_cond[0] not in self.bot.cache[guild.id]:  # 招待キャッシュに存在しない場合
                 wrongs.append(code_cond[1])
             else:
-                code_authors.append(self.bot.cache[guild.id][code_cond[0]]["author"])  # 招待の作成者を追加
+                code_authors.append(self.bot.cache[guild.id].get_author(code_cond[0]))  # 招待の作成者を追加
             codes.append(code_cond[0])
         # ユーザーIDリストの確認
         for user_cond in user_list:
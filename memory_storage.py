@@ -0,0 +1,271 @@
+import bisect
+import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from storage import Event, Storage
+
+
+class MemoryStorage(Storage):
+    """プロセス内のメモリに保存 (開発・ベンチマーク用, 再起動すると消える)"""
+
+    def __init__(self):
+        super().__init__()
+        self.connected = False
+        # {サーバーID: {"channel": ログチャンネルID, "code_trigger": {コード: 役職}, "user_trigger": {ユーザーID(str): 役職}, "left_at": 退出日時}}
+        self.guilds: Dict[int, dict] = {}
+        # {サーバーID: {ユーザーID: [招待者ID, 招待コード]}}
+        self.members: Dict[int, Dict[int, list]] = {}
+        # 退出したメンバー {サーバーID: {ユーザーID: 退出日時}}
+        self.members_left: Dict[int, Dict[int, datetime.datetime]] = {}
+        # {サーバーID: {招待者ID: {参加者ID, ...}}}
+        self.invited: Dict[int, Dict[int, Set[int]]] = {}
+        # 逆引き用 {サーバーID: {招待者ID or 招待コード: {参加者ID, ...}}}
+        self.by_inviter: Dict[int, Dict[int, Set[int]]] = {}
+        self.by_code: Dict[int, Dict[str, Set[int]]] = {}
+        # 招待数 {サーバーID: {招待者ID: 招待数}}
+        self.invite_counts: Dict[int, Dict[int, int]] = {}
+        # 招待数の多い順 {サーバーID: [(-招待数, 招待者ID), ...]} (招待数の変更時に並びを保ったまま更新)
+        self.rankings: Dict[int, List[Tuple[int, int]]] = {}
+        # イベント {サーバーID: [イベント, ...] (発生順)}
+        self.events: Dict[int, List[Event]] = {}
+
+    # Connection
+    async def connect(self) -> None:
+        """データベースに接続"""
+        self.connected = True
+        await self.load_guild_settings()
+
+    def is_connected(self) -> bool:
+        """データベースに接続しているか確認"""
+        return self.connected
+
+    # Guild
+    async def get_guild_ids(self) -> list:
+        """登録されているサーバーIDのリストを取得"""
+        return list(self.guilds)
+
+    async def _fetch_guild_settings(self) -> Dict[int, Optional[int]]:
+        """全サーバーのログチャンネルIDを取得"""
+        return {guild_id: guild["channel"] for guild_id, guild in self.guilds.items()}
+
+    async def _set_log_channel_id(self, guild_id: int, channel_id: Optional[int]) -> None:
+        """ログチャンネルIDを保存 (Noneの場合は無効)"""
+        if guild_id in self.guilds:
+            self.guilds[guild_id]["channel"] = channel_id
+
+    async def is_registered_guild(self, guild_id: int) -> bool:
+        """サーバーが登録されているか確認"""
+        return guild_id in self.guilds
+
+    async def _insert_guilds(self, guild_ids: List[int]) -> List[int]:
+        """登録されていないサーバーを追加して、追加したサーバーIDのリストを取得"""
+        inserted = []
+        for guild_id in guild_ids:
+            if guild_id not in self.guilds:
+                self.guilds[guild_id] = {"channel": None, "code_trigger": {}, "user_trigger": {}, "left_at": None}
+                inserted.append(guild_id)
+        return inserted
+
+    async def set_guilds_left(self, guild_ids: List[int], left: bool) -> None:
+        """サーバーの退出日時を記録 (leftがFalseの場合は退出日時を消去)"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for guild_id in guild_ids:
+            if (guild := self.guilds.get(guild_id)) is not None and (guild["left_at"] is None) == left:
+                guild["left_at"] = now if left else None
+
+    async def get_guild_users_count(self, guild_id: int) -> int:
+        """サーバーが認識しているユーザー数を取得"""
+        return len(self.members.get(guild_id, {}))
+
+    async def get_guild_users(self, guild_id: int) -> list:
+        """保存されているユーザーのリストを取得"""
+        return list(self.members.get(guild_id, {}))
+
+    async def get_enabled_guild_ids(self) -> list:
+        """有効化されているサーバーIDのリストを取得"""
+        return [guild_id for guild_id, guild in self.guilds.items() if guild["channel"] is not None]
+
+    async def _fetch_log_channel_id(self, guild_id: int) -> Optional[int]:
+        """ログ送信用チャンネルを取得"""
+        return self.guilds.get(guild_id, {}).get("channel")
+
+    # Trigger
+    def _triggers(self, guild_id: int, kind: str) -> dict:
+        return self.guilds.get(guild_id, {}).get(kind, {})
+
+    async def get_code_trigger_list(self, guild_id: int) -> list:
+        """招待コードトリガーに設定されているコードのリストを取得"""
+        return list(self._triggers(guild_id, "code_trigger"))
+
+    async def get_code_trigger_count(self, guild_id: int) -> int:
+        """招待コードトリガーの数を取得"""
+        return len(self._triggers(guild_id, "code_trigger"))
+
+    async def get_code_trigger_roles(self, guild_id: int, code: str) -> list:
+        """招待コードトリガーに設定されている役職のリストを取得"""
+        return list(self._triggers(guild_id, "code_trigger").get(code) or [])
+
+    async def add_code_trigger(self, guild_id: int, code: str, roles: list) -> None:
+        """招待コードトリガーを追加"""
+        if guild_id in self.guilds:
+            self.guilds[guild_id]["code_trigger"][code] = list(roles)
+
+    async def remove_code_trigger(self, guild_id: int, code: str) -> None:
+        """招待コードトリガーから設定されているコードを削除"""
+        self._triggers(guild_id, "code_trigger").pop(code, None)
+
+    async def get_user_trigger_list(self, guild_id: int) -> list:
+        """ユーザートリガーに設定されているユーザーのリストを取得"""
+        return list(self._triggers(guild_id, "user_trigger"))
+
+    async def get_user_trigger_count(self, guild_id: int) -> int:
+        """ユーザートリガーの数を取得"""
+        return len(self._triggers(guild_id, "user_trigger"))
+
+    async def get_user_trigger_roles(self, guild_id: int, user_id: int) -> list:
+        """ユーザートリガーに設定されている役職のリストを取得"""
+        return list(self._triggers(guild_id, "user_trigger").get(str(user_id)) or [])
+
+    async def add_user_trigger(self, guild_id: int, user_id: int, roles: list) -> None:
+        """ユーザートリガーを追加"""
+        if guild_id in self.guilds:
+            self.guilds[guild_id]["user_trigger"][str(user_id)] = list(roles)
+
+    async def remove_user_trigger(self, guild_id: int, user: int) -> None:
+        """ユーザートリガーから設定されているユーザーを削除"""
+        self._triggers(guild_id, "user_trigger").pop(str(user), None)
+
+    # Invites
+    async def record_joins(self, records: List[Tuple[int, int, int, str]]) -> None:
+        """複数の参加履歴をまとめて記録 [(サーバーID, 招待者ID, 参加者ID, 招待コード), ...]"""
+        for guild_id, inviter, invited, code in records:
+            members = self.members.setdefault(guild_id, {})
+            if inviter != invited:
+                members.setdefault(inviter, [None, None])
+            invited_users = self.invited.setdefault(guild_id, {}).setdefault(inviter, set())
+            if invited not in invited_users:
+                invited_users.add(invited)
+                counts = self.invite_counts.setdefault(guild_id, {})
+                count = counts[inviter] = counts.get(inviter, 0) + 1
+                ranking = self.rankings.setdefault(guild_id, [])
+                if count > 1:
+                    del ranking[bisect.bisect_left(ranking, (1 - count, inviter))]
+                bisect.insort(ranking, (-count, inviter))
+            # 以前の招待元・招待コードの逆引きを削除してから更新
+            old_inviter, old_code = members.get(invited, [None, None])
+            self.by_inviter.get(guild_id, {}).get(old_inviter, set()).discard(invited)
+            self.by_code.get(guild_id, {}).get(old_code, set()).discard(invited)
+            members[invited] = [inviter, code]
+            self.members_left.get(guild_id, {}).pop(invited, None)
+            self.by_inviter.setdefault(guild_id, {}).setdefault(inviter, set()).add(invited)
+            self.by_code.setdefault(guild_id, {}).setdefault(code, set()).add(invited)
+
+    # User
+    async def register_new_user(self, guild_id: int, user_id: int) -> None:
+        """新規ユーザーデータを追加"""
+        self.members.setdefault(guild_id, {}).setdefault(user_id, [None, None])
+
+    async def mark_member_left(self, guild_id: int, user_id: int) -> None:
+        """メンバーの退出日時を記録 (再参加時に消去)"""
+        if user_id in self.members.get(guild_id, {}):
+            self.members_left.setdefault(guild_id, {})[user_id] = datetime.datetime.now(datetime.timezone.utc)
+
+    async def reset_users_data(self, guild_id: int, user_ids: Optional[List[int]] = None):
+        """複数ユーザーのデータを1回でクリア (user_idsを指定しない場合はサーバー全体)"""
+        if user_ids is None:
+            self.invited.pop(guild_id, None)
+            self.invite_counts.pop(guild_id, None)
+            self.rankings.pop(guild_id, None)
+        else:
+            for user_id in user_ids:
+                self.invited.get(guild_id, {}).pop(user_id, None)
+                if count := self.invite_counts.get(guild_id, {}).pop(user_id, 0):
+                    ranking = self.rankings[guild_id]
+                    del ranking[bisect.bisect_left(ranking, (-count, user_id))]
+
+    async def get_user_invite_count(self, guild_id: int, user_id: int) -> int:
+        """特定ユーザーの招待数を取得"""
+        return self.invite_counts.get(guild_id, {}).get(user_id, 0)
+
+    async def get_leaderboard(self, guild_id: int, limit: int, after: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int]]:
+        """招待数の多いユーザーのリストを取得 [(ユーザーID, 招待数), ...] afterを指定した場合はその次から (前のページの最後の行)"""
+        ranking = self.rankings.get(guild_id, [])
+        start = 0 if after is None else bisect.bisect_right(ranking, (-after[1], after[0]))
+        return [(user_id, -count) for count, user_id in ranking[start:start + limit]]
+
+    async def get_user_invite_from(self, guild_id: int, user_id: int) -> Optional[int]:
+        """特定ユーザーの招待元ユーザーIDを取得"""
+        return self.members.get(guild_id, {}).get(user_id, [None, None])[0]
+
+    async def get_user_invite_code(self, guild_id: int, user_id: int) -> Optional[str]:
+        """特定ユーザーの参加時の招待コードを取得"""
+        return self.members.get(guild_id, {}).get(user_id, [None, None])[1]
+
+    async def is_registered_user(self, guild_id: int, user_id: int) -> bool:
+        """ユーザーがサーバーのユーザーリストに登録されているか確認"""
+        return user_id in self.members.get(guild_id, {})
+
+    async def filter_with_code_and_from(self, code_list: List[str], from_list: List[str], guild_id: int) -> Set[int]:
+        """指定した招待コードまたは招待者によって参加した人のIDリストを取得"""
+        id_list = set()
+        for code in code_list:
+            id_list |= self.by_code.get(guild_id, {}).get(code, set())
+        for user_id in from_list:
+            id_list |= self.by_inviter.get(guild_id, {}).get(int(user_id), set())
+        return id_list
+
+    # Event
+    async def record_events(self, events: List[Event]) -> None:
+        """複数のイベントをまとめて追記"""
+        for event in events:
+            guild_events = self.events.setdefault(event[1], [])
+            guild_events.append(event)
+            # 通常は発生順に届くため、順番が前後した場合のみ並べ直す
+            if len(guild_events) > 1 and guild_events[-2][0] > event[0]:
+                guild_events.sort(key=lambda e: e[0])
+
+    async def get_events(self, guild_id: int, since: datetime.datetime, until: datetime.datetime) -> List[Event]:
+        """期間内(since以上until未満)のサーバーのイベントを発生順に取得"""
+        return [event for event in self.events.get(guild_id, []) if since <= event[0] < until]
+
+    # Retention
+    # メモリ上のデータは容量を測定しないため、容量は常に0
+    async def get_departed_guild_ids(self, before: datetime.datetime) -> list:
+        """beforeより前にBOTが退出したサーバーIDのリストを取得"""
+        return [guild_id for guild_id, guild in self.guilds.items() if guild["left_at"] is not None and guild["left_at"] < before]
+
+    async def purge_guild(self, guild_id: int, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """退出したサーバーのデータを削除 (メンバー, 招待履歴, 招待数, イベント, サーバーの順)"""
+        if (guild := self.guilds.get(guild_id)) is None or guild["left_at"] is None or guild["left_at"] >= before:
+            return 0, 0
+        # メモリ上ではロックが発生しないため、一度に削除
+        rows = len(self.members.pop(guild_id, {})) + sum(len(users) for users in self.invited.pop(guild_id, {}).values())
+        rows += len(self.invite_counts.pop(guild_id, {})) + len(self.events.pop(guild_id, []))
+        for index in (self.members_left, self.by_inviter, self.by_code, self.rankings):
+            index.pop(guild_id, None)
+        del self.guilds[guild_id]
+        return rows + 1, 0
+
+    async def purge_departed_members(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前に退出したメンバーのデータを削除"""
+        rows = 0
+        for guild_id, users in self.members_left.items():
+            for user_id in [user_id for user_id, left_at in users.items() if left_at < before][:limit - rows]:
+                del users[user_id]
+                inviter, code = self.members[guild_id].pop(user_id)
+                self.by_inviter.get(guild_id, {}).get(inviter, set()).discard(user_id)
+                self.by_code.get(guild_id, {}).get(code, set()).discard(user_id)
+                rows += 1
+        return rows, 0
+
+    async def purge_events(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前のイベントを削除"""
+        rows = 0
+        for guild_events in self.events.values():
+            if rows >= limit:
+                break
+            # 発生順に並んでいるため、先頭から削除
+            count = next((i for i, event in enumerate(guild_events[:limit - rows]) if event[0] >= before), min(len(guild_events), limit - rows))
+            del guild_events[:count]
+            rows += count
+        return rows, 0
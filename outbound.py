@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from ratelimit import TokenBucket
+
+# 送信処理の優先度 (小さいほど優先)
+PRIORITY_MODERATION = 0  # キック・BAN・招待の削除
+PRIORITY_ROLE = 1  # トリガーによる役職の付与
+PRIORITY_LOG = 2  # ログの送信 (混雑している場合は破棄する)
+PRIORITY_NAMES = {PRIORITY_MODERATION: "moderation", PRIORITY_ROLE: "role", PRIORITY_LOG: "log"}
+
+
+class OutboundAction:
+    """送信待ちの処理"""
+
+    __slots__ = ("guild_id", "route", "priority", "func", "future", "merge_key", "queued_at")
+
+    def __init__(self, guild_id: int, route: str, priority: int, func: Callable[[], Awaitable[Any]], future: asyncio.Future, merge_key: Optional[Hashable]):
+        self.guild_id = guild_id
+        self.route = route
+        self.priority = priority
+        self.func = func
+        self.future = future
+        self.merge_key = merge_key
+        self.queued_at = time.perf_counter()
+
+
+class PriorityGate:
+    """全体の送信頻度を制限し、待っている処理には優先度順にトークンを渡す"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.bucket = TokenBucket(rate, capacity)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # (優先度, 順番, 待っている処理)
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self, priority: int) -> None:
+        if not self._waiters and self.bucket.try_acquire():
+            return
+        self._seq += 1
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._grant())
+        await future
+
+    async def _grant(self) -> None:
+        while self._waiters:
+            await self.bucket.acquire()
+            _, _, future = heapq.heappop(self._waiters)
+            future.set_result(None)
+
+
+class RouteQueue:
+    """同じAPIの経路(ルート)の送信待ちの処理"""
+
+    __slots__ = ("heap", "bucket", "task")
+
+    def __init__(self, rate: float, capacity: int):
+        self.heap: List[Tuple[int, int, OutboundAction]] = []  # (優先度, 順番, 処理)
+        self.bucket = TokenBucket(rate, capacity)
+        self.task: Optional[asyncio.Task] = None
+
+
+class OutboundQueue:
+    """
+    Discordへの送信処理(キック・BAN・役職の付与・ログ)を優先度順に、ルートごとの頻度を制限して実行する
+    サーバーの送信待ちが多い場合は、優先度の低い処理を破棄する
+    """
+
+    def __init__(self, rate: float = 40.0, route_rate: float = 5.0, route_burst: int = 5, guild_limit: int = 200):
+        self.gate = PriorityGate(rate, max(1, int(rate)))  # 全体の頻度制限
+        self.route_rate = route_rate  # ルートごとの1秒あたりの送信回数
+        self.route_burst = route_burst  # ルートごとに連続で送信できる回数
+        self.guild_limit = guild_limit  # サーバーごとの送信待ちの上限 (超えた場合は優先度の低い処理を破棄) 0の場合は破棄しない
+        self.routes: Dict[str, RouteQueue] = {}  # ルートごとの送信待ち {ルート: 送信待ち}
+        self.depth: Dict[int, int] = {}  # サーバーごとの送信待ちの数 {サーバーID: 数}
+        self.merging: Dict[Hashable, OutboundAction] = {}  # まとめられる送信待ちの処理 {まとめるキー: 処理}
+        self._seq = 0
+        self.executed = 0  # 実行した数
+        self.merged = 0  # 送信待ちの同じ処理にまとめた数
+        self.shed = 0  # 混雑のため破棄した数
+        self.errors = 0  # 失敗した数
+        # 優先度ごとの待ち時間 {優先度: [回数, 合計[秒], 最大[秒]]}
+        self.waits: Dict[int, List[float]] = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+
+    async def submit(self, guild_id: int, route: str, func: Callable[[], Awaitable[Any]], priority: int = PRIORITY_LOG, merge_key: Optional[Hashable] = None) -> Any:
+        """
+        送信処理を追加して、実行結果を待つ
+        :param route: 頻度を制限する単位 (例: f"kick:{サーバーID}", f"messages:{チャンネルID}")
+        :param merge_key: 送信待ちの同じキーの処理がある場合は、実行せずにその結果を共有する
+        :return: 処理の結果 (混雑のため破棄した場合はNone)
+        """
+        if merge_key is not None and (action := self.merging.get(merge_key)) is not None:
+            self.merged += 1
+            return await asyncio.shield(action.future)
+        if priority >= PRIORITY_LOG and 0 < self.guild_limit <= self.depth.get(guild_id, 0):
+            self.shed += 1
+            return None
+        action = OutboundAction(guild_id, route, priority, func, asyncio.get_event_loop().create_future(), merge_key)
+        if merge_key is not None:
+            self.merging[merge_key] = action
+        self.depth[guild_id] = self.depth.get(guild_id, 0) + 1
+        if (queue := self.routes.get(route)) is None:
+            queue = self.routes[route] = RouteQueue(self.route_rate, self.route_burst)
+        self._seq += 1
+        heapq.heappush(queue.heap, (priority, self._seq, action))
+        if queue.task is None:
+            queue.task = asyncio.ensure_future(self._run_route(route, queue))
+        return await asyncio.shield(action.future)
+
+    async def _run_route(self, route: str, queue: RouteQueue) -> None:
+        while queue.heap:
+            await queue.bucket.acquire()
+            await self.gate.acquire(queue.heap[0][0])
+            # 待っている間に追加された、より優先度の高い処理を先に取り出す
+            _, _, action = heapq.heappop(queue.heap)
+            if action.merge_key is not None:
+                del self.merging[action.merge_key]
+            if (depth := self.depth[action.guild_id] - 1) > 0:
+                self.depth[action.guild_id] = depth
+            else:
+                del self.depth[action.guild_id]
+            wait = time.perf_counter() - action.queued_at
+            stats = self.waits[action.priority]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            asyncio.ensure_future(self._execute(action))
+        # 送信待ちがなくなったルートは削除
+        del self.routes[route]
+
+    async def _execute(self, action: OutboundAction) -> None:
+        try:
+            result = await action.func()
+        except Exception as e:
+            self.errors += 1
+            action.future.set_exception(e)
+            action.future.exception()  # 待っている処理がない場合に警告を出さない
+        else:
+            self.executed += 1
+            action.future.set_result(result)
+
+    def get_stats(self, top: int = 5) -> dict:
+        """送信待ちの数 (送信待ちの多いサーバー上位top件) と、優先度ごとの待ち時間を取得"""
+        return {
+            "queued": sum(self.depth.values()),
+            "routes": len(self.routes),
+            "guilds": sorted(self.depth.items(), key=lambda item: item[1], reverse=True)[:top],
+            "executed": self.executed,
+            "merged": self.merged,
+            "shed": self.shed,
+            "errors": self.errors,
+            "waits": {PRIORITY_NAMES[priority]: {"count": int(count), "avg": total / count if count else 0.0, "max": wait_max}
+                      for priority, (count, total, wait_max) in self.waits.items()},
+        }
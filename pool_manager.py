@@ -0,0 +1,132 @@
+import asyncio
+import contextlib
+import dataclasses
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import asyncpg
+
+
+@dataclasses.dataclass(frozen=True)
+class PoolConfig:
+    min_size: int = 2  # 常に確保しておく接続数
+    max_size: int = 10  # 最大接続数
+    command_timeout: float = 10.0  # 1回の問い合わせの制限時間[秒]
+    acquire_timeout: float = 5.0  # 接続を取得するまでの制限時間[秒]
+    max_queries: int = 50000  # この回数問い合わせた接続は作り直す
+    max_inactive_connection_lifetime: float = 300.0  # この時間使われなかった接続は閉じる[秒]
+    max_lifetime: float = 3600.0  # 作成からこの時間が経った接続は、使い終わった際に閉じて作り直す[秒] (0の場合は作り直さない)
+    statement_cache_size: int = 100  # 接続ごとに準備済みのまま保持するSQLの数 (QUERIESの数以上にする)
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        """環境変数 (DB_POOL_MIN, DB_POOL_MAX, DB_COMMAND_TIMEOUT, DB_ACQUIRE_TIMEOUT, DB_MAX_QUERIES, DB_MAX_IDLE, DB_MAX_LIFETIME, DB_STATEMENT_CACHE_SIZE) から設定を作成"""
+        return cls(
+            min_size=int(os.getenv("DB_POOL_MIN", cls.min_size)),
+            max_size=int(os.getenv("DB_POOL_MAX", cls.max_size)),
+            command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", cls.command_timeout)),
+            acquire_timeout=float(os.getenv("DB_ACQUIRE_TIMEOUT", cls.acquire_timeout)),
+            max_queries=int(os.getenv("DB_MAX_QUERIES", cls.max_queries)),
+            max_inactive_connection_lifetime=float(os.getenv("DB_MAX_IDLE", cls.max_inactive_connection_lifetime)),
+            max_lifetime=float(os.getenv("DB_MAX_LIFETIME", cls.max_lifetime)),
+            statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", cls.statement_cache_size)),
+        )
+
+
+class PoolManager:
+    """接続プールを作成し、接続の取得待ち時間や使用中の接続数を記録する"""
+
+    def __init__(self, database_url: str, config: PoolConfig, init: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = None):
+        self.database_url = database_url
+        self.config = config
+        self.init = init  # 新しい接続を作成した際に実行する処理
+        self.pool: Optional[asyncpg.pool.Pool] = None
+        self.in_use = 0  # 使用中の接続数
+        self.waiting = 0  # 接続の取得を待っている数
+        self.acquired = 0  # 接続を取得した回数
+        self.timeouts = 0  # 接続の取得が制限時間を超えた回数
+        self.wait_total = 0.0  # 接続の取得待ち時間の合計[秒]
+        self.wait_max = 0.0  # 接続の取得待ち時間の最大[秒]
+        self.created: Dict[int, float] = {}  # 接続を作成した時刻 {接続のPID: time.monotonic()}
+        self.recycled = 0  # 作成から時間が経ったため作り直した接続の数
+
+    async def open(self, loop: asyncio.AbstractEventLoop) -> asyncpg.pool.Pool:
+        """接続プールを作成"""
+        self.pool = await asyncpg.create_pool(
+            self.database_url,
+            loop=loop,
+            init=self._init_connection,
+            min_size=self.config.min_size,
+            max_size=self.config.max_size,
+            command_timeout=self.config.command_timeout,
+            max_queries=self.config.max_queries,
+            max_inactive_connection_lifetime=self.config.max_inactive_connection_lifetime,
+            statement_cache_size=self.config.statement_cache_size,
+        )
+        return self.pool
+
+    async def _init_connection(self, con: asyncpg.Connection) -> None:
+        """新しい接続の作成時刻を記録して、initを実行"""
+        pid = con.get_server_pid()
+        created = self.created[pid] = time.monotonic()
+
+        def forget(_: asyncpg.Connection) -> None:
+            # 同じPIDの新しい接続が既に登録済みの場合は削除しない
+            if self.created.get(pid) == created:
+                del self.created[pid]
+
+        con.add_termination_listener(forget)
+        if self.init is not None:
+            await self.init(con)
+
+    def _expired(self, con: asyncpg.Connection) -> bool:
+        """作成からmax_lifetimeが経った接続か (使用中の接続は閉じずに、使い終わった際に確認する)"""
+        if self.config.max_lifetime <= 0 or con.is_closed():
+            return False
+        created = self.created.get(con.get_server_pid())
+        return created is not None and time.monotonic() - created >= self.config.max_lifetime
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """接続を取得 (制限時間を超えた場合はasyncio.TimeoutError)"""
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            con = await self.pool.acquire(timeout=self.config.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+        wait = time.perf_counter() - start
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.in_use += 1
+        try:
+            yield con
+        finally:
+            self.in_use -= 1
+            if self._expired(con):
+                # 閉じた接続を返すと、接続プールは次に取得された際に新しい接続を作成する
+                self.recycled += 1
+                try:
+                    await con.close(timeout=self.config.command_timeout)
+                except Exception:
+                    con.terminate()
+            await self.pool.release(con)
+
+    def get_stats(self) -> dict:
+        """接続プールの使用状況を取得"""
+        return {
+            "size": self.pool.get_size() if self.pool is not None else 0,
+            "max_size": self.config.max_size,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "wait_max": self.wait_max,
+            "recycled": self.recycled,
+        }
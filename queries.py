@@ -0,0 +1,311 @@
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set
+
+import asyncpg
+
+# 招待履歴を保存するテーブル (server.usersのJSONBを正規化したもの)
+SCHEMA = """
+    ALTER TABLE server ADD COLUMN IF NOT EXISTS users_migrated boolean NOT NULL DEFAULT false;
+    -- BOTがサーバーから退出した日時 (保持期間を過ぎたら削除)
+    ALTER TABLE server ADD COLUMN IF NOT EXISTS left_at timestamptz;
+    CREATE TABLE IF NOT EXISTS member (
+        guild_id bigint NOT NULL,
+        user_id bigint NOT NULL,
+        inviter bigint,
+        code text,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    -- 招待者・招待コードから参加者を逆引きするためのインデックス
+    CREATE INDEX IF NOT EXISTS member_inviter_idx ON member (guild_id, inviter) WHERE inviter IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS member_code_idx ON member (guild_id, code) WHERE code IS NOT NULL;
+    -- メンバーがサーバーから退出した日時 (保持期間を過ぎたら削除)
+    ALTER TABLE member ADD COLUMN IF NOT EXISTS left_at timestamptz;
+    CREATE INDEX IF NOT EXISTS member_left_idx ON member (left_at) WHERE left_at IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS invited (
+        guild_id bigint NOT NULL,
+        inviter bigint NOT NULL,
+        invited bigint NOT NULL,
+        PRIMARY KEY (guild_id, inviter, invited)
+    );
+    -- 招待数のランキング用に、招待者ごとの招待数を参加時に加算して保存
+    DO $$ BEGIN
+        IF to_regclass('invite_count') IS NULL THEN
+            CREATE TABLE invite_count (
+                guild_id bigint NOT NULL,
+                user_id bigint NOT NULL,
+                count integer NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, user_id)
+            );
+            CREATE INDEX invite_count_rank_idx ON invite_count (guild_id, count DESC, user_id);
+            INSERT INTO invite_count (guild_id, user_id, count) SELECT guild_id, inviter, count(*) FROM invited GROUP BY guild_id, inviter;
+        END IF;
+    END $$;
+    -- 参加・退出・招待の作成/削除の履歴 (追記のみ, 月ごとのパーティションに分割)
+    CREATE TABLE IF NOT EXISTS event (
+        created_at timestamptz NOT NULL,
+        guild_id bigint NOT NULL,
+        kind text NOT NULL,
+        user_id bigint,
+        inviter bigint,
+        code text
+    ) PARTITION BY RANGE (created_at);
+    CREATE INDEX IF NOT EXISTS event_guild_idx ON event (guild_id, created_at);
+    -- 指定した日時を含む月のパーティション(event_YYYYMM)を作成
+    CREATE OR REPLACE FUNCTION create_event_partition(ts timestamptz) RETURNS void AS $$
+    DECLARE
+        month_start timestamptz := date_trunc('month', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    BEGIN
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF event FOR VALUES FROM (%L) TO (%L)',
+                       'event_' || to_char(month_start AT TIME ZONE 'UTC', 'YYYYMM'), month_start, month_start + interval '1 month');
+    END $$ LANGUAGE plpgsql;
+    -- 全ての期間がcutoffより前のパーティションを古い順に1つ削除して、削除したパーティションの行数と容量を返す
+    -- (統計情報のreltuplesは集計前のパーティションでは0になるため、削除前に行数を数える)
+    CREATE OR REPLACE FUNCTION drop_event_partitions(cutoff timestamptz) RETURNS TABLE (dropped_rows bigint, dropped_bytes bigint) AS $$
+    DECLARE
+        part record;
+    BEGIN
+        FOR part IN
+            SELECT c.relname, pg_total_relation_size(c.oid) AS size
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'event'::regclass
+              AND (to_date(substr(c.relname, 7), 'YYYYMM') + interval '1 month') AT TIME ZONE 'UTC' <= cutoff
+            ORDER BY c.relname LIMIT 1
+        LOOP
+            EXECUTE format('SELECT count(*) FROM %I', part.relname) INTO dropped_rows;
+            EXECUTE format('DROP TABLE %I', part.relname);
+            dropped_bytes := part.size;
+            RETURN NEXT;
+        END LOOP;
+    END $$ LANGUAGE plpgsql;
+"""
+
+# 使用するSQLの一覧 {名前: SQL}
+# 値は全てパラメーター($1, $2...)で渡し、SQLの文字列は固定にする
+QUERIES = {
+    # Guild
+    "get_guild_ids": "SELECT array_agg(id) FROM server;",
+    "get_guild_settings": "SELECT id, channel FROM server;",
+    "get_log_channel_id": "SELECT channel FROM server WHERE id = $1;",
+    "enable_guild": "UPDATE server SET channel = $2 WHERE id = $1;",
+    "disable_guild": "UPDATE server SET channel = null WHERE id = $1;",
+    "is_registered_guild": "SELECT EXISTS (SELECT 1 FROM server WHERE id = $1);",
+    # 新しいサーバーは旧形式のデータがないため移行済みとして登録
+    "register_new_guilds": "INSERT INTO server (id, users_migrated) SELECT unnest($1::bigint[]), true ON CONFLICT DO NOTHING RETURNING id;",
+    "get_enabled_guild_ids": "SELECT array_agg(id) FROM server WHERE channel IS NOT NULL;",
+    "get_guild_users_count": "SELECT count(*) FROM member WHERE guild_id = $1;",
+    "get_guild_users": "SELECT array_agg(user_id) FROM member WHERE guild_id = $1;",
+    "set_guilds_left": "UPDATE server SET left_at = now() WHERE id = ANY($1::bigint[]) AND left_at IS NULL;",
+    "set_guilds_returned": "UPDATE server SET left_at = NULL WHERE id = ANY($1::bigint[]) AND left_at IS NOT NULL;",
+    # Trigger
+    # SELECT array_agg(keys) FROM () r // keysを配列に整形して表示 (名前をつけないといけないため任意の名前r(AS r)を追加)
+    # SELECT jsonb_object_keys(code_trigger) AS keys FROM server WHERE id = $1 // code_triggerのキー一覧を取得してkeysという名前で保存
+    "get_code_trigger_list": "SELECT array_agg(keys) FROM (SELECT jsonb_object_keys(code_trigger) AS keys FROM server WHERE id = $1) r;",
+    "get_code_trigger_count": "SELECT count(keys) FROM (SELECT jsonb_object_keys(code_trigger) AS keys FROM server WHERE id = $1) r;",
+    "get_code_trigger_roles": "SELECT code_trigger->>$2::text AS f FROM server WHERE id = $1;",
+    # jsonb_set(code_trigger, {code}, roles) // [code_trigger][code] = roles
+    "add_code_trigger": "UPDATE server SET code_trigger = jsonb_set(code_trigger, ARRAY[$2::text], $3::jsonb) WHERE id = $1;",
+    # code_trigger - code // code_triggerの中のキーがcodeである要素を削除
+    "remove_code_trigger": "UPDATE server SET code_trigger = code_trigger - $2::text WHERE id = $1;",
+    "get_user_trigger_list": "SELECT array_agg(keys) FROM (SELECT jsonb_object_keys(user_trigger) AS keys FROM server WHERE id = $1) r;",
+    "get_user_trigger_count": "SELECT count(keys) FROM (SELECT jsonb_object_keys(user_trigger) AS keys FROM server WHERE id = $1) r;",
+    "get_user_trigger_roles": "SELECT user_trigger->>$2::text AS f FROM server WHERE id = $1;",
+    "add_user_trigger": "UPDATE server SET user_trigger = jsonb_set(user_trigger, ARRAY[$2::text], $3::jsonb) WHERE id = $1;",
+    "remove_user_trigger": "UPDATE server SET user_trigger = user_trigger - $2::text WHERE id = $1;",
+    # Invites
+    # 参加履歴の記録 (招待者の登録, 招待履歴の追加, 招待元と招待コードの保存)
+    "record_join": """
+        WITH inviter_row AS (
+            INSERT INTO member (guild_id, user_id) SELECT $1::bigint, $2::bigint WHERE $2::bigint <> $3::bigint
+            ON CONFLICT DO NOTHING
+        ), edge AS (
+            INSERT INTO invited (guild_id, inviter, invited) VALUES ($1, $2, $3)
+            ON CONFLICT DO NOTHING RETURNING inviter
+        ), counter AS (
+            -- 招待履歴が新しく追加された場合のみ招待数を加算
+            INSERT INTO invite_count (guild_id, user_id, count) SELECT $1, inviter, 1 FROM edge
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET count = invite_count.count + 1
+        )
+        INSERT INTO member (guild_id, user_id, inviter, code) VALUES ($1, $3, $2, $4)
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET inviter = excluded.inviter, code = excluded.code, left_at = NULL;
+    """,
+    # User
+    "register_new_user": "INSERT INTO member (guild_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING;",
+    "mark_member_left": "UPDATE member SET left_at = now() WHERE guild_id = $1 AND user_id = $2;",
+    "reset_users_data": """
+        WITH counter AS (DELETE FROM invite_count WHERE guild_id = $1 AND user_id = ANY($2::bigint[]))
+        DELETE FROM invited WHERE guild_id = $1 AND inviter = ANY($2::bigint[]);
+    """,
+    "reset_guild_users_data": """
+        WITH counter AS (DELETE FROM invite_count WHERE guild_id = $1)
+        DELETE FROM invited WHERE guild_id = $1;
+    """,
+    "get_user_invite_count": "SELECT count FROM invite_count WHERE guild_id = $1 AND user_id = $2;",
+    # 招待数の多い順 (invite_count_rank_idxを使うため、件数分だけ読む)
+    "get_leaderboard": """
+        SELECT user_id, count FROM invite_count WHERE guild_id = $1 AND count > 0
+        ORDER BY count DESC, user_id LIMIT $2;
+    """,
+    # 前のページの最後の行 (招待数$3, ユーザーID$4) の次から (OFFSETのように読み飛ばす行を読まない)
+    "get_leaderboard_after": """
+        SELECT user_id, count FROM invite_count WHERE guild_id = $1 AND count > 0 AND (count < $3 OR (count = $3 AND user_id > $4))
+        ORDER BY count DESC, user_id LIMIT $2;
+    """,
+    "get_user_invite_from": "SELECT inviter FROM member WHERE guild_id = $1 AND user_id = $2;",
+    "get_user_invite_code": "SELECT code FROM member WHERE guild_id = $1 AND user_id = $2;",
+    "is_registered_user": "SELECT EXISTS (SELECT 1 FROM member WHERE guild_id = $1 AND user_id = $2);",
+    # 招待コードと招待者でそれぞれインデックスを使うため、ORではなくUNIONで結合
+    "filter_with_code_and_from": """
+        SELECT user_id FROM member WHERE guild_id = $1 AND code = ANY($2::text[])
+        UNION
+        SELECT user_id FROM member WHERE guild_id = $1 AND inviter = ANY($3::bigint[]);
+    """,
+    # Event
+    "create_event_partitions": "SELECT create_event_partition(month) FROM unnest($1::timestamptz[]) month;",
+    # 1回の問い合わせでまとめて追記 (列ごとの配列で渡す)
+    "record_events": """
+        INSERT INTO event (created_at, guild_id, kind, user_id, inviter, code)
+        SELECT * FROM unnest($1::timestamptz[], $2::bigint[], $3::text[], $4::bigint[], $5::bigint[], $6::text[]);
+    """,
+    # 期間で対象のパーティションだけを読む
+    "get_events": """
+        SELECT created_at, guild_id, kind, user_id, inviter, code FROM event
+        WHERE guild_id = $1 AND created_at >= $2 AND created_at < $3 ORDER BY created_at;
+    """,
+    # Retention
+    # 削除は$2件ずつ行い、1回のロック時間を短くする (削除した行数と容量を返す)
+    "get_departed_guild_ids": "SELECT array_agg(id) FROM server WHERE left_at < $1;",
+    "purge_departed_members": """
+        WITH deleted AS (
+            DELETE FROM member WHERE (guild_id, user_id) IN (SELECT guild_id, user_id FROM member WHERE left_at < $1 LIMIT $2)
+            RETURNING pg_column_size(member.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    "purge_events": "SELECT COALESCE(sum(dropped_rows), 0)::bigint AS deleted_rows, COALESCE(sum(dropped_bytes), 0)::bigint AS deleted_bytes FROM drop_event_partitions($1);",
+    # 削除中にBOTが再参加した場合は残りを削除しない
+    "purge_guild_members": """
+        WITH deleted AS (
+            DELETE FROM member WHERE (guild_id, user_id) IN (
+                SELECT guild_id, user_id FROM member WHERE guild_id = $1 AND EXISTS (SELECT 1 FROM server WHERE id = $1 AND left_at < $3) LIMIT $2
+            ) RETURNING pg_column_size(member.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    "purge_guild_invited": """
+        WITH deleted AS (
+            DELETE FROM invited WHERE (guild_id, inviter, invited) IN (
+                SELECT guild_id, inviter, invited FROM invited WHERE guild_id = $1 AND EXISTS (SELECT 1 FROM server WHERE id = $1 AND left_at < $3) LIMIT $2
+            ) RETURNING pg_column_size(invited.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    "purge_guild_invite_count": """
+        WITH deleted AS (
+            DELETE FROM invite_count WHERE (guild_id, user_id) IN (
+                SELECT guild_id, user_id FROM invite_count WHERE guild_id = $1 AND EXISTS (SELECT 1 FROM server WHERE id = $1 AND left_at < $3) LIMIT $2
+            ) RETURNING pg_column_size(invite_count.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    # パーティションごとに行の位置(ctid)が重複するため、テーブル(tableoid)と組み合わせて指定
+    "purge_guild_events": """
+        WITH deleted AS (
+            DELETE FROM event WHERE (tableoid, ctid) IN (
+                SELECT tableoid, ctid FROM event WHERE guild_id = $1 AND EXISTS (SELECT 1 FROM server WHERE id = $1 AND left_at < $3) LIMIT $2
+            ) RETURNING pg_column_size(event.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    "purge_guild": """
+        WITH deleted AS (
+            DELETE FROM server WHERE id = $1 AND left_at < $2 RETURNING pg_column_size(server.*) AS size
+        ) SELECT count(*) AS deleted_rows, COALESCE(sum(size), 0)::bigint AS deleted_bytes FROM deleted;
+    """,
+    # Migration
+    "get_legacy_guild_ids": "SELECT array_agg(id) FROM server WHERE NOT users_migrated;",
+    # 移行中に同じサーバーの移行が重複しないように行をロック
+    "lock_legacy_guild": "SELECT users_migrated FROM server WHERE id = $1 FOR UPDATE;",
+    # 移行開始後に書き込まれた新しいデータを優先するため、重複時は何もしない
+    "migrate_legacy_members": """
+        INSERT INTO member (guild_id, user_id, inviter, code)
+        SELECT $1, key::bigint, (value->>'from')::bigint, value->>'code'
+        FROM server, jsonb_each(users) WHERE id = $1
+        ON CONFLICT DO NOTHING;
+    """,
+    "migrate_legacy_invited": """
+        INSERT INTO invited (guild_id, inviter, invited)
+        SELECT $1, key::bigint, jsonb_array_elements_text(COALESCE(value->'to', '[]'::jsonb))::bigint
+        FROM server, jsonb_each(users) WHERE id = $1
+        ON CONFLICT DO NOTHING;
+    """,
+    "migrate_legacy_invite_count": """
+        INSERT INTO invite_count (guild_id, user_id, count)
+        SELECT guild_id, inviter, count(*) FROM invited WHERE guild_id = $1 GROUP BY guild_id, inviter
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET count = excluded.count;
+    """,
+    "finish_legacy_guild": "UPDATE server SET users_migrated = true WHERE id = $1;",
+}
+
+
+class StatementRegistry:
+    """
+    QUERIESのSQLを名前で実行し、解析・実行計画の作成の再利用率を記録する
+    SQLの文字列は固定のため、asyncpgの接続ごとのステートメントキャッシュ(statement_cache_size)で準備済みのものが使い回される
+    (PreparedStatementは取得した接続をプールに戻すと使えなくなるため、保持しない)
+    """
+
+    def __init__(self, queries: Dict[str, str]):
+        self.queries = queries
+        # 実行したことのあるSQL {接続のバックエンドPID: {名前, ...}} (接続が閉じられたら削除)
+        self.seen: Dict[int, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.prepare_time = 0.0  # 接続ごとの初回の実行(準備を含む)にかかった合計時間[秒]
+
+    async def init_connection(self, con: asyncpg.Connection) -> None:
+        """新しい接続を登録 (プールのinitに指定)"""
+        pid = con.get_server_pid()
+        seen = self.seen[pid] = set()
+
+        def forget(_: asyncpg.Connection) -> None:
+            # プールが接続を作り直した場合に、閉じた接続の記録が残り続けないように削除
+            # (同じPIDの新しい接続が既に登録済みの場合は削除しない)
+            if self.seen.get(pid) is seen:
+                del self.seen[pid]
+
+        con.add_termination_listener(forget)
+
+    async def fetch(self, con: asyncpg.Connection, name: str, *args) -> List[asyncpg.Record]:
+        """SQLを実行して全ての行を取得"""
+        return await self._run(con, name, con.fetch, *args)
+
+    async def fetchrow(self, con: asyncpg.Connection, name: str, *args) -> Optional[asyncpg.Record]:
+        """SQLを実行して最初の行を取得"""
+        return await self._run(con, name, con.fetchrow, *args)
+
+    async def fetchval(self, con: asyncpg.Connection, name: str, *args):
+        """SQLを実行して最初の値を取得"""
+        return await self._run(con, name, con.fetchval, *args)
+
+    async def executemany(self, con: asyncpg.Connection, name: str, args: Iterable[Sequence]) -> None:
+        """SQLを複数の引数でまとめて実行"""
+        await self._run(con, name, con.executemany, args)
+
+    async def _run(self, con: asyncpg.Connection, name: str, method: Callable[..., Awaitable[Any]], *args) -> Any:
+        seen = self.seen.setdefault(con.get_server_pid(), set())
+        if name in seen:  # この接続で準備済み
+            self.hits += 1
+            return await method(self.queries[name], *args)
+        start = time.perf_counter()
+        res = await method(self.queries[name], *args)
+        self.misses += 1
+        self.prepare_time += time.perf_counter() - start
+        seen.add(name)
+        return res
+
+    def get_stats(self) -> dict:
+        """ステートメントの再利用率と準備時間を取得"""
+        total = self.hits + self.misses
+        return {
+            "statements": len(self.queries),
+            "connections": len(self.seen),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "prepare_time": self.prepare_time,
+        }
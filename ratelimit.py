@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+
+import discord
+
+# 招待の取得の優先度 (小さいほど優先)
+PRIORITY_JOIN = 0  # メンバーの参加 (招待者の判定を待っている)
+PRIORITY_COMMAND = 1  # コマンド・招待のイベント
+PRIORITY_RECONCILE = 2  # 招待キャッシュの定期確認
+PRIORITY_WARMUP = 3  # 起動時の招待キャッシュの作成
+PRIORITY_NAMES = {PRIORITY_JOIN: "join", PRIORITY_COMMAND: "command", PRIORITY_RECONCILE: "reconcile", PRIORITY_WARMUP: "warmup"}
+
+
+class TokenBucket:
+    """一定の速度で回復するトークンを使って、リクエストの頻度を制限する"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate  # 1秒あたりに回復するトークン数
+        self.capacity = capacity  # 溜められる最大のトークン数 (連続で送れるリクエスト数)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """トークンがある場合は1つ使う (待たない) 使った場合はTrue"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        """トークンを1つ使う (足りない場合は回復するまで待つ)"""
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchRequest:
+    """取得待ちのリクエスト (同じサーバーのリクエストはまとめる)"""
+
+    __slots__ = ("guild", "priority", "future", "queued_at")
+
+    def __init__(self, guild: discord.Guild, priority: int, future: asyncio.Future):
+        self.guild = guild
+        self.priority = priority
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class InviteFetchScheduler:
+    """guild.invites()の取得を優先度順に、トークンバケットで頻度を制限して実行する"""
+
+    def __init__(self, rate: float = 10.0, burst: int = 20):
+        self.bucket = TokenBucket(rate, burst)
+        self.queued: Dict[int, FetchRequest] = {}  # 取得待ちのリクエスト {サーバーID: リクエスト}
+        self._heap: List[Tuple[int, int, FetchRequest]] = []  # (優先度, 順番, リクエスト) 優先度が変わった場合は古い要素を読み飛ばす
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.in_flight = 0  # 取得中の数
+        self.fetched = 0  # 取得した回数
+        self.merged = 0  # 取得待ちのリクエストにまとめた回数
+        self.errors = 0  # 取得に失敗した回数
+        # 優先度ごとの待ち時間 {優先度: [回数, 合計[秒], 最大[秒]]}
+        self.waits: Dict[int, List[float]] = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+
+    async def fetch(self, guild: discord.Guild, priority: int = PRIORITY_COMMAND) -> List[discord.Invite]:
+        """サーバーの招待を取得 (取得待ちの同じサーバーのリクエストがある場合は結果を共有)"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        if (request := self.queued.get(guild.id)) is not None:
+            self.merged += 1
+            if priority < request.priority:  # より優先度の高いリクエストにまとめられた場合は順番を上げる
+                request.priority = priority
+                self._push(request)
+        else:
+            request = self.queued[guild.id] = FetchRequest(guild, priority, asyncio.get_event_loop().create_future())
+            self._push(request)
+        return await asyncio.shield(request.future)
+
+    def _push(self, request: FetchRequest) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (request.priority, self._seq, request))
+        self._wakeup.set()
+
+    def _pop(self) -> Optional[FetchRequest]:
+        while self._heap:
+            priority, _, request = heapq.heappop(self._heap)
+            if self.queued.get(request.guild.id) is request and request.priority == priority:
+                del self.queued[request.guild.id]
+                return request
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            if not self.queued:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            # トークンを待っている間に追加された、より優先度の高いリクエストを先に取り出す
+            if (request := self._pop()) is None:
+                continue
+            wait = time.perf_counter() - request.queued_at
+            stats = self.waits[request.priority]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            asyncio.ensure_future(self._fetch(request))
+
+    async def _fetch(self, request: FetchRequest) -> None:
+        self.in_flight += 1
+        try:
+            invites = await request.guild.invites()
+        except Exception as e:
+            self.errors += 1
+            request.future.set_exception(e)
+            request.future.exception()  # 待っている処理がない場合に警告を出さない
+        else:
+            self.fetched += 1
+            request.future.set_result(invites)
+        finally:
+            self.in_flight -= 1
+
+    def get_stats(self) -> dict:
+        """取得待ちの数と、優先度ごとの待ち時間を取得"""
+        return {
+            "queued": len(self.queued),
+            "in_flight": self.in_flight,
+            "fetched": self.fetched,
+            "merged": self.merged,
+            "errors": self.errors,
+            "tokens": self.bucket.tokens,
+            "waits": {PRIORITY_NAMES[priority]: {"count": int(count), "avg": total / count if count else 0.0, "max": wait_max}
+                      for priority, (count, total, wait_max) in self.waits.items()},
+        }
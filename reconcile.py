@@ -0,0 +1,166 @@
+import asyncio
+import dataclasses
+import heapq
+import os
+import random
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import discord
+
+from invite_cache import InviteCache, InviteSnapshot
+from join_coalescer import JoinCoalescer
+
+
+@dataclasses.dataclass(frozen=True)
+class ReconcilePolicy:
+    min_interval: float = 600.0  # 招待の取得し直しの最短間隔[秒] (参加が多いサーバー・差異が見つかったサーバー)
+    max_interval: float = 21600.0  # 招待の取得し直しの最長間隔[秒] (参加がなく差異もないサーバー)
+    budget: float = 30.0  # 全サーバーで1分あたりに取得し直す最大回数 (0の場合は取得し直さない)
+
+    @classmethod
+    def from_env(cls) -> "ReconcilePolicy":
+        """環境変数 (RECONCILE_MIN_INTERVAL, RECONCILE_MAX_INTERVAL, RECONCILE_BUDGET) から設定を作成"""
+        return cls(
+            min_interval=float(os.getenv("RECONCILE_MIN_INTERVAL", cls.min_interval)),
+            max_interval=float(os.getenv("RECONCILE_MAX_INTERVAL", cls.max_interval)),
+            budget=float(os.getenv("RECONCILE_BUDGET", cls.budget)),
+        )
+
+
+class InviteReconciler:
+    """イベントの取りこぼしで古くなった招待キャッシュを、サーバーの活発さに応じた間隔で取得し直す"""
+
+    def __init__(self, cache: InviteCache, coalescer: JoinCoalescer, get_guild: Callable[[int], Optional[discord.Guild]],
+                 fetch: Callable[[discord.Guild], Awaitable[Optional[InviteSnapshot]]], on_drift: Callable[[int, List[str]], Awaitable[None]],
+                 policy: ReconcilePolicy):
+        self.cache = cache  # 招待キャッシュ {サーバーID: 招待キャッシュ}
+        self.coalescer = coalescer  # 参加時の取得と同時に取得し直さないためのロックと、参加日時
+        self.get_guild = get_guild
+        self.fetch = fetch  # 招待を全て取得する処理 (招待キャッシュは更新しない)
+        self.on_drift = on_drift  # 差異が見つかった際の処理 (サーバーID, 差異があった招待コード)
+        self.policy = policy
+        self.intervals: Dict[int, float] = {}  # サーバーごとの取得し直す間隔[秒] {サーバーID: 間隔}
+        self.due: Dict[int, float] = {}  # 次に取得し直す時刻 {サーバーID: time.monotonic()}
+        self.checked: Dict[int, float] = {}  # 前回取得し直した時刻 {サーバーID: time.monotonic()}
+        self.touched: Dict[int, float] = {}  # 最後に招待のイベントがあった時刻 {サーバーID: time.monotonic()}
+        self._heap: List[Tuple[float, int]] = []  # (次に取得し直す時刻, サーバーID) 予定が変わった場合は古い要素を読み飛ばす
+        self._synced = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.checks = 0  # 取得し直した回数
+        self.drifts = 0  # 差異が見つかった回数
+        self.skipped = 0  # 取得中に参加があったため結果を使わなかった回数
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """定期実行を開始"""
+        if self.policy.budget > 0 and self._task is None:
+            self._task = loop.create_task(self._run_loop())
+
+    def stop(self) -> None:
+        """定期実行を停止"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def touch(self, guild_id: int) -> None:
+        """招待のイベントがあったことを記録 (活発なサーバーは短い間隔で取得し直す)"""
+        self.touched[guild_id] = time.monotonic()
+
+    def _last_activity(self, guild_id: int) -> float:
+        return max(self.coalescer.last_join.get(guild_id, 0.0), self.touched.get(guild_id, 0.0))
+
+    def _schedule(self, guild_id: int, due: float) -> None:
+        self.due[guild_id] = due
+        heapq.heappush(self._heap, (due, guild_id))
+
+    def _sync(self, now: float) -> None:
+        """招待キャッシュがあるサーバーを予定に追加 (一斉に取得し直さないように最初の時刻はばらつかせる)"""
+        for guild_id in self.cache.keys() - self.due.keys():
+            self.intervals[guild_id] = self.policy.min_interval
+            self._schedule(guild_id, now + random.uniform(0, self.policy.min_interval))
+        self._synced = now
+
+    def _pop(self) -> Optional[Tuple[float, int]]:
+        while self._heap:
+            due, guild_id = self._heap[0]
+            if self.due.get(guild_id) != due:
+                heapq.heappop(self._heap)
+            elif guild_id not in self.cache:  # 無効化・退出したサーバー
+                heapq.heappop(self._heap)
+                for state in (self.due, self.intervals, self.checked, self.touched):
+                    state.pop(guild_id, None)
+            else:
+                return due, guild_id
+        return None
+
+    async def reconcile(self, guild_id: int) -> Optional[List[str]]:
+        """
+        サーバーの招待を取得し直して招待キャッシュと比較
+        :return: 差異があった招待コード (取得しなかった場合や、取得中に参加があった場合はNone)
+        """
+        if (guild := self.get_guild(guild_id)) is None or self.coalescer.busy(guild_id):
+            return None
+        start = time.monotonic()
+        new = await self.fetch(guild)  # 優先度の低い取得を待つ間はロックを保持しない
+        if new is None:
+            return None
+        async with self.coalescer.lock(guild_id):
+            if self.coalescer.last_join.get(guild_id, 0.0) >= start:
+                # 取得中の参加は使用回数に含まれている可能性があるため、参加時の取得に任せる
+                self.skipped += 1
+                return None
+            # 取得し直しは使われた扱いにしない (圧縮されている場合は圧縮したまま)
+            old = self.cache.peek(guild_id)
+            self.cache.replace(guild_id, new)
+        self.checks += 1
+        if old is None:
+            return []
+        # 追加・削除された招待と、使用回数が変わった招待
+        drift = sorted((old.index.keys() ^ new.index.keys()) | old.deltas(new).keys())
+        if drift:
+            self.drifts += 1
+            await self.on_drift(guild_id, drift)
+        return drift
+
+    async def _run_loop(self) -> None:
+        spacing = 60 / self.policy.budget  # 取得し直す最短の間隔[秒]
+        while True:
+            now = time.monotonic()
+            if now - self._synced >= self.policy.min_interval / 10:
+                self._sync(now)
+            if (item := self._pop()) is None or item[0] > now:
+                await asyncio.sleep(max(spacing, min(item[0] - now, self.policy.min_interval / 10)) if item else spacing)
+                continue
+            _, guild_id = item
+            del self.due[guild_id]
+            try:
+                drift = await self.reconcile(guild_id)
+            except Exception:
+                traceback.print_exc()
+                drift = None
+            # 差異があった・前回から参加や招待のイベントがあった場合は間隔を短く、どちらもない場合は長くする
+            interval = self.intervals.get(guild_id, self.policy.min_interval)
+            if drift:
+                interval = self.policy.min_interval
+            elif self._last_activity(guild_id) > self.checked.get(guild_id, 0.0):
+                interval = max(self.policy.min_interval, interval / 2)
+            elif drift is not None:
+                interval = min(self.policy.max_interval, interval * 2)
+            self.intervals[guild_id] = interval
+            self.checked[guild_id] = now
+            self._schedule(guild_id, now + interval)
+            await asyncio.sleep(spacing)
+
+    def get_stats(self) -> dict:
+        """取得し直した回数と、差異が見つかった割合を取得"""
+        intervals = self.intervals.values()
+        return {
+            "guilds": len(self.due),
+            "checks": self.checks,
+            "drifts": self.drifts,
+            "skipped": self.skipped,
+            "drift_rate": self.drifts / self.checks if self.checks else 0.0,
+            "min_interval": min(intervals, default=0.0),
+            "max_interval": max(intervals, default=0.0),
+        }
@@ -0,0 +1,109 @@
+import asyncio
+import dataclasses
+import datetime
+import os
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from storage import Storage
+
+
+@dataclasses.dataclass(frozen=True)
+class RetentionPolicy:
+    """データを削除する保持期間 (既定では何も削除しない, 削除する場合は環境変数で日数を指定)"""
+    guild_days: float = 0.0  # BOTが退出したサーバーのデータを残す日数 (0の場合は削除しない)
+    member_days: float = 0.0  # 退出したメンバーのデータを残す日数 (0の場合は削除しない)
+    event_days: float = 0.0  # イベント履歴を残す日数 (0の場合は削除しない)
+    batch_size: int = 1000  # 1回で削除する行数
+    batch_interval: float = 0.1  # 削除の間隔[秒]
+    interval: float = 86400.0  # 実行間隔[秒]
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        """環境変数 (RETENTION_GUILD_DAYS, RETENTION_MEMBER_DAYS, RETENTION_EVENT_DAYS, RETENTION_BATCH_SIZE, RETENTION_BATCH_INTERVAL, RETENTION_INTERVAL) から設定を作成"""
+        return cls(
+            guild_days=float(os.getenv("RETENTION_GUILD_DAYS", cls.guild_days)),
+            member_days=float(os.getenv("RETENTION_MEMBER_DAYS", cls.member_days)),
+            event_days=float(os.getenv("RETENTION_EVENT_DAYS", cls.event_days)),
+            batch_size=int(os.getenv("RETENTION_BATCH_SIZE", cls.batch_size)),
+            batch_interval=float(os.getenv("RETENTION_BATCH_INTERVAL", cls.batch_interval)),
+            interval=float(os.getenv("RETENTION_INTERVAL", cls.interval)),
+        )
+
+
+class RetentionJob:
+    """保持期間を過ぎたデータを少しずつ削除して、削除した行数とそのサイズを記録する (空いたディスク容量ではない)"""
+
+    def __init__(self, db: Storage, policy: RetentionPolicy):
+        self.db = db
+        self.policy = policy
+        # 前回の結果 {"guilds": サーバー数, 対象: (行数, 削除した行のサイズ[byte]), "time": 所要時間[秒]}
+        self.last_report: Optional[dict] = None
+        self.last_run: Optional[datetime.datetime] = None
+        self.total_rows = 0
+        self.total_bytes = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """定期実行を開始"""
+        if self._task is None:
+            self._task = loop.create_task(self._run_loop())
+
+    def stop(self) -> None:
+        """定期実行を停止"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _purge(self, purge: Callable[[], Awaitable[Tuple[int, int]]]) -> Tuple[int, int]:
+        """削除する行がなくなるまで、間隔を空けて繰り返し削除"""
+        total_rows = total_bytes = 0
+        while True:
+            rows, size = await purge()
+            if not rows and not size:  # 空のパーティションを削除した場合は、サイズのみ返る
+                return total_rows, total_bytes
+            total_rows += rows
+            total_bytes += size
+            await asyncio.sleep(self.policy.batch_interval)
+
+    async def run(self) -> dict:
+        """保持期間を過ぎたデータを削除"""
+        async with self._lock:
+            start = time.perf_counter()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            limit = self.policy.batch_size
+            report: Dict[str, object] = {"guilds": 0, "guild_data": (0, 0), "members": (0, 0), "events": (0, 0)}
+            if self.policy.guild_days > 0:
+                before = now - datetime.timedelta(days=self.policy.guild_days)
+                rows = size = 0
+                for guild_id in await self.db.get_departed_guild_ids(before):
+                    guild_rows, guild_size = await self._purge(lambda: self.db.purge_guild(guild_id, before, limit))
+                    if not await self.db.is_registered_guild(guild_id):
+                        self.db.log_channels.pop(guild_id, None)
+                        report["guilds"] += 1
+                    rows, size = rows + guild_rows, size + guild_size
+                report["guild_data"] = (rows, size)
+            if self.policy.member_days > 0:
+                before = now - datetime.timedelta(days=self.policy.member_days)
+                report["members"] = await self._purge(lambda: self.db.purge_departed_members(before, limit))
+            if self.policy.event_days > 0:
+                before = now - datetime.timedelta(days=self.policy.event_days)
+                report["events"] = await self._purge(lambda: self.db.purge_events(before, limit))
+            report["time"] = time.perf_counter() - start
+            for key in ("guild_data", "members", "events"):
+                self.total_rows += report[key][0]
+                self.total_bytes += report[key][1]
+            self.last_report, self.last_run = report, now
+            return report
+
+    async def _run_loop(self) -> None:
+        while True:
+            try:
+                report = await self.run()
+                print(f"Retention: purged {report['guilds']} servers, {sum(report[key][0] for key in ('guild_data', 'members', 'events'))} rows "
+                      f"({sum(report[key][1] for key in ('guild_data', 'members', 'events')) / 1024:.1f}KiB deleted) in {report['time']:.2f}s")
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.policy.interval)
@@ -1,5 +1,6 @@
 import datetime
 import time
+from typing import Dict, Tuple
 
 import discord
 from discord.ext import commands
@@ -12,8 +13,12 @@ from main import InviteMonitor
 class Setting(commands.Cog):
     """SetUp the bot"""
 
+    LEADERBOARD_PAGE_SIZE = 10  # ランキング1ページあたりの表示人数
+
     def __init__(self, bot):
         self.bot = bot  # type: InviteMonitor
+        # ランキングの各ページの直前の行 {サーバーID: {ページ: (ユーザーID, 招待数)}} (1ページ目を表示した際に作り直す)
+        self.leaderboard_cursors: Dict[int, Dict[int, Tuple[int, int]]] = {}
 
     async def cog_command_error(self, ctx, error):
         if isinstance(error, commands.CommandOnCooldown):
@@ -80,7 +85,7 @@ class Setting(commands.Cog):
             embed.set_author(name=f"{str(target_user)}", icon_url=target_user.avatar_url)
             embed.set_thumbnail(url=target_user.avatar_url)
             embed.description = f"Cached data of <@{target_user.id}>\n\n"
-            if str(target_user.id) in await self.bot.db.get_guild_users(ctx.guild.id):
+            if await self.bot.db.is_registered_user(ctx.guild.id, target_user.id):
                 embed.description += f"`InviteCount:`  {await self.bot.db.get_user_invite_count(ctx.guild.id, target_user.id)}\n"
                 if inviter_id := await self.bot.db.get_user_invite_from(ctx.guild.id, target_user.id):
                     if (inviter := self.bot.get_user(inviter_id)) is None:
@@ -99,6 +104,37 @@ class Setting(commands.Cog):
             embed.description += f"`Joined At  :`  {ctx.guild.get_member(target_user.id).joined_at.strftime('%Y/%m/%d %H:%M:%S')}"
             await ctx.send(embed=embed)
 
+    @commands.command(aliases=["lb", "top"], usage="leaderboard (page)", brief="Top inviters", description="Show users ranked by invite counts in the server. 10 users are shown per page.")
+    @commands.cooldown(1, 3, commands.BucketType.guild)
+    async def leaderboard(self, ctx, page: int = 1):
+        # そのサーバーでログが設定されているか確認
+        if not await self.bot.db.is_enabled_guild(ctx.guild.id):
+            return await warning_embed_builder(ctx, f"Not enabled yet. Please setup by `{self.bot.PREFIX}enable` before checking leaderboard.")
+        page = max(page, 1)
+        if page == 1:
+            self.leaderboard_cursors.pop(ctx.guild.id, None)
+        cursors = self.leaderboard_cursors.setdefault(ctx.guild.id, {})
+        # 前のページの最後の行から取得 (表示していないページは、最も近い表示済みのページから順にたどる)
+        current = max((known for known in cursors if known <= page), default=1)
+        while True:
+            # 次のページがあるか確認するために1件多く取得
+            ranking = await self.bot.db.get_leaderboard(ctx.guild.id, self.LEADERBOARD_PAGE_SIZE + 1, cursors.get(current))
+            if len(ranking) > self.LEADERBOARD_PAGE_SIZE:
+                cursors[current + 1] = ranking[self.LEADERBOARD_PAGE_SIZE - 1]
+            if current == page or len(ranking) <= self.LEADERBOARD_PAGE_SIZE:
+                break
+            current += 1
+        if current != page or not ranking:
+            return await warning_embed_builder(ctx, "No invites recorded on this page.")
+        has_next = len(ranking) > self.LEADERBOARD_PAGE_SIZE
+        embed = discord.Embed(color=0xd3a8ff)
+        embed.set_author(name=f"{ctx.guild.name}", icon_url=ctx.guild.icon_url)
+        embed.description = f"Top inviters of the server **{ctx.guild.name}**\n\n"
+        for rank, (user_id, count) in enumerate(ranking[:self.LEADERBOARD_PAGE_SIZE], start=(page - 1) * self.LEADERBOARD_PAGE_SIZE + 1):
+            embed.description += f"`{rank:>3}.`  <@{user_id}>  **{count}** invites\n"
+        embed.set_footer(text=f"Page {page}" + (f" | Next: {self.bot.PREFIX}leaderboard {page + 1}" if has_next else ""))
+        await ctx.send(embed=embed)
+
     @commands.command(aliases=["info"], usage="about", brief="About the bot", description="Show the information about the bot.")
     @commands.cooldown(1, 3, commands.BucketType.guild)
     async def about(self, ctx):
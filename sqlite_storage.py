@@ -0,0 +1,316 @@
+import datetime
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from storage import Event, Storage
+
+# SQLManagerと同じ構成のテーブル (トリガーはJSON文字列で保存)
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS server (
+        id INTEGER PRIMARY KEY,
+        channel INTEGER,
+        code_trigger TEXT NOT NULL DEFAULT '{}',
+        user_trigger TEXT NOT NULL DEFAULT '{}',
+        left_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS member (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        inviter INTEGER,
+        code TEXT,
+        left_at REAL,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS member_inviter_idx ON member (guild_id, inviter) WHERE inviter IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS member_code_idx ON member (guild_id, code) WHERE code IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS invited (
+        guild_id INTEGER NOT NULL,
+        inviter INTEGER NOT NULL,
+        invited INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, inviter, invited)
+    );
+    CREATE TABLE IF NOT EXISTS invite_count (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS invite_count_rank_idx ON invite_count (guild_id, count DESC, user_id);
+    -- SQLiteにはパーティションがないため、期間の検索はインデックスで行う (発生日時はUNIX時間)
+    CREATE TABLE IF NOT EXISTS event (
+        created_at REAL NOT NULL,
+        guild_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        user_id INTEGER,
+        inviter INTEGER,
+        code TEXT
+    );
+    CREATE INDEX IF NOT EXISTS event_guild_idx ON event (guild_id, created_at);
+"""
+
+
+class SQLiteStorage(Storage):
+    """SQLiteのファイルに保存 (小規模な環境向け, 問い合わせはイベントループ上で同期的に行う)"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+
+    # Connection
+    async def connect(self) -> None:
+        """データベースに接続"""
+        self.connection = sqlite3.connect(self.path, isolation_level=None)  # 自動コミット (まとめる場合はBEGINを使う)
+        self.connection.execute("PRAGMA journal_mode = WAL;")
+        self.connection.executescript(SCHEMA)
+        # 退出日時の列がない古いファイルに列を追加 (日時はUNIX時間)
+        for table in ("server", "member"):
+            if "left_at" not in [column[1] for column in self.connection.execute(f"PRAGMA table_info({table});")]:
+                self.connection.execute(f"ALTER TABLE {table} ADD COLUMN left_at REAL;")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS member_left_idx ON member (left_at) WHERE left_at IS NOT NULL;")
+        await self.load_guild_settings()
+
+    def is_connected(self) -> bool:
+        """データベースに接続しているか確認"""
+        return self.connection is not None
+
+    def _fetchval(self, sql: str, *args):
+        res = self.connection.execute(sql, args).fetchone()
+        return None if res is None else res[0]
+
+    def _fetchcol(self, sql: str, *args) -> list:
+        return [record[0] for record in self.connection.execute(sql, args)]
+
+    # Guild
+    async def get_guild_ids(self) -> list:
+        """登録されているサーバーIDのリストを取得"""
+        return self._fetchcol("SELECT id FROM server;")
+
+    async def _fetch_guild_settings(self) -> Dict[int, Optional[int]]:
+        """全サーバーのログチャンネルIDを取得"""
+        return dict(self.connection.execute("SELECT id, channel FROM server;").fetchall())
+
+    async def _set_log_channel_id(self, guild_id: int, channel_id: Optional[int]) -> None:
+        """ログチャンネルIDを保存 (Noneの場合は無効)"""
+        self.connection.execute("UPDATE server SET channel = ? WHERE id = ?;", (channel_id, guild_id))
+
+    async def is_registered_guild(self, guild_id: int) -> bool:
+        """サーバーが登録されているか確認"""
+        return bool(self._fetchval("SELECT EXISTS (SELECT 1 FROM server WHERE id = ?);", guild_id))
+
+    async def _insert_guilds(self, guild_ids: List[int]) -> List[int]:
+        """登録されていないサーバーを追加して、追加したサーバーIDのリストを取得"""
+        inserted = []
+        with self.connection:
+            self.connection.execute("BEGIN;")
+            for guild_id in guild_ids:
+                if self.connection.execute("INSERT INTO server (id) VALUES (?) ON CONFLICT DO NOTHING;", (guild_id,)).rowcount:
+                    inserted.append(guild_id)
+        return inserted
+
+    async def set_guilds_left(self, guild_ids: List[int], left: bool) -> None:
+        """サーバーの退出日時を記録 (leftがFalseの場合は退出日時を消去)"""
+        with self.connection:
+            self.connection.execute("BEGIN;")
+            if left:
+                now = time.time()
+                self.connection.executemany("UPDATE server SET left_at = ? WHERE id = ? AND left_at IS NULL;", [(now, guild_id) for guild_id in guild_ids])
+            else:
+                self.connection.executemany("UPDATE server SET left_at = NULL WHERE id = ? AND left_at IS NOT NULL;", [(guild_id,) for guild_id in guild_ids])
+
+    async def get_guild_users_count(self, guild_id: int) -> int:
+        """サーバーが認識しているユーザー数を取得"""
+        return self._fetchval("SELECT count(*) FROM member WHERE guild_id = ?;", guild_id)
+
+    async def get_guild_users(self, guild_id: int) -> list:
+        """保存されているユーザーのリストを取得"""
+        return self._fetchcol("SELECT user_id FROM member WHERE guild_id = ?;", guild_id)
+
+    async def get_enabled_guild_ids(self) -> list:
+        """有効化されているサーバーIDのリストを取得"""
+        return self._fetchcol("SELECT id FROM server WHERE channel IS NOT NULL;")
+
+    async def _fetch_log_channel_id(self, guild_id: int) -> Optional[int]:
+        """ログ送信用チャンネルをデータベースから取得"""
+        return self._fetchval("SELECT channel FROM server WHERE id = ?;", guild_id)
+
+    # Trigger
+    def _get_triggers(self, guild_id: int, kind: str) -> dict:
+        # kindは"code_trigger"か"user_trigger"のみ (内部からのみ指定)
+        res = self._fetchval(f"SELECT {kind} FROM server WHERE id = ?;", guild_id)
+        return {} if res is None else json.loads(res)
+
+    def _set_triggers(self, guild_id: int, kind: str, triggers: dict) -> None:
+        self.connection.execute(f"UPDATE server SET {kind} = ? WHERE id = ?;", (json.dumps(triggers), guild_id))
+
+    async def get_code_trigger_list(self, guild_id: int) -> list:
+        """招待コードトリガーに設定されているコードのリストを取得"""
+        return list(self._get_triggers(guild_id, "code_trigger"))
+
+    async def get_code_trigger_count(self, guild_id: int) -> int:
+        """招待コードトリガーの数を取得"""
+        return len(self._get_triggers(guild_id, "code_trigger"))
+
+    async def get_code_trigger_roles(self, guild_id: int, code: str) -> list:
+        """招待コードトリガーに設定されている役職のリストを取得"""
+        return self._get_triggers(guild_id, "code_trigger").get(code) or []
+
+    async def add_code_trigger(self, guild_id: int, code: str, roles: list) -> None:
+        """招待コードトリガーを追加"""
+        triggers = self._get_triggers(guild_id, "code_trigger")
+        triggers[code] = roles
+        self._set_triggers(guild_id, "code_trigger", triggers)
+
+    async def remove_code_trigger(self, guild_id: int, code: str) -> None:
+        """招待コードトリガーから設定されているコードを削除"""
+        triggers = self._get_triggers(guild_id, "code_trigger")
+        triggers.pop(code, None)
+        self._set_triggers(guild_id, "code_trigger", triggers)
+
+    async def get_user_trigger_list(self, guild_id: int) -> list:
+        """ユーザートリガーに設定されているユーザーのリストを取得"""
+        return list(self._get_triggers(guild_id, "user_trigger"))
+
+    async def get_user_trigger_count(self, guild_id: int) -> int:
+        """ユーザートリガーの数を取得"""
+        return len(self._get_triggers(guild_id, "user_trigger"))
+
+    async def get_user_trigger_roles(self, guild_id: int, user_id: int) -> list:
+        """ユーザートリガーに設定されている役職のリストを取得"""
+        return self._get_triggers(guild_id, "user_trigger").get(str(user_id)) or []
+
+    async def add_user_trigger(self, guild_id: int, user_id: int, roles: list) -> None:
+        """ユーザートリガーを追加"""
+        triggers = self._get_triggers(guild_id, "user_trigger")
+        triggers[str(user_id)] = roles
+        self._set_triggers(guild_id, "user_trigger", triggers)
+
+    async def remove_user_trigger(self, guild_id: int, user: int) -> None:
+        """ユーザートリガーから設定されているユーザーを削除"""
+        triggers = self._get_triggers(guild_id, "user_trigger")
+        triggers.pop(str(user), None)
+        self._set_triggers(guild_id, "user_trigger", triggers)
+
+    # Invites
+    async def record_joins(self, records: List[Tuple[int, int, int, str]]) -> None:
+        """複数の参加履歴をまとめて記録 [(サーバーID, 招待者ID, 参加者ID, 招待コード), ...]"""
+        with self.connection:
+            self.connection.execute("BEGIN;")
+            self.connection.executemany("INSERT INTO member (guild_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING;",
+                                        [(guild_id, inviter) for guild_id, inviter, invited, code in records if inviter != invited])
+            for guild_id, inviter, invited, code in records:
+                # 招待履歴が新しく追加された場合のみ招待数を加算
+                if self.connection.execute("INSERT INTO invited (guild_id, inviter, invited) VALUES (?, ?, ?) ON CONFLICT DO NOTHING;", (guild_id, inviter, invited)).rowcount:
+                    self.connection.execute("""
+                        INSERT INTO invite_count (guild_id, user_id, count) VALUES (?, ?, 1)
+                        ON CONFLICT (guild_id, user_id) DO UPDATE SET count = count + 1;
+                    """, (guild_id, inviter))
+            self.connection.executemany("""
+                INSERT INTO member (guild_id, user_id, inviter, code) VALUES (?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET inviter = excluded.inviter, code = excluded.code, left_at = NULL;
+            """, [(guild_id, invited, inviter, code) for guild_id, inviter, invited, code in records])
+
+    # User
+    async def register_new_user(self, guild_id: int, user_id: int) -> None:
+        """新規ユーザーデータを追加"""
+        self.connection.execute("INSERT INTO member (guild_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING;", (guild_id, user_id))
+
+    async def mark_member_left(self, guild_id: int, user_id: int) -> None:
+        """メンバーの退出日時を記録 (再参加時に消去)"""
+        self.connection.execute("UPDATE member SET left_at = ? WHERE guild_id = ? AND user_id = ?;", (time.time(), guild_id, user_id))
+
+    async def reset_users_data(self, guild_id: int, user_ids: Optional[List[int]] = None):
+        """複数ユーザーのデータを1回でクリア (user_idsを指定しない場合はサーバー全体)"""
+        with self.connection:
+            self.connection.execute("BEGIN;")
+            if user_ids is None:
+                self.connection.execute("DELETE FROM invited WHERE guild_id = ?;", (guild_id,))
+                self.connection.execute("DELETE FROM invite_count WHERE guild_id = ?;", (guild_id,))
+            else:
+                self.connection.executemany("DELETE FROM invited WHERE guild_id = ? AND inviter = ?;", [(guild_id, user_id) for user_id in user_ids])
+                self.connection.executemany("DELETE FROM invite_count WHERE guild_id = ? AND user_id = ?;", [(guild_id, user_id) for user_id in user_ids])
+
+    async def get_user_invite_count(self, guild_id: int, user_id: int) -> int:
+        """特定ユーザーの招待数を取得"""
+        return self._fetchval("SELECT count FROM invite_count WHERE guild_id = ? AND user_id = ?;", guild_id, user_id) or 0
+
+    async def get_leaderboard(self, guild_id: int, limit: int, after: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int]]:
+        """招待数の多いユーザーのリストを取得 [(ユーザーID, 招待数), ...] afterを指定した場合はその次から (前のページの最後の行)"""
+        if after is None:
+            return self.connection.execute("""
+                SELECT user_id, count FROM invite_count WHERE guild_id = ? AND count > 0
+                ORDER BY count DESC, user_id LIMIT ?;
+            """, (guild_id, limit)).fetchall()
+        return self.connection.execute("""
+            SELECT user_id, count FROM invite_count WHERE guild_id = ? AND count > 0 AND (count < ? OR (count = ? AND user_id > ?))
+            ORDER BY count DESC, user_id LIMIT ?;
+        """, (guild_id, after[1], after[1], after[0], limit)).fetchall()
+
+    async def get_user_invite_from(self, guild_id: int, user_id: int) -> Optional[int]:
+        """特定ユーザーの招待元ユーザーIDを取得"""
+        return self._fetchval("SELECT inviter FROM member WHERE guild_id = ? AND user_id = ?;", guild_id, user_id)
+
+    async def get_user_invite_code(self, guild_id: int, user_id: int) -> Optional[str]:
+        """特定ユーザーの参加時の招待コードを取得"""
+        return self._fetchval("SELECT code FROM member WHERE guild_id = ? AND user_id = ?;", guild_id, user_id)
+
+    async def is_registered_user(self, guild_id: int, user_id: int) -> bool:
+        """ユーザーがサーバーのユーザーリストに登録されているか確認"""
+        return bool(self._fetchval("SELECT EXISTS (SELECT 1 FROM member WHERE guild_id = ? AND user_id = ?);", guild_id, user_id))
+
+    async def filter_with_code_and_from(self, code_list: List[str], from_list: List[str], guild_id: int) -> Set[int]:
+        """指定した招待コードまたは招待者によって参加した人のIDリストを取得"""
+        id_list = set()
+        for code in code_list:
+            id_list.update(self._fetchcol("SELECT user_id FROM member WHERE guild_id = ? AND code = ?;", guild_id, code))
+        for user_id in from_list:
+            id_list.update(self._fetchcol("SELECT user_id FROM member WHERE guild_id = ? AND inviter = ?;", guild_id, int(user_id)))
+        return id_list
+
+    # Event
+    async def record_events(self, events: List[Event]) -> None:
+        """複数のイベントをまとめて追記"""
+        with self.connection:
+            self.connection.execute("BEGIN;")
+            self.connection.executemany("INSERT INTO event (created_at, guild_id, kind, user_id, inviter, code) VALUES (?, ?, ?, ?, ?, ?);",
+                                        [(created_at.timestamp(), *event) for created_at, *event in events])
+
+    async def get_events(self, guild_id: int, since: datetime.datetime, until: datetime.datetime) -> List[Event]:
+        """期間内(since以上until未満)のサーバーのイベントを発生順に取得"""
+        res = self.connection.execute("""
+            SELECT created_at, guild_id, kind, user_id, inviter, code FROM event
+            WHERE guild_id = ? AND created_at >= ? AND created_at < ? ORDER BY created_at;
+        """, (guild_id, since.timestamp(), until.timestamp()))
+        return [(datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc), *event) for created_at, *event in res]
+
+    # Retention
+    def _delete_batch(self, sql: str, *args) -> Tuple[int, int]:
+        """1回分を削除して、削除した行数と空いたページの容量を取得"""
+        page_size = self._fetchval("PRAGMA page_size;")
+        before = self._fetchval("PRAGMA freelist_count;")
+        rows = self.connection.execute(sql, args).rowcount
+        return rows, max(self._fetchval("PRAGMA freelist_count;") - before, 0) * page_size
+
+    async def get_departed_guild_ids(self, before: datetime.datetime) -> list:
+        """beforeより前にBOTが退出したサーバーIDのリストを取得"""
+        return self._fetchcol("SELECT id FROM server WHERE left_at < ?;", before.timestamp())
+
+    async def purge_guild(self, guild_id: int, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """退出したサーバーのデータを削除 (メンバー, 招待履歴, 招待数, イベント, サーバーの順)"""
+        if not self._fetchval("SELECT EXISTS (SELECT 1 FROM server WHERE id = ? AND left_at < ?);", guild_id, before.timestamp()):
+            return 0, 0  # 削除中にBOTが再参加した場合
+        for table in ("member", "invited", "invite_count", "event"):
+            rows, size = self._delete_batch(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE guild_id = ? LIMIT ?);", guild_id, limit)
+            if rows:
+                return rows, size
+        return self._delete_batch("DELETE FROM server WHERE id = ?;", guild_id)
+
+    async def purge_departed_members(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前に退出したメンバーのデータを削除"""
+        return self._delete_batch("DELETE FROM member WHERE rowid IN (SELECT rowid FROM member WHERE left_at < ? LIMIT ?);", before.timestamp(), limit)
+
+    async def purge_events(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前のイベントを削除"""
+        return self._delete_batch("DELETE FROM event WHERE rowid IN (SELECT rowid FROM event WHERE created_at < ? LIMIT ?);", before.timestamp(), limit)
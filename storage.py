@@ -0,0 +1,246 @@
+import abc
+import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+# イベント (発生日時, サーバーID, 種類, ユーザーID, 招待者ID, 招待コード)
+Event = Tuple[datetime.datetime, int, str, Optional[int], Optional[int], Optional[str]]
+
+
+class Storage(abc.ABC):
+    """データ保存先の共通インターフェース (SQLManager, SQLiteStorage, MemoryStorage)"""
+
+    def __init__(self):
+        # サーバー設定キャッシュ {サーバーID: ログチャンネルID(無効の場合None)}
+        self.log_channels: Dict[int, Optional[int]] = {}
+        self.settings_hits = 0
+        self.settings_misses = 0
+
+    # Connection
+    @abc.abstractmethod
+    async def connect(self) -> None:
+        """データベースに接続"""
+
+    @abc.abstractmethod
+    def is_connected(self) -> bool:
+        """データベースに接続しているか確認"""
+
+    def get_backend_stats(self) -> Dict[str, str]:
+        """保存先ごとの統計を取得 {項目名: 内容}"""
+        return {}
+
+    # Guild
+    @abc.abstractmethod
+    async def get_guild_ids(self) -> list:
+        """登録されているサーバーIDのリストを取得"""
+
+    async def load_guild_settings(self) -> None:
+        """全サーバーの設定をキャッシュに読み込み"""
+        self.log_channels = await self._fetch_guild_settings()
+
+    @abc.abstractmethod
+    async def _fetch_guild_settings(self) -> Dict[int, Optional[int]]:
+        """全サーバーのログチャンネルIDを取得"""
+
+    def get_settings_stats(self) -> dict:
+        """サーバー設定キャッシュの統計を取得"""
+        return {"guilds": len(self.log_channels), "hits": self.settings_hits, "misses": self.settings_misses}
+
+    async def is_enabled_guild(self, guild_id: int) -> bool:
+        """特定のサーバーでモニターが有効になっているかどうかを確認"""
+        return await self.get_log_channel_id(guild_id) is not None
+
+    async def enable_guild(self, guild_id: int, channel_id: int) -> None:
+        """有効にする"""
+        if not await self.is_registered_guild(guild_id):
+            await self.register_new_guild(guild_id)
+        await self._set_log_channel_id(guild_id, channel_id)
+        self.log_channels[guild_id] = channel_id
+
+    async def disable_guild(self, guild_id: int) -> None:
+        """無効にする"""
+        await self._set_log_channel_id(guild_id, None)
+        self.log_channels[guild_id] = None
+
+    @abc.abstractmethod
+    async def _set_log_channel_id(self, guild_id: int, channel_id: Optional[int]) -> None:
+        """ログチャンネルIDを保存 (Noneの場合は無効)"""
+
+    @abc.abstractmethod
+    async def is_registered_guild(self, guild_id: int) -> bool:
+        """サーバーが登録されているか確認"""
+
+    async def register_new_guild(self, guild_id: int) -> None:
+        """新規サーバーのデータを追加 (再参加した場合は削除対象から外す)"""
+        await self.register_new_guilds([guild_id])
+        await self.set_guilds_left([guild_id], False)
+
+    async def leave_guild(self, guild_id: int) -> None:
+        """BOTがサーバーから退出した際に無効にして、退出日時を記録"""
+        await self.disable_guild(guild_id)
+        await self.set_guilds_left([guild_id], True)
+
+    @abc.abstractmethod
+    async def set_guilds_left(self, guild_ids: List[int], left: bool) -> None:
+        """サーバーの退出日時を記録 (leftがFalseの場合は退出日時を消去)"""
+
+    async def register_new_guilds(self, guild_ids: List[int]) -> None:
+        """複数の新規サーバーのデータを1回で追加"""
+        # サーバーに再参加した場合は何もしない
+        for guild_id in await self._insert_guilds(guild_ids):
+            self.log_channels[guild_id] = None
+
+    @abc.abstractmethod
+    async def _insert_guilds(self, guild_ids: List[int]) -> List[int]:
+        """登録されていないサーバーを追加して、追加したサーバーIDのリストを取得"""
+
+    @abc.abstractmethod
+    async def get_guild_users_count(self, guild_id: int) -> int:
+        """サーバーが認識しているユーザー数を取得"""
+
+    @abc.abstractmethod
+    async def get_guild_users(self, guild_id: int) -> list:
+        """保存されているユーザーのリストを取得"""
+
+    @abc.abstractmethod
+    async def get_enabled_guild_ids(self) -> list:
+        """有効化されているサーバーIDのリストを取得"""
+
+    async def get_log_channel_id(self, guild_id: int) -> Optional[int]:
+        """ログ送信用チャンネルを取得 (キャッシュにあればデータベースに問い合わせない)"""
+        if guild_id in self.log_channels:
+            self.settings_hits += 1
+            return self.log_channels[guild_id]
+        self.settings_misses += 1
+        channel_id = await self._fetch_log_channel_id(guild_id)
+        self.log_channels[guild_id] = channel_id
+        return channel_id
+
+    @abc.abstractmethod
+    async def _fetch_log_channel_id(self, guild_id: int) -> Optional[int]:
+        """ログ送信用チャンネルをデータベースから取得"""
+
+    # Trigger
+    @abc.abstractmethod
+    async def get_code_trigger_list(self, guild_id: int) -> list:
+        """招待コードトリガーに設定されているコードのリストを取得"""
+
+    @abc.abstractmethod
+    async def get_code_trigger_count(self, guild_id: int) -> int:
+        """招待コードトリガーの数を取得"""
+
+    @abc.abstractmethod
+    async def get_code_trigger_roles(self, guild_id: int, code: str) -> list:
+        """招待コードトリガーに設定されている役職のリストを取得"""
+
+    @abc.abstractmethod
+    async def add_code_trigger(self, guild_id: int, code: str, roles: list) -> None:
+        """招待コードトリガーを追加"""
+
+    @abc.abstractmethod
+    async def remove_code_trigger(self, guild_id: int, code: str) -> None:
+        """招待コードトリガーから設定されているコードを削除"""
+
+    @abc.abstractmethod
+    async def get_user_trigger_list(self, guild_id: int) -> list:
+        """ユーザートリガーに設定されているユーザーのリストを取得"""
+
+    @abc.abstractmethod
+    async def get_user_trigger_count(self, guild_id: int) -> int:
+        """ユーザートリガーの数を取得"""
+
+    @abc.abstractmethod
+    async def get_user_trigger_roles(self, guild_id: int, user_id: int) -> list:
+        """ユーザートリガーに設定されている役職のリストを取得"""
+
+    @abc.abstractmethod
+    async def add_user_trigger(self, guild_id: int, user_id: int, roles: list) -> None:
+        """ユーザートリガーを追加"""
+
+    @abc.abstractmethod
+    async def remove_user_trigger(self, guild_id: int, user: int) -> None:
+        """ユーザートリガーから設定されているユーザーを削除"""
+
+    # Invites
+    async def record_join(self, guild_id: int, inviter: int, invited: int, code: str) -> None:
+        """参加履歴を記録 (招待者の登録, 招待履歴の追加, 招待元と招待コードの保存)"""
+        await self.record_joins([(guild_id, inviter, invited, code)])
+
+    @abc.abstractmethod
+    async def record_joins(self, records: List[Tuple[int, int, int, str]]) -> None:
+        """複数の参加履歴をまとめて記録 [(サーバーID, 招待者ID, 参加者ID, 招待コード), ...]"""
+
+    # User
+    @abc.abstractmethod
+    async def register_new_user(self, guild_id: int, user_id: int) -> None:
+        """新規ユーザーデータを追加"""
+
+    async def reset_user_data(self, guild_id: int, user_id: int):
+        """既存ユーザーデータをクリア"""
+        await self.reset_users_data(guild_id, [user_id])
+
+    @abc.abstractmethod
+    async def mark_member_left(self, guild_id: int, user_id: int) -> None:
+        """メンバーの退出日時を記録 (再参加時に消去)"""
+
+    @abc.abstractmethod
+    async def reset_users_data(self, guild_id: int, user_ids: Optional[List[int]] = None):
+        """複数ユーザーのデータを1回でクリア (user_idsを指定しない場合はサーバー全体)"""
+
+    @abc.abstractmethod
+    async def get_user_invite_count(self, guild_id: int, user_id: int) -> int:
+        """特定ユーザーの招待数を取得"""
+
+    @abc.abstractmethod
+    async def get_leaderboard(self, guild_id: int, limit: int, after: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int]]:
+        """
+        招待数の多いユーザーのリストを取得 [(ユーザーID, 招待数), ...]
+        afterに前のページの最後の行を指定すると、その次から取得する (読み飛ばす行数によらず一定の時間で取得)
+        """
+
+    @abc.abstractmethod
+    async def get_user_invite_from(self, guild_id: int, user_id: int) -> Optional[int]:
+        """特定ユーザーの招待元ユーザーIDを取得"""
+
+    @abc.abstractmethod
+    async def get_user_invite_code(self, guild_id: int, user_id: int) -> Optional[str]:
+        """特定ユーザーの参加時の招待コードを取得"""
+
+    @abc.abstractmethod
+    async def is_registered_user(self, guild_id: int, user_id: int) -> bool:
+        """ユーザーがサーバーのユーザーリストに登録されているか確認"""
+
+    @abc.abstractmethod
+    async def filter_with_code_and_from(self, code_list: List[str], from_list: List[str], guild_id: int) -> Set[int]:
+        """指定した招待コードまたは招待者によって参加した人のIDリストを取得"""
+
+    # Event
+    @abc.abstractmethod
+    async def record_events(self, events: List[Event]) -> None:
+        """複数のイベントをまとめて追記"""
+
+    @abc.abstractmethod
+    async def get_events(self, guild_id: int, since: datetime.datetime, until: datetime.datetime) -> List[Event]:
+        """期間内(since以上until未満)のサーバーのイベントを発生順に取得"""
+
+    # Retention
+    # 削除はlimit件ずつ行い、(削除した行数, 削除した行のサイズ[byte])を返す (0件になるまで繰り返し呼ぶ)
+    @abc.abstractmethod
+    async def get_departed_guild_ids(self, before: datetime.datetime) -> list:
+        """beforeより前にBOTが退出したサーバーIDのリストを取得"""
+
+    @abc.abstractmethod
+    async def purge_guild(self, guild_id: int, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """退出したサーバーのデータを削除 (メンバー, 招待履歴, 招待数, イベント, サーバーの順)"""
+
+    @abc.abstractmethod
+    async def purge_departed_members(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前に退出したメンバーのデータを削除"""
+
+    @abc.abstractmethod
+    async def purge_events(self, before: datetime.datetime, limit: int) -> Tuple[int, int]:
+        """beforeより前のイベントを削除"""
+
+    # Migration
+    async def migrate_legacy_users(self) -> int:
+        """旧形式のデータを移行 (移行が必要な保存先のみ)"""
+        return 0
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+# テストからリポジトリ直下のモジュールを読み込む
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_storage import MemoryStorage  # noqa: E402
+from sqlite_storage import SQLiteStorage  # noqa: E402
+
+# 元々のBOTが作成していたserverテーブル (SQLManagerのSCHEMAはこのテーブルがある前提)
+LEGACY_SERVER_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS server (
+        id bigint PRIMARY KEY,
+        channel bigint,
+        code_trigger jsonb NOT NULL DEFAULT '{}',
+        user_trigger jsonb NOT NULL DEFAULT '{}',
+        users jsonb NOT NULL DEFAULT '{}'
+    );
+"""
+
+# PostgreSQLはDATABASE_URLが設定されている場合のみ (専用のスキーマを作成して、終了後に削除)
+BACKENDS = ["memory", "sqlite"] + (["postgres"] if os.getenv("DATABASE_URL") else [])
+
+
+async def open_storage(backend: str, tmp_path):
+    if backend == "memory":
+        db = MemoryStorage()
+    elif backend == "sqlite":
+        db = SQLiteStorage(str(tmp_path / "storage.db"))
+    else:
+        import asyncpg
+        from pool_manager import PoolConfig
+        from SQLManager import SQLManager
+        schema = f"test_{uuid.uuid4().hex}"
+        con = await asyncpg.connect(os.getenv("DATABASE_URL"))
+        try:
+            await con.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema}; {LEGACY_SERVER_SCHEMA}")
+        finally:
+            await con.close()
+        db = SQLManager(os.getenv("DATABASE_URL"), asyncio.get_event_loop(), PoolConfig(min_size=1, max_size=1))
+        db.test_schema = schema
+        # 全ての接続で作成したスキーマを使う (認識されない接続パラメーターはサーバーの設定として渡される)
+        db.database_url = db.pool.database_url = f"{db.database_url}{'&' if '?' in db.database_url else '?'}search_path={schema}"
+    await db.connect()
+    return db
+
+
+async def close_storage(backend: str, db) -> None:
+    if backend == "sqlite":
+        db.connection.close()
+    elif backend == "postgres":
+        async with db.pool.acquire() as con:
+            await con.execute(f"DROP SCHEMA {db.test_schema} CASCADE;")
+        await db.pool.pool.close()
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    """保存先ごとに、接続したStorageを渡してテストの処理を実行"""
+    def runner(check):
+        async def main():
+            db = await open_storage(request.param, tmp_path)
+            try:
+                await check(db)
+            finally:
+                await close_storage(request.param, db)
+        asyncio.run(main())
+    return runner
@@ -0,0 +1,66 @@
+import asyncio
+import datetime
+
+from event_log import EVENT_JOIN, EventWriter
+from join_buffer import JoinBuffer
+from memory_storage import MemoryStorage
+
+GUILD = 100
+UTC = datetime.timezone.utc
+
+
+class SlowStorage(MemoryStorage):
+    """書き込みをreleaseが呼ばれるまで止めるStorage"""
+
+    def __init__(self):
+        super().__init__()
+        self.writing = asyncio.Event()
+        self.released = asyncio.Event()
+
+    async def record_events(self, events):
+        self.writing.set()
+        await self.released.wait()
+        await super().record_events(events)
+
+    async def record_joins(self, records):
+        self.writing.set()
+        await self.released.wait()
+        await super().record_joins(records)
+
+
+def test_event_writer_close_during_write():
+    async def main():
+        db = SlowStorage()
+        writer = EventWriter(db, max_size=2, interval=60)
+        writer.start(asyncio.get_event_loop())
+        for user_id in (10, 11):
+            await writer.record(GUILD, EVENT_JOIN, user_id, 1, "aaa")
+        await db.writing.wait()  # 定期書き込みが書き込み中
+        await writer.record(GUILD, EVENT_JOIN, 12, 1, "aaa")
+        closing = asyncio.ensure_future(writer.close())
+        await asyncio.sleep(0)
+        db.released.set()
+        await closing
+        now = datetime.datetime.now(UTC)
+        events = await db.get_events(GUILD, now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=1))
+        assert [event[3] for event in events] == [10, 11, 12]
+        assert (writer.written, writer.write_count, len(writer)) == (3, 2, 0)
+    asyncio.run(main())
+
+
+def test_join_buffer_close_during_write():
+    async def main():
+        db = SlowStorage()
+        await db.register_new_guild(GUILD)
+        buffer = JoinBuffer(db, max_size=2, interval=60)
+        buffer.start(asyncio.get_event_loop())
+        for invited in (10, 11):
+            await buffer.record_join(GUILD, 1, invited, "aaa")
+        await db.writing.wait()
+        closing = asyncio.ensure_future(buffer.close())
+        await asyncio.sleep(0)
+        db.released.set()
+        await closing
+        assert sorted(await db.get_guild_users(GUILD)) == [1, 10, 11]
+        assert (buffer.written, buffer.write_count) == (2, 1)
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+import asyncio
+import dataclasses
+import os
+
+import pytest
+
+from conftest import close_storage, open_storage
+
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="DATABASE_URL is not set")
+
+
+def test_queries_reuse_pooled_connection(tmp_path):
+    async def main():
+        db = await open_storage("postgres", tmp_path)
+        try:
+            # 同じ接続をプールから取得し直しても、続けて問い合わせできる
+            async with db.pool.acquire() as con:
+                first_pid = con.get_server_pid()
+            await db.enable_guild(100, 10)
+            assert await db.get_guild_ids() == [100]
+            assert await db.get_guild_ids() == [100]
+            async with db.pool.acquire() as con:
+                assert con.get_server_pid() == first_pid
+            stats = db.statements.get_stats()
+            assert stats["connections"] == 1
+            assert stats["hits"] >= 1
+        finally:
+            await close_storage("postgres", db)
+    asyncio.run(main())
+
+
+def test_pool_recycles_old_connections(tmp_path):
+    async def main():
+        db = await open_storage("postgres", tmp_path)
+        try:
+            db.pool.config = dataclasses.replace(db.pool.config, max_lifetime=0.05)
+            async with db.pool.acquire() as con:
+                first_pid = con.get_server_pid()
+                await asyncio.sleep(0.1)  # 使用中の接続は閉じない
+                assert not con.is_closed()
+            # 作成から時間が経った接続は、使い終わった際に作り直される
+            async with db.pool.acquire() as con:
+                assert con.get_server_pid() != first_pid
+            assert db.pool.get_stats()["recycled"] == 1
+            assert await db.get_guild_ids() in ([], None)
+        finally:
+            await close_storage("postgres", db)
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+import datetime
+
+GUILD = 100
+OTHER_GUILD = 200
+UTC = datetime.timezone.utc
+
+
+def test_enable_and_disable(run):
+    async def check(db):
+        assert not await db.is_registered_guild(GUILD)
+        await db.enable_guild(GUILD, 10)
+        assert await db.is_registered_guild(GUILD)
+        assert await db.get_log_channel_id(GUILD) == 10
+        assert await db.get_enabled_guild_ids() == [GUILD]
+        await db.disable_guild(GUILD)
+        assert not await db.is_enabled_guild(GUILD)
+        assert await db.get_enabled_guild_ids() in ([], None)
+        # キャッシュを読み直しても同じ結果になる
+        await db.enable_guild(GUILD, 11)
+        await db.load_guild_settings()
+        assert await db.get_log_channel_id(GUILD) == 11
+        assert sorted(await db.get_guild_ids()) == [GUILD]
+    run(check)
+
+
+def test_register_new_guilds(run):
+    async def check(db):
+        await db.enable_guild(GUILD, 10)
+        await db.register_new_guilds([GUILD, OTHER_GUILD])
+        # 登録済みのサーバーの設定は変更しない
+        assert await db.get_log_channel_id(GUILD) == 10
+        assert await db.get_log_channel_id(OTHER_GUILD) is None
+        assert sorted(await db.get_guild_ids()) == [GUILD, OTHER_GUILD]
+    run(check)
+
+
+def test_record_joins(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_joins([(GUILD, 1, 10, "aaa"), (GUILD, 1, 11, "aaa"), (GUILD, 2, 12, "bbb")])
+        assert await db.get_user_invite_from(GUILD, 10) == 1
+        assert await db.get_user_invite_code(GUILD, 12) == "bbb"
+        assert await db.is_registered_user(GUILD, 1)  # 招待者も登録される
+        assert await db.get_guild_users_count(GUILD) == 5
+        assert sorted(await db.get_guild_users(GUILD)) == [1, 2, 10, 11, 12]
+        assert await db.get_user_invite_count(GUILD, 1) == 2
+        assert await db.filter_with_code_and_from(["aaa"], [], GUILD) == {10, 11}
+        assert await db.filter_with_code_and_from(["aaa"], ["2"], GUILD) == {10, 11, 12}
+        assert await db.get_user_invite_from(OTHER_GUILD, 10) is None
+    run(check)
+
+
+def test_record_joins_reattribution(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_join(GUILD, 1, 10, "aaa")
+        await db.record_join(GUILD, 1, 10, "aaa")  # 同じ招待者からの再参加は加算しない
+        assert await db.get_user_invite_count(GUILD, 1) == 1
+        await db.record_join(GUILD, 2, 10, "bbb")
+        assert await db.get_user_invite_from(GUILD, 10) == 2
+        assert await db.get_user_invite_code(GUILD, 10) == "bbb"
+        assert await db.filter_with_code_and_from(["aaa"], ["1"], GUILD) == set()
+        assert await db.filter_with_code_and_from(["bbb"], [], GUILD) == {10}
+        # 以前の招待者の招待数は残る
+        assert await db.get_user_invite_count(GUILD, 1) == 1
+        assert await db.get_user_invite_count(GUILD, 2) == 1
+    run(check)
+
+
+def test_leaderboard(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_joins([(GUILD, inviter, invited, "code") for inviter, count in ((1, 3), (2, 1), (3, 3)) for invited in range(inviter * 10, inviter * 10 + count)])
+        assert await db.get_leaderboard(GUILD, 10) == [(1, 3), (3, 3), (2, 1)]
+        assert await db.get_leaderboard(GUILD, 1, (1, 3)) == [(3, 3)]
+        assert await db.get_leaderboard(GUILD, 10, (3, 3)) == [(2, 1)]
+        assert await db.get_leaderboard(GUILD, 10, (2, 1)) == []
+        # 招待数が変わっても、前のページの最後の行の次から取得する
+        await db.record_joins([(GUILD, 2, invited, "code") for invited in range(40, 43)])
+        assert await db.get_leaderboard(GUILD, 10) == [(2, 4), (1, 3), (3, 3)]
+        assert await db.get_leaderboard(GUILD, 2, (2, 4)) == [(1, 3), (3, 3)]
+        assert await db.get_leaderboard(OTHER_GUILD, 10) == []
+    run(check)
+
+
+def test_reset_users_data(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_joins([(GUILD, 1, 10, "aaa"), (GUILD, 2, 11, "bbb"), (GUILD, 3, 12, "ccc")])
+        await db.reset_user_data(GUILD, 1)
+        assert await db.get_user_invite_count(GUILD, 1) == 0
+        assert await db.get_leaderboard(GUILD, 10) == [(2, 1), (3, 1)]
+        await db.reset_users_data(GUILD, [2])
+        assert await db.get_leaderboard(GUILD, 10) == [(3, 1)]
+        await db.reset_users_data(GUILD)
+        assert await db.get_leaderboard(GUILD, 10) == []
+        # 招待をやり直すと、招待数は0から数え直す
+        await db.record_join(GUILD, 1, 10, "aaa")
+        assert await db.get_user_invite_count(GUILD, 1) == 1
+    run(check)
+
+
+def test_triggers(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.add_code_trigger(GUILD, "aaa", [1, 2])
+        await db.add_code_trigger(GUILD, "bbb", [3])
+        assert sorted(await db.get_code_trigger_list(GUILD)) == ["aaa", "bbb"]
+        assert await db.get_code_trigger_count(GUILD) == 2
+        assert await db.get_code_trigger_roles(GUILD, "aaa") == [1, 2]
+        assert await db.get_code_trigger_roles(GUILD, "ccc") == []
+        await db.remove_code_trigger(GUILD, "aaa")
+        assert await db.get_code_trigger_list(GUILD) == ["bbb"]
+        await db.add_user_trigger(GUILD, 10, [4])
+        assert await db.get_user_trigger_list(GUILD) == ["10"]
+        assert await db.get_user_trigger_count(GUILD) == 1
+        assert await db.get_user_trigger_roles(GUILD, 10) == [4]
+        await db.remove_user_trigger(GUILD, 10)
+        assert await db.get_user_trigger_count(GUILD) == 0
+        assert await db.get_user_trigger_roles(GUILD, 10) == []
+    run(check)
+
+
+def test_events(run):
+    async def check(db):
+        start = datetime.datetime(2021, 1, 31, 23, 0, tzinfo=UTC)
+        events = [(start + datetime.timedelta(hours=hours), guild_id, "join", 10 + hours, 1, "aaa") for hours in range(4) for guild_id in (GUILD, OTHER_GUILD)]
+        await db.record_events(events[1:])
+        await db.record_events(events[:1])  # 発生順が前後しても発生順に取得できる
+        res = await db.get_events(GUILD, start, start + datetime.timedelta(hours=3))
+        assert res == [event for event in events[:6] if event[1] == GUILD]
+        assert await db.get_events(GUILD, start + datetime.timedelta(hours=4), start + datetime.timedelta(hours=5)) == []
+    run(check)
+
+
+def test_purge_departed_members(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_joins([(GUILD, 1, invited, "aaa") for invited in range(10, 15)])
+        for invited in range(10, 13):
+            await db.mark_member_left(GUILD, invited)
+        await db.record_join(GUILD, 1, 12, "aaa")  # 再参加したメンバーは削除しない
+        before = datetime.datetime.now(UTC) + datetime.timedelta(days=1)
+        assert (await db.purge_departed_members(before, 1))[0] == 1
+        assert (await db.purge_departed_members(before, 10))[0] == 1
+        assert (await db.purge_departed_members(before, 10))[0] == 0
+        assert sorted(await db.get_guild_users(GUILD)) == [1, 12, 13, 14]
+        assert await db.get_user_invite_from(GUILD, 10) is None
+        assert await db.filter_with_code_and_from(["aaa"], [], GUILD) == {12, 13, 14}
+    run(check)
+
+
+def test_purge_guild(run):
+    async def check(db):
+        await db.register_new_guilds([GUILD, OTHER_GUILD])
+        await db.record_joins([(guild_id, 1, invited, "aaa") for guild_id in (GUILD, OTHER_GUILD) for invited in range(10, 13)])
+        now = datetime.datetime.now(UTC)
+        await db.record_events([(now, guild_id, "join", 10, 1, "aaa") for guild_id in (GUILD, OTHER_GUILD)])
+        await db.leave_guild(GUILD)
+        before = now + datetime.timedelta(days=1)
+        assert await db.get_departed_guild_ids(now - datetime.timedelta(days=1)) in ([], None)
+        assert await db.get_departed_guild_ids(before) == [GUILD]
+        rows = 0
+        while (res := await db.purge_guild(GUILD, before, 2))[0]:
+            rows += res[0]
+        # メンバー4, 招待履歴3, 招待数1, イベント1, サーバー1
+        assert rows == 10
+        assert not await db.is_registered_guild(GUILD)
+        assert await db.get_events(GUILD, now, before) == []
+        # 他のサーバーのデータは残る
+        assert await db.get_guild_users_count(OTHER_GUILD) == 4
+        assert await db.get_leaderboard(OTHER_GUILD, 10) == [(1, 3)]
+        assert len(await db.get_events(OTHER_GUILD, now, before)) == 1
+    run(check)
+
+
+def test_purge_guild_after_return(run):
+    async def check(db):
+        await db.register_new_guild(GUILD)
+        await db.record_join(GUILD, 1, 10, "aaa")
+        await db.leave_guild(GUILD)
+        await db.register_new_guild(GUILD)  # 再参加したサーバーは削除しない
+        before = datetime.datetime.now(UTC) + datetime.timedelta(days=1)
+        assert await db.get_departed_guild_ids(before) in ([], None)
+        assert (await db.purge_guild(GUILD, before, 10))[0] == 0
+        assert await db.get_guild_users_count(GUILD) == 2
+    run(check)
+
+
+def test_purge_events(run):
+    async def check(db):
+        old = datetime.datetime(2020, 1, 15, tzinfo=UTC)
+        new = datetime.datetime(2020, 3, 15, tzinfo=UTC)
+        await db.record_events([(old + datetime.timedelta(minutes=minutes), GUILD, "join", minutes, 1, "aaa") for minutes in range(5)])
+        await db.record_events([(new, GUILD, "leave", 1, None, None)])
+        rows = 0
+        while any(res := await db.purge_events(datetime.datetime(2020, 3, 1, tzinfo=UTC), 2)):
+            assert res[0] <= 2 or res[0] == 5  # PostgreSQLはパーティションごとに削除
+            rows += res[0]
+        assert rows == 5
+        assert await db.get_events(GUILD, old, new + datetime.timedelta(days=1)) == [(new, GUILD, "leave", 1, None, None)]
+    run(check)